@@ -0,0 +1,281 @@
+"""Loads the data files of many sessions at once and computes the standard search measures.
+
+visSearch writes one tab separated file per subject (data/<subjCode>.tsv,
+without a header) and TLTask one csv per subject (VisualSearch_NNN.csv). In
+both, the list columns (distractorLocations, Locations, ...) are stringified
+lists. Here every file is read by a pool of worker processes and concatenated
+into one DataFrame, list columns are parsed for all rows at once into a
+columnar.RaggedColumn, and every measure is a single groupby over sums, so
+thousands of sessions take seconds instead of a loop per row.
+
+The measures take the names of the columns they use, with the visSearch names
+as defaults. For TLTask data pass e.g. x='SetSize', y='RT', acc='ACC' and
+by=['Subject'].
+
+If this file is run directly, it prints the RT x set size slopes of the files
+given on the command line.
+
+Functions:
+accuracy_by -- returns the mean accuracy and trial count per group.
+block_effects -- returns the mean correct RT and accuracy per subject and block.
+find_files -- lists the data files matching glob patterns.
+load_tltask -- reads TLTask csv files into one DataFrame.
+load_vissearch -- reads visSearch data files into one DataFrame.
+parse_list_column -- parses a column of stringified lists into a RaggedColumn in bulk.
+read_tltask_file -- reads one TLTask csv file.
+read_vissearch_file -- reads one visSearch data file.
+rt_slopes -- fits RT = intercept + slope * set size per group.
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import columnar
+
+# The columns visSearch writes: the trial file (run time variables, then the trial fields), then the responses
+vissearch_run_time_fields = ['subjCode', 'instructions', 'lang', 'showTargetImage', 'showTargetText',
+                             'seed', 'gender', 'blockOrder', 'dateStr', 'expVersion']
+vissearch_trial_fields = ['block', 'targetName', 'targetPic', 'distractorName', 'distractorPic',
+                          'targetLocation', 'isPresent', 'numItems', 'distractorLocations']
+vissearch_response_fields = ['part', 'trialIndex', 'response', 'isRight', 'rt']
+vissearch_fields = vissearch_run_time_fields + vissearch_trial_fields + vissearch_response_fields
+# frametiming.trial_fields(['blank', 'fixation', 'search', 'clear']), spelled out so analysis does not need psychopy
+vissearch_timing_fields = ['BlankOnset', 'BlankDrawMs', 'FixationOnset', 'FixationDrawMs', 'SearchOnset',
+                           'SearchDrawMs', 'ClearOnset', 'ClearDrawMs', 'DroppedFrames', 'RTOffsetMs']
+
+serial_below = 8  # files; fewer than this are read without starting worker processes
+
+
+_list_punctuation = {
+    False: str.maketrans('', '', '[]() \t\r'),
+    True: str.maketrans('', '', '[]()\t\r\'"'),  # strings keep their spaces
+}
+_empty_string = '\x00'  # stands in for '' in lists of strings while they are split
+
+
+def find_files(patterns):
+    """Returns the sorted list of files matching any of the glob patterns.
+
+    Parameters:
+    patterns -- A glob pattern (e.g. 'data/*.tsv') or a list of them.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return sorted(set(path for pattern in patterns for path in glob.glob(pattern)))
+
+
+def read_vissearch_file(path):
+    """Reads one visSearch data file (see load_vissearch) into a DataFrame, practice trials included.
+
+    Parameters:
+    path -- The name of the data file.
+    """
+    frame = pd.read_csv(path, sep='\t', header=None, na_values=['NA', '*'], keep_default_na=False,
+                        dtype={0: str})  # subject codes such as 007 stay strings
+    n_extra = frame.shape[1] - len(vissearch_fields)
+    if n_extra == len(vissearch_timing_fields):
+        extra = vissearch_timing_fields
+    else:
+        extra = ['extra%d' % i for i in range(max(n_extra, 0))]
+    frame.columns = (vissearch_fields + extra)[:frame.shape[1]]
+    frame['session'] = os.path.splitext(os.path.basename(path))[0]
+    return frame
+
+
+def read_tltask_file(path):
+    """Reads one TLTask csv file (see load_tltask) into a DataFrame.
+
+    Parameters:
+    path -- The name of the csv file.
+    """
+    frame = pd.read_csv(path, na_values=['NA', 'None'], keep_default_na=False,
+                        dtype={'Subject': str})
+    frame['session'] = os.path.splitext(os.path.basename(path))[0]
+    return frame
+
+
+def _read_many(paths, reader, processes):
+    if processes == 1 or len(paths) < serial_below:
+        frames = [reader(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            frames = list(pool.map(reader, paths, chunksize=max(1, len(paths) // 64)))
+    if not frames:
+        raise ValueError('No data files to read.')
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+def load_vissearch(paths, real_only=True, processes=None):
+    """Reads visSearch data files (data/<subjCode>.tsv) into one DataFrame.
+
+    The columns are named as in the trial file followed by part, trialIndex, response, isRight
+    and rt (and the frame timing columns if they were recorded). A session column holds the name
+    of the file each row came from.
+
+    Parameters:
+    paths -- A list of file names, or glob patterns (see find_files).
+    real_only -- If True, practice trials are dropped.
+    processes -- The number of worker processes (default is the number of CPUs, 1 reads serially).
+    """
+    frame = _read_many(find_files(paths), read_vissearch_file, processes)
+    if real_only:
+        frame = frame[frame['part'] == 'real'].reset_index(drop=True)
+    return frame
+
+
+def load_tltask(paths, processes=None):
+    """Reads TLTask csv files into one DataFrame with a session column naming the file of each row.
+
+    Parameters:
+    paths -- A list of file names, or glob patterns (see find_files).
+    processes -- The number of worker processes (default is the number of CPUs, 1 reads serially).
+    """
+    return _read_many(find_files(paths), read_tltask_file, processes)
+
+
+def parse_list_column(strings, dtype=float, width=None):
+    """Parses a column of stringified lists (e.g. '[0, 5, 1]' or '[[1.5, 2], [3, 4]]') into a
+    columnar.RaggedColumn, for all rows at once.
+
+    All brackets are removed and the items of every row are split in one vectorized pass, so
+    nested lists come out flat; give width to get them back as rows of width values (e.g. 2 for
+    x, y pairs).
+
+    Parameters:
+    strings -- A pandas Series (or list) of stringified lists. Missing values are empty rows.
+    dtype -- The dtype of the values: a number type, or str for lists of strings.
+    width -- The number of values per item for nested lists, or None.
+    """
+    rows = pd.Series(strings, dtype=object).fillna('').astype(str)
+    if not len(rows):
+        return columnar.RaggedColumn(np.array([], dtype=dtype), np.zeros(1, dtype=np.int64))
+    text = '\n'.join(rows)
+    if dtype is str:  # an empty string would be lost with its quotes
+        text = text.replace("''", _empty_string).replace('""', _empty_string)
+    text = text.translate(_list_punctuation[dtype is str])
+    text = text.replace(', ', ',').replace(',\n', '\n').rstrip(',')
+
+    # Every row has one value more than it has commas, unless it is empty
+    chars = np.frombuffer(text.encode(), dtype=np.uint8)
+    row_ends = np.append(np.flatnonzero(chars == ord('\n')), len(chars))
+    row_starts = np.append(0, row_ends[:-1] + 1)
+    commas = np.bincount(np.searchsorted(row_ends, np.flatnonzero(chars == ord(','))),
+                         minlength=len(rows))
+    lengths = np.where(row_ends > row_starts, commas + 1, 0)
+
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # Splitting gives commas + 1 items per row, and one empty item for an empty row, which is dropped
+    items = np.array(text.replace('\n', ',').split(','), dtype=object)
+    items = items[np.repeat(lengths > 0, commas + 1)]
+    if dtype is str:
+        items[items == _empty_string] = ''
+    values = np.array(items.tolist(), dtype=dtype)
+
+    if width is not None:
+        values = values.reshape(-1, width)
+        offsets //= width
+    return columnar.RaggedColumn(values, offsets)
+
+
+def rt_slopes(frame, by=('subjCode', 'isPresent'), x='numItems', y='rt', acc='isRight',
+              correct_only=True):
+    """Fits y = intercept + slope * x by least squares for every group, e.g. the search slope in
+    ms per item for every subject and target presence.
+
+    The fit uses the per group sums of x, y, x*x, x*y and y*y from one groupby, so there is no
+    loop over groups.
+
+    Returns a DataFrame indexed by the groups with columns n, slope, intercept and r2. Groups with
+    a single set size get nan.
+
+    Parameters:
+    frame -- A DataFrame from load_vissearch or load_tltask.
+    by -- The column (or list of columns) to group by.
+    x -- The set size column.
+    y -- The RT column.
+    acc -- The accuracy column (1 for correct), used if correct_only.
+    correct_only -- If True, only correct trials are used.
+    """
+    if correct_only:
+        frame = frame[frame[acc] == 1]
+    x_values = frame[x].to_numpy(dtype=float)
+    y_values = frame[y].to_numpy(dtype=float)
+    valid = np.isfinite(x_values) & np.isfinite(y_values)
+
+    terms = pd.DataFrame({'n': 1.0, 'x': x_values, 'y': y_values, 'xx': x_values * x_values,
+                          'xy': x_values * y_values, 'yy': y_values * y_values})[valid]
+    keys = [frame[column].to_numpy()[valid] for column in _as_list(by)]
+    sums = terms.groupby(keys).sum()
+    sums.index.names = _as_list(by)
+
+    n = sums['n']
+    sxx = n * sums['xx'] - sums['x'] ** 2
+    sxy = n * sums['xy'] - sums['x'] * sums['y']
+    syy = n * sums['yy'] - sums['y'] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sxy / sxx).where(sxx > 0)
+        r2 = (sxy ** 2 / (sxx * syy)).where((sxx > 0) & (syy > 0))
+
+    return pd.DataFrame({
+        'n': n.astype(int),
+        'slope': slope,
+        'intercept': (sums['y'] - slope * sums['x']) / n,
+        'r2': r2,
+    })
+
+
+def accuracy_by(frame, by=('subjCode', 'isPresent'), acc='isRight'):
+    """Returns a DataFrame with the mean accuracy (accuracy) and trial count (n) of every group.
+
+    Parameters:
+    frame -- A DataFrame from load_vissearch or load_tltask.
+    by -- The column (or list of columns) to group by.
+    acc -- The accuracy column (1 for correct).
+    """
+    grouped = frame.groupby(_as_list(by))[acc]
+    return pd.DataFrame({'n': grouped.size(), 'accuracy': grouped.mean()})
+
+
+def block_effects(frame, subject='subjCode', block='block', y='rt', acc='isRight'):
+    """Returns a DataFrame with the mean correct RT (rt), accuracy and trial count (n) for every
+    subject and block.
+
+    Parameters:
+    frame -- A DataFrame from load_vissearch or load_tltask.
+    subject -- The subject column.
+    block -- The block column.
+    y -- The RT column.
+    acc -- The accuracy column (1 for correct).
+    """
+    correct_rt = frame[y].where(frame[acc] == 1)
+    grouped = frame.assign(_correct_rt=correct_rt).groupby([subject, block])
+    return pd.DataFrame({
+        'n': grouped.size(),
+        'rt': grouped['_correct_rt'].mean(),
+        'accuracy': grouped[acc].mean(),
+    })
+
+
+def _as_list(columns):
+    return [columns] if isinstance(columns, str) else list(columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the RT x set size slopes of data files.')
+    parser.add_argument('files', nargs='+', help='data files or glob patterns')
+    parser.add_argument('--format', choices=['vissearch', 'tltask'], default='vissearch')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.format == 'vissearch':
+        data = load_vissearch(args.files, processes=args.processes)
+        print(rt_slopes(data).to_string())
+    else:
+        data = load_tltask(args.files, processes=args.processes)
+        print(rt_slopes(data, by=['Subject'], x='SetSize', y='RT', acc='ACC').to_string())
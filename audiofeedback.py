@@ -0,0 +1,321 @@
+"""Low latency playback of feedback sounds (e.g. the error buzz).
+
+Calling play() on a psychopy Sound starts it whenever the audio backend gets
+to it, which can be tens of milliseconds after the screen changed. Here every
+sound is preloaded into memory once, and playback is scheduled for an exact
+time, by default the next flip of the window, so the sound starts with the
+frame it belongs to. With the PTB backend the audio device reports when each
+sound really started, which is recorded as its onset latency (actual minus
+scheduled start).
+
+Scheduling needs psychopy.sound to be running on the PTB backend. If
+initAudio fell back to another library (e.g. pyo), the SoundBackend plays the
+sounds right away instead, like Sound.play() always did, and their onsets are
+not measured.
+
+The NullBackend plays nothing but records (and can log to a file) every
+scheduled sound, so the timing logic can be tested without sound hardware. It
+is only used when passed in explicitly (as headless.py does).
+
+Classes:
+FeedbackAudio -- Preloads feedback sounds and plays them aligned to the next flip.
+NullBackend -- An audio backend that only records what would have been played.
+PTBBackend -- An audio backend that plays preloaded sounds with psychtoolbox.
+SoundBackend -- An audio backend that plays sounds right away with any psychopy.sound library.
+
+Functions:
+default_backend -- returns the backend for the library psychopy.sound is using.
+"""
+
+import json
+import os
+import time
+import wave
+
+import numpy as np
+
+try:
+    import psychtoolbox as ptb
+except ImportError:
+    ptb = None
+
+onset_tolerance = .005  # s; an onset this much before the scheduled time is from an earlier play
+
+
+class PTBBackend:
+    """Plays preloaded sounds with psychopy's PTB backend at times on the ptb.GetSecs() clock.
+
+    Methods:
+    load -- preloads a sound file.
+    now -- returns the current time on the audio clock.
+    onset -- returns when a sound last started playing.
+    play -- schedules a sound to start at a given time.
+    """
+
+    def __init__(self):
+        if ptb is None:
+            raise ImportError('PTBBackend needs psychtoolbox (pip install psychtoolbox).')
+        import psychopy.sound
+        self.sound_module = psychopy.sound
+        self.sounds = {}
+
+    def load(self, name, filename):
+        """Loads the whole sound file into memory (preBuffer=-1), so playing never reads the disk.
+
+        Parameters:
+        name -- The name to play the sound by.
+        filename -- The sound file.
+        """
+        self.sounds[name] = self.sound_module.Sound(filename, preBuffer=-1)
+
+    def now(self):
+        """Returns the current time on the clock play() is scheduled on."""
+        return ptb.GetSecs()
+
+    def play(self, name, when):
+        """Schedules a preloaded sound to start at time when.
+
+        Parameters:
+        name -- The name of the sound.
+        when -- The start time on the ptb.GetSecs() clock.
+        """
+        self.sounds[name].play(when=when)
+
+    def onset(self, name):
+        """Returns the time the audio device last started the sound, or None if it is not known."""
+        track = getattr(self.sounds[name], 'track', None)
+        try:
+            start_time = track.status['StartTime']
+        except (AttributeError, KeyError, TypeError):
+            return None
+        return start_time or None
+
+
+class SoundBackend:
+    """Plays sounds with whatever library psychopy.sound is using (e.g. pyo), as soon as play() is
+    called; the scheduled time is ignored and onsets are unknown.
+
+    Methods:
+    load -- loads a sound file.
+    now -- returns the current time.
+    onset -- returns None, as the start of a sound is not known.
+    play -- plays a sound right away.
+    """
+
+    def __init__(self):
+        import psychopy.sound
+        self.sound_module = psychopy.sound
+        self.sounds = {}
+
+    def load(self, name, filename):
+        """Loads a sound file.
+
+        Parameters:
+        name -- The name to play the sound by.
+        filename -- The sound file.
+        """
+        self.sounds[name] = self.sound_module.Sound(filename)
+
+    def now(self):
+        """Returns the current time."""
+        return time.perf_counter()
+
+    def play(self, name, when):
+        """Plays a sound right away.
+
+        Parameters:
+        name -- The name of the sound.
+        when -- Ignored; the library cannot schedule sounds.
+        """
+        self.sounds[name].play()
+
+    def onset(self, name):
+        """Returns None; this backend cannot tell when a sound started."""
+        return None
+
+
+class NullBackend:
+    """An audio backend without sound hardware. A sound "starts" at its scheduled time (or right
+    away if that has passed).
+
+    Parameters:
+    sink -- An optional file name. Every scheduled sound is appended to it as a tab separated line
+        of name, scheduled start, start and duration.
+
+    Methods:
+    load -- records a sound file's duration.
+    now -- returns the current time.
+    onset -- returns when a sound last started.
+    play -- records a sound as started at a given time.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.durations = {}
+        self.onsets = {}
+        self.played = []
+
+    def load(self, name, filename):
+        """Records the duration of a sound file (0 if it is not a readable .wav file).
+
+        Parameters:
+        name -- The name to play the sound by.
+        filename -- The sound file.
+        """
+        try:
+            with wave.open(filename, 'rb') as wav_file:
+                self.durations[name] = wav_file.getnframes() / float(wav_file.getframerate())
+        except (wave.Error, EOFError, OSError):
+            self.durations[name] = 0.0
+
+    def now(self):
+        """Returns the current time."""
+        return time.perf_counter()
+
+    def play(self, name, when):
+        """Records a sound as starting at when (or now if when has passed).
+
+        Parameters:
+        name -- The name of the sound.
+        when -- The start time on the now() clock.
+        """
+        onset = max(when, self.now())
+        self.onsets[name] = onset
+        self.played.append((name, when, onset))
+        if self.sink is not None:
+            with open(self.sink, 'a') as sink_file:
+                sink_file.write('%s\t%.6f\t%.6f\t%.6f\n' % (
+                    name, when, onset, self.durations.get(name, 0.0)))
+
+    def onset(self, name):
+        """Returns the time the sound last started, or None if it was never played."""
+        return self.onsets.get(name)
+
+
+def default_backend():
+    """Returns a PTBBackend if psychopy.sound is using psychtoolbox, otherwise a SoundBackend (and
+    prints a warning that sounds will not be aligned to flips).
+
+    Call it after initAudio(), which chooses the library.
+    """
+    import psychopy.sound
+    audio_lib = getattr(psychopy.sound, 'audioLib', None)
+    if ptb is not None and audio_lib == 'ptb':
+        return PTBBackend()
+    print('Warning: psychopy.sound is using %s, not ptb; feedback sounds will play right away, '
+          'not at the next flip, and their onset latencies will not be measured' % audio_lib)
+    return SoundBackend()
+
+
+class FeedbackAudio:
+    """Preloads feedback sounds and plays them at the next flip of a window, recording the onset
+    latency of every sound.
+
+    Parameters:
+    backend -- A PTBBackend, SoundBackend or NullBackend. Defaults to default_backend(), so
+        psychopy.sound must have been set up (initAudio) first.
+    window -- The psychopy window whose flips sounds are aligned to. If None, sounds are played
+        right away.
+
+    Methods:
+    load -- preloads a sound file.
+    load_folder -- preloads every sound file in a folder.
+    measure -- records the onset latency of every played sound that has started.
+    next_flip_time -- returns the time of the next flip on the audio clock.
+    play -- plays a sound at the next flip (or at a given time).
+    save_summary -- writes summary() to a json file.
+    summary -- returns statistics of the onset latencies.
+    """
+
+    def __init__(self, backend=None, window=None):
+        if backend is None:
+            backend = default_backend()
+        self.backend = backend
+        self.window = window
+        self.pending = []
+        self.latencies = []
+
+    def load(self, name, filename):
+        """Preloads a sound file.
+
+        Parameters:
+        name -- The name to play the sound by.
+        filename -- The sound file.
+        """
+        self.backend.load(name, filename)
+
+    def load_folder(self, folder, extension='.wav'):
+        """Preloads every file in folder with the extension, named by the file name without it.
+
+        Parameters:
+        folder -- The folder with the sound files.
+        extension -- The extension of the sound files.
+        """
+        for filename in sorted(os.listdir(folder)):
+            name, file_extension = os.path.splitext(filename)
+            if file_extension.lower() == extension:
+                self.load(name, os.path.join(folder, filename))
+
+    def next_flip_time(self):
+        """Returns when the next flip of window will happen on the audio clock (now if there is no
+        window or its refresh rate is unknown)."""
+        now = self.backend.now()
+        if self.window is None:
+            return now
+        try:
+            return now + max(0.0, self.window.getFutureFlipTime(clock='now'))
+        except (AttributeError, TypeError, ValueError):
+            return now
+
+    def play(self, name, when=None, delay=0):
+        """Schedules a preloaded sound and returns its scheduled start on the audio clock.
+
+        Call it just before the flip the sound belongs to.
+
+        Parameters:
+        name -- The name of the sound.
+        when -- The start time on the audio clock. Defaults to the next flip.
+        delay -- Seconds to add to the start time.
+        """
+        if when is None:
+            when = self.next_flip_time()
+        when += delay
+        self.backend.play(name, when)
+        self.pending.append((name, when))
+        return when
+
+    def measure(self):
+        """Records the onset latency of every played sound that has started since the last call.
+
+        Call it after the sound has had time to start, e.g. after the post feedback wait.
+        """
+        waiting = []
+        for name, when in self.pending:
+            onset = self.backend.onset(name)
+            if onset is None or onset < when - onset_tolerance:
+                waiting.append((name, when))
+            else:
+                self.latencies.append(onset - when)
+        self.pending = waiting
+
+    def summary(self):
+        """Returns a dict with the number of sounds measured and their onset latencies in ms."""
+        self.measure()
+        latencies_ms = np.array(self.latencies) * 1000
+        summary = {'sounds': len(self.latencies), 'unmeasured': len(self.pending)}
+        if len(latencies_ms):
+            summary.update({
+                'mean_latency_ms': float(latencies_ms.mean()),
+                'max_latency_ms': float(np.abs(latencies_ms).max()),
+                'sd_latency_ms': float(latencies_ms.std()),
+            })
+        return summary
+
+    def save_summary(self, filename):
+        """Writes summary() to a json file.
+
+        Parameters:
+        filename -- The name of the json file.
+        """
+        with open(filename, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
@@ -15,34 +15,52 @@ from psychopy import prefs
 # 	prefs.general['audioDriver']=[u'ASIO']
 # except:
 # 	print('could not load pyo')
-import psychtoolbox as ptb
-
-prefs.hardware['audioLib'] = ['ptb', 'pyo']
-
-from psychopy import sound, core, visual
-
-
-if prefs.hardware['audioLib'][0] == 'pyo':
-	print('initializing pyo to 48000')
-	sound.init(48000,buffer=128)
-
-print('Using %s(with %s) for sounds' %(sound.audioLib, sound.audioDriver))
-
-
 from psychopy import core, logging, event, visual, data, gui, misc
-import glob, os, random, sys, gc, time, hashlib, subprocess
+from psychopy.hardware import keyboard
+import glob, os, random, sys, gc, time, hashlib, subprocess, threading, atexit, struct, ast, csv, io, mmap
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from trialblock import TrialRecord
+from textfiles import writeToFile, syncFile  # kept psychopy-free for generateTrials
 from math import *
 
-try:
-	import pygame
-	from pygame.locals import *
-except ImportError:
-	print("Warning: pygame not found; will be using pyglet for stim presentation")
+# pygame (only used for gamepads and the old image loaders) and psychopy.sound (which opens the audio device,
+# see initAudio) are imported when first needed, so importing this module has no side effects and stays fast
 # pygame.mixer.pre_init(44100,-16,1, 4096) # pre-initialize to reduce the delay
 try:
-	from scipy import ndimage
+	import PIL.Image
 except ImportError:
-	pass
+	PIL = None
+	print("Warning: PIL not found; images will be decoded by psychopy when first drawn")
+
+
+sound = None  # psychopy.sound, once initAudio() has been called
+
+
+def initAudio(audioLib=('ptb', 'pyo')):
+	"""Chooses the audio library and imports psychopy.sound, which opens the audio device. Call it before loading or
+	playing sounds (loadFiles calls it for sound files); later calls return the same psychopy.sound module"""
+	global sound
+	if sound is None:
+		prefs.hardware['audioLib'] = list(audioLib)
+		from psychopy import sound as psychopySound
+		if prefs.hardware['audioLib'][0] == 'pyo':
+			print('initializing pyo to 48000')
+			psychopySound.init(48000,buffer=128)
+		print('Using %s(with %s) for sounds' %(psychopySound.audioLib, psychopySound.audioDriver))
+		sound = psychopySound
+	return sound
+
+
+def strToBool(value):
+	"""Converts a yes/no string such as 'True' or 'False' from the run time dialog to a bool (like distutils' strtobool,
+	which is gone from Python 3.12)"""
+	value = str(value).strip().lower()
+	if value in ('y', 'yes', 't', 'true', 'on', '1'):
+		return True
+	if value in ('n', 'no', 'f', 'false', 'off', '0'):
+		return False
+	raise ValueError('invalid truth value %r' % (value,))
 
 
 def killDropbox():
@@ -143,6 +161,14 @@ def popupError(text):
 	errorDlg.show()
 
 
+def popupConfirm(text):
+	"""Shows text with OK and Cancel buttons; returns True if OK was pressed"""
+	confirmDlg = gui.Dlg(title="Confirm", pos=(200, 400))
+	confirmDlg.addText(text)
+	confirmDlg.show()
+	return confirmDlg.OK
+
+
 def setupSubjectVariables():
 	parser = OptionParser()
 	parser.add_option("-s", "--subject-id", dest="subjid", help="specify the subject id")
@@ -170,20 +196,128 @@ def writeHeader(curTrial, headerText, fileName='header'):
 		return False
 
 
-def writeToFile(fileHandle, trial, sync=True):
-	"""Writes a trial (array of lists) to a fileHandle"""
-	line = '\t'.join([str(i) for i in trial])  # TABify
-	line += '\n'  # add a newline
-	fileHandle.write(line)
-	if sync:
-		fileHandle.flush()
-		os.fsync(fileHandle)
-
-
-def syncFile(fileHandle):
-	"""syncs file to prevent buffer loss"""
-	fileHandle.flush()
-	os.fsync(fileHandle)
+class TrialLogger:
+	"""Takes trial rows on a queue and writes them to fileHandle in groups from a background thread,
+	so no flush/fsync happens between a response and the next fixation.
+
+	Pending rows are committed (written, flushed and fsync'd) when
+	- everyNRows rows are pending (0 to disable)
+	- everyMs milliseconds have passed since the oldest pending row (0 to disable)
+	- idle() is called during an idle window such as the ITI, a break or feedback (if commitOnIdle)
+	- endBlock(), flush() or close() is called. These wait until the rows are on disk.
+	close() is registered with atexit so pending rows are still written if the experiment exits or crashes.
+	If writing fails (e.g. the disk is full), the background thread stops and the error is raised from the next
+	write(), endBlock(), flush() or close(), so rows are never dropped silently."""
+
+	def __init__(self, fileHandle, everyNRows=0, everyMs=0, commitOnIdle=True):
+		self.fileHandle = fileHandle
+		self.everyNRows = everyNRows
+		self.everyMs = everyMs
+		self.commitOnIdle = commitOnIdle
+		self.pending = []
+		self.pendingSince = None
+		self.commitRequested = False
+		self.closed = False
+		self.rowsQueued = 0
+		self.rowsCommitted = 0
+		self.error = None  # the exception that stopped the commit thread
+		self.condition = threading.Condition()
+		self.thread = threading.Thread(target=self._commitLoop, name='TrialLogger', daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def write(self, trial):
+		"""Queues a trial (array of lists); same format as writeToFile"""
+		line = '\t'.join([str(i) for i in trial]) + '\n'
+		with self.condition:
+			if self.closed:
+				raise ValueError('TrialLogger is closed')
+			self._raiseError()
+			if not self.pending:
+				self.pendingSince = time.time()
+				if self.everyMs:
+					self.condition.notify_all()  # start the timer in the commit thread
+			self.pending.append(line)
+			self.rowsQueued += 1
+			if self.everyNRows and len(self.pending) >= self.everyNRows:
+				self.commitRequested = True
+				self.condition.notify_all()
+
+	def idle(self):
+		"""Call at the start of an idle window; commits pending rows in the background"""
+		if self.commitOnIdle:
+			self._requestCommit(wait=False)
+
+	def endBlock(self):
+		self._requestCommit(wait=True)
+
+	def flush(self):
+		self._requestCommit(wait=True)
+
+	def close(self):
+		with self.condition:
+			if self.closed:
+				return
+			self.closed = True
+			self.condition.notify_all()
+		self.thread.join()
+		atexit.unregister(self.close)
+		with self.condition:
+			self._raiseError()
+
+	def _raiseError(self):
+		"""Raises the error that stopped the commit thread, or a RuntimeError if it stopped with rows not written;
+		call with the condition held"""
+		if self.error is not None:
+			raise self.error
+		if not self.thread.is_alive() and self.rowsCommitted < self.rowsQueued:
+			raise RuntimeError('TrialLogger stopped with %d rows not written' % (self.rowsQueued - self.rowsCommitted))
+
+	def _requestCommit(self, wait):
+		with self.condition:
+			self._raiseError()
+			self.commitRequested = True
+			self.condition.notify_all()
+			if wait:
+				target = self.rowsQueued
+				while self.rowsCommitted < target and self.thread.is_alive():
+					self.condition.wait(.05)
+				if self.rowsCommitted < target:
+					self._raiseError()
+
+	def _commitDue(self):
+		if self.closed or self.commitRequested:
+			return True
+		return bool(self.everyMs and self.pendingSince is not None and (time.time() - self.pendingSince) * 1000 >= self.everyMs)
+
+	def _timeUntilDue(self):
+		if self.everyMs and self.pendingSince is not None:
+			return max(0, self.everyMs / 1000.0 - (time.time() - self.pendingSince))
+		return None
+
+	def _commitLoop(self):
+		while True:
+			with self.condition:
+				while not self._commitDue():
+					self.condition.wait(self._timeUntilDue())
+				(lines, self.pending) = (self.pending, [])
+				self.pendingSince = None
+				self.commitRequested = False
+				closed = self.closed
+			if lines:
+				try:
+					self.fileHandle.write(''.join(lines))
+					syncFile(self.fileHandle)
+				except Exception as error:
+					with self.condition:
+						self.error = error
+						self.condition.notify_all()
+					return
+			with self.condition:
+				self.rowsCommitted += len(lines)
+				self.condition.notify_all()
+			if closed:
+				return
 
 
 def getSubjVariables(allSubjVariables):
@@ -208,8 +342,250 @@ def getSubjVariables(allSubjVariables):
 	return subjVariables
 
 
-def loadFiles(directory, extension, fileType, win='', whichFiles='*', stimList=[]):
-	""" Load all the pics and sounds"""
+class StimRecord(namedtuple('StimRecord', ['stim', 'fileName', 'num', 'width', 'height', 'name'])):
+	"""An image loaded by loadFiles. Works like the old (stim, fileName, num, width, height, name) tuple
+	and can also be indexed by field name, e.g. pics['L']['stim']"""
+	__slots__ = ()
+
+	def __getitem__(self, key):
+		if isinstance(key, str):
+			return getattr(self, key)
+		return tuple.__getitem__(self, key)
+
+
+class LazyStim(object):
+	"""Stands in for a psychopy stimulus and creates it with factory() the first time it is used.
+	Stimuli touch OpenGL/audio, so they must be first used on the main thread.
+	Indexing with ['stim'] returns the stimulus itself so sounds can be used like StimRecords."""
+	__slots__ = ('_factory', '_stim')
+
+	def __init__(self, factory):
+		object.__setattr__(self, '_factory', factory)
+		object.__setattr__(self, '_stim', None)
+
+	def get(self):
+		"""Returns the stimulus, creating it if needed"""
+		if self._stim is None:
+			object.__setattr__(self, '_stim', self._factory())
+			object.__setattr__(self, '_factory', None)
+		return self._stim
+
+	def __getattr__(self, name):
+		return getattr(self.get(), name)
+
+	def __setattr__(self, name, value):
+		setattr(self.get(), name, value)
+
+	def __getitem__(self, key):
+		if key == 'stim':
+			return self.get()
+		raise KeyError(key)
+
+
+def imageSize(fileName):
+	"""Returns (width, height) of a PNG, GIF or JPEG read from its header without decoding the image, or ('', '') if unknown"""
+	with open(fileName, 'rb') as f:
+		head = f.read(26)
+		if head[:8] == b'\x89PNG\r\n\x1a\n':
+			return struct.unpack('>II', head[16:24])
+		if head[:6] in (b'GIF87a', b'GIF89a'):
+			return struct.unpack('<HH', head[6:10])
+		if head[:2] == b'\xff\xd8':  # JPEG: walk the markers until the start of frame
+			f.seek(2)
+			while True:
+				marker = f.read(2)
+				if len(marker) < 2 or marker[0] != 0xFF:
+					break
+				if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:  # markers without a length
+					continue
+				length = struct.unpack('>H', f.read(2))[0]
+				if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+					height, width = struct.unpack('>xHH', f.read(5))
+					return width, height
+				f.seek(length - 2, 1)
+	return '', ''
+
+
+_decodePool = None
+
+
+def _getDecodePool():
+	global _decodePool
+	if _decodePool is None:
+		_decodePool = ThreadPoolExecutor(thread_name_prefix='decodeImage')
+	return _decodePool
+
+
+_imageHashes = {}  # (path, mtime_ns, size) -> SHA-1 of the file's contents
+
+
+def _imageHash(fileName, cacheDir):
+	"""Returns the SHA-1 of an image file, only reading the whole file when its mtime or size changed.
+	The hash is remembered in memory and in a small .sha1 stamp file in cacheDir, so later runs skip it too."""
+	path = os.path.abspath(fileName)
+	stat = os.stat(path)
+	key = (path, stat.st_mtime_ns, stat.st_size)
+	if key in _imageHashes:
+		return _imageHashes[key]
+	stampFile = os.path.join(cacheDir, hashlib.sha1(path.encode()).hexdigest() + '.sha1')
+	try:
+		with open(stampFile) as f:
+			mtime, size, fileHash = f.read().split()
+		if (int(mtime), int(size)) != key[1:]:
+			fileHash = None
+	except (IOError, ValueError):
+		fileHash = None
+	if fileHash is None:
+		digest = hashlib.sha1()
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				digest.update(block)
+		fileHash = digest.hexdigest()
+		try:
+			os.makedirs(cacheDir, exist_ok=True)
+			tmpFile = stampFile + '.%d.tmp' % threading.get_ident()
+			with open(tmpFile, 'w') as f:
+				f.write('%d %d %s' % (key[1], key[2], fileHash))
+			os.replace(tmpFile, stampFile)
+		except OSError:
+			pass  # the cache is only an optimization
+	_imageHashes[key] = fileHash
+	return fileHash
+
+
+def decodeImage(fileName, cacheDir=None):
+	"""Returns the image as an RGBA uint8 array (row 0 at the top).
+	If cacheDir is given, decoded arrays are kept there as .npy files keyed by the file's hash,
+	so an image is only decoded again after it changes. The file is only hashed when its mtime or size changed."""
+	cacheFile = None
+	if cacheDir:
+		cacheFile = os.path.join(cacheDir, _imageHash(fileName, cacheDir) + '.npy')
+		try:
+			return numpy.load(cacheFile)
+		except (IOError, ValueError):
+			pass
+	with PIL.Image.open(fileName) as image:
+		rgba = numpy.asarray(image.convert('RGBA'))
+	if cacheFile:
+		try:
+			os.makedirs(cacheDir, exist_ok=True)
+			tmpFile = cacheFile + '.%d.tmp' % threading.get_ident()
+			with open(tmpFile, 'wb') as f:
+				numpy.save(f, rgba)
+			os.replace(tmpFile, cacheFile)  # never leaves a half written cache file
+		except OSError:
+			pass  # the cache is only an optimization
+	return rgba
+
+
+def _imageStimFactory(win, fullPath, decoded):
+	def makeStim():
+		if decoded is None:
+			return visual.ImageStim(win, image=fullPath, mask=None, interpolate=True)
+		return visual.ImageStim(win, image=PIL.Image.fromarray(decoded.result(), 'RGBA'), mask=None, interpolate=True)
+	return makeStim
+
+
+# name@variant transforms of decoded RGBA arrays (row 0 at the top); rotations are clockwise like psychopy's ori
+variantTransforms = {
+	'flipX': numpy.fliplr,
+	'flipY': numpy.flipud,
+	'rot90': lambda rgba: numpy.rot90(rgba, -1),
+	'rot180': lambda rgba: numpy.rot90(rgba, 2),
+	'rot270': lambda rgba: numpy.rot90(rgba, 1),
+}
+# the same variants as (flipHoriz, flipVert, ori) for stims that can transform their texture when drawn (atlas stims)
+variantDrawTransforms = {
+	'flipX': (True, False, 0),
+	'flipY': (False, True, 0),
+	'rot90': (False, False, 90),
+	'rot180': (False, False, 180),
+	'rot270': (False, False, 270),
+}
+
+
+class StimMatrix(dict):
+	"""The dict loadFiles returns. Besides the loaded names it also serves variants: looking up 'name@variant'
+	(variant from variantTransforms, e.g. pics['L@flipY'] or chained pics['L@flipX@rot90']) derives the variant
+	from name's image the first time and then caches it like a loaded file, so a new condition needs no new image file.
+	Image variants are built from a transformed copy of the decoded base array; atlas variants draw the base
+	rectangle flipped/rotated. Note that 'in' and get() only see variants that were already looked up."""
+
+	def __init__(self, win=None):
+		dict.__init__(self)
+		self.win = win
+		self.decoded = {}  # name -> future (or finished array) of the decoded RGBA image
+		self.atlas = None
+
+	def __missing__(self, key):
+		base, sep, variant = key.rpartition('@')
+		if not sep or variant not in variantTransforms:
+			raise KeyError(key)
+		record = self[base]  # recursive for chained variants
+		if not isinstance(record, StimRecord):
+			raise KeyError('%s: only images have variants' % key)
+		width, height = record.width, record.height
+		if variant in ('rot90', 'rot270'):
+			width, height = height, width
+		if self.atlas is not None:
+			import stimatlas
+			baseName, flipHoriz, flipVert, ori = self._drawTransform(key)
+			stim = LazyStim(lambda: stimatlas.AtlasStim(self.win, self.atlas, baseName, flipHoriz=flipHoriz, flipVert=flipVert, base_ori=ori))
+		else:
+			stim = LazyStim(lambda: visual.ImageStim(self.win, image=self.image(key), mask=None, interpolate=True))
+		self[key] = StimRecord(stim, record.fileName, record.num, width, height, key)
+		return self[key]
+
+	def _drawTransform(self, key):
+		"""Returns (base name, flipHoriz, flipVert, ori) that draw key from its base image"""
+		names = key.split('@')
+		flipHoriz, flipVert, ori = False, False, 0
+		for variant in names[1:]:
+			variantFlipHoriz, variantFlipVert, variantOri = variantDrawTransforms[variant]
+			if variantFlipHoriz or variantFlipVert:
+				# flipping a rotated image is the same as flipping first and rotating the other way
+				flipHoriz ^= variantFlipHoriz
+				flipVert ^= variantFlipVert
+				ori = -ori % 360
+			ori = (ori + variantOri) % 360
+		return names[0], flipHoriz, flipVert, ori
+
+	def size(self, key):
+		"""Returns [width, height] of a loaded image or a variant without creating the variant; nothing is stored,
+		so it can be called from a background thread (e.g. by a TrialStream prepare function)"""
+		base, sep, variant = key.rpartition('@')
+		if not sep or dict.__contains__(self, key):
+			return [self[key]['width'], self[key]['height']]
+		if variant not in variantTransforms:
+			raise KeyError(key)
+		width, height = self.size(base)
+		return [height, width] if variant in ('rot90', 'rot270') else [width, height]
+
+	def array(self, key):
+		"""Returns the decoded RGBA array (row 0 at the top) of a loaded image or a variant"""
+		if key not in self.decoded:
+			base, sep, variant = key.rpartition('@')
+			if not sep or variant not in variantTransforms:
+				raise KeyError('%s has no decoded image' % key)
+			self.decoded[key] = numpy.ascontiguousarray(variantTransforms[variant](self.array(base)))
+		decoded = self.decoded[key]
+		if not isinstance(decoded, numpy.ndarray):
+			decoded = self.decoded[key] = decoded.result()
+		return decoded
+
+	def image(self, key):
+		"""Returns a PIL image of a loaded image or a variant (e.g. to use as a texture)"""
+		return PIL.Image.fromarray(self.array(key), 'RGBA')
+
+
+def loadFiles(directory, extension, fileType, win='', whichFiles='*', stimList=[], lazy=True, cacheDir='.stimcache'):
+	""" Load all the pics and sounds
+	Image dimensions come from the file headers, images are decoded in a thread pool (and cached in cacheDir; None to disable),
+	and the ImageStims and Sounds are only created when first used (all at the end if lazy is False).
+	Images are StimRecords, i.e. (stim, fileName, num, width, height, name) that can also be indexed as pics[name]['stim']
+	fileType 'atlas' packs the images into one texture atlas (see stimatlas.py, rebuilt in cacheDir when an image changes)
+	and returns StimRecords whose stims are AtlasStims drawing from it
+	Variants of images such as pics['L@flipY'] are derived on first lookup (see StimMatrix)"""
 	path = os.getcwd()  # set path to current directory
 	if isinstance(extension, list):
 		fileList = []
@@ -217,27 +593,52 @@ def loadFiles(directory, extension, fileType, win='', whichFiles='*', stimList=[
 			fileList.extend(glob.glob(os.path.join(path, directory, whichFiles + curExtension)))
 	else:
 		fileList = glob.glob(os.path.join(path, directory, whichFiles + extension))
-	fileMatrix = {}  # initialize fileMatrix  as a dict because it'll be accessed by picture names, cound names, whatver
+	if cacheDir:
+		cacheDir = os.path.join(path, cacheDir)
+	if fileType == "atlas":
+		import stimatlas
+		extensions = extension if isinstance(extension, list) else [extension]
+		atlasFile = os.path.join(cacheDir or path, os.path.basename(os.path.normpath(directory)) + '_atlas.png')
+		if stimatlas.atlas_is_stale(os.path.join(path, directory), atlasFile, extensions):
+			atlas = stimatlas.build_atlas(os.path.join(path, directory), atlasFile, extensions)
+		else:
+			atlas = stimatlas.load_atlas(atlasFile)
+	fileMatrix = StimMatrix(win)  # a dict accessed by picture names, sound names, whatever (and name@variant for images)
+	if fileType == "atlas":
+		fileMatrix.atlas = atlas
 	for num, curFile in enumerate(fileList):
 		fullPath = curFile
 		fullFileName = os.path.basename(fullPath)
 		stimFile = os.path.splitext(fullFileName)[0]
 		if fileType == "image":
 			try:
-				surface = pygame.image.load(fullPath)  # gets height/width of the image
-				stim = visual.ImageStim(win, image=fullPath, mask=None, interpolate=True)
-				fileMatrix[stimFile] = ((stim, fullFileName, num, surface.get_width(), surface.get_height(), stimFile))
-			except:  # no pygame, so don't store the image dims
-				stim = visual.ImageStim(win, image=fullPath, mask=None, interpolate=True)
-				fileMatrix[stimFile] = ((stim, fullFileName, num, '', '', stimFile))
+				width, height = imageSize(fullPath)
+			except (IOError, struct.error):
+				width, height = '', ''
+			decoded = _getDecodePool().submit(decodeImage, fullPath, cacheDir) if PIL is not None else None
+			if decoded is not None:
+				fileMatrix.decoded[stimFile] = decoded
+			stim = LazyStim(_imageStimFactory(win, fullPath, decoded))
+			fileMatrix[stimFile] = StimRecord(stim, fullFileName, num, width, height, stimFile)
+		elif fileType == "atlas":
+			width, height = atlas.pixel_sizes[atlas.lookup(stimFile)].astype(int).tolist()
+			stim = LazyStim(lambda stimFile=stimFile: stimatlas.AtlasStim(win, atlas, stimFile))
+			fileMatrix[stimFile] = StimRecord(stim, fullFileName, num, width, height, stimFile)
 		elif fileType == "sound":
-			soundRef = sound.Sound(fullPath)
+			soundRef = LazyStim(lambda fullPath=fullPath: initAudio().Sound(fullPath))
 			fileMatrix[stimFile] = ((soundRef))
 		elif fileType == "winSound":
 			soundRef = open(fullPath, "rb").read()
 			fileMatrix[stimFile] = ((soundRef))
 			fileMatrix[stimFile + '-path'] = fullPath  # this allows asynchronous playing in winSound.
 
+	if not lazy:
+		for curStim in fileMatrix.values():
+			if isinstance(curStim, StimRecord):
+				curStim.stim.get()
+			elif isinstance(curStim, LazyStim):
+				curStim.get()
+
 	# check
 	if stimList and set(fileMatrix.keys()).intersection(stimList) != set(stimList):
 		popupError(str(set(stimList).difference(fileMatrix.keys())) + " does not exist in " + path + '\\' + directory)
@@ -260,6 +661,7 @@ def loadFilesMovie(directory, extension, fileType, win='', whichFiles='*', stimL
 		stimFile = os.path.splitext(fullFileName)[0]
 		if fileType == "image":
 			try:
+				import pygame
 				surface = pygame.image.load(fullPath)  # gets height/width of the image
 				stim = visual.ImageStim(win, image=fullPath, mask=None, interpolate=True)
 				fileMatrix[stimFile] = ((stim, fullFileName, num, surface.get_width(), surface.get_height(), stimFile))
@@ -267,7 +669,7 @@ def loadFilesMovie(directory, extension, fileType, win='', whichFiles='*', stimL
 				stim = visual.ImageStim(win, image=fullPath, mask=None, interpolate=True)
 				fileMatrix[stimFile] = ((stim, fullFileName, num, '', '', stimFile))
 		elif fileType == "sound":
-			soundRef = sound.Sound(fullPath)
+			soundRef = initAudio().Sound(fullPath)
 			fileMatrix[stimFile] = ((soundRef))
 		elif fileType == "winSound":
 			soundRef = open(fullPath, "rb").read()
@@ -299,6 +701,7 @@ def loadFilesOld(directory, extension, fileType, win='', whichFiles='*', stimLis
 		stimFile = fullFileName[:len(fullFileName) - 4]  # chops off the extension
 		if fileType == "image":
 			try:
+				import pygame
 				surface = pygame.image.load(fullPath)  # this is just to get heigh/width of the image
 				# stim = visual.PatchStim(win, tex=fullPath)
 				stim = visual.SimpleImageStim(win, image=fullPath)
@@ -308,7 +711,7 @@ def loadFilesOld(directory, extension, fileType, win='', whichFiles='*', stimLis
 				fileMatrix[stimFile] = ((stim, fullFileName, i, '', '', stimFile))
 
 		elif fileType == "sound":
-			soundRef = sound.Sound(fullPath)
+			soundRef = initAudio().Sound(fullPath)
 			fileMatrix[stimFile] = ((soundRef))
 		elif fileType == "winSound":
 			soundRef = highPitch = open(fullPath, "rb").read()
@@ -363,14 +766,191 @@ def createRespNew(allSubjVariables, subjVariables, fieldVarNames, fieldVars, **r
 	return [header, trial]
 
 
+def importColumnarTrials(fileName):
+	"""Reads a columnar trial file (.npz or .arrow, see columnar.py) into a list of trial dicts and the field names.
+	Values come back as the same Python types the text importer gives (lists for list columns, 'NA' for a negative targetLocation,
+	and text columns parsed cell by cell like _parseCell, so e.g. a seed stored as '20' is 20)"""
+	import columnar
+	table = columnar.read_table(fileName)
+	columns = dict((name, table[name].tolist()) for name in table.names)
+	for name in table.names:
+		if getattr(table[name], 'dtype', None) is not None and table[name].dtype.kind == 'U':
+			columns[name] = [_parseCell(value) for value in columns[name]]
+	if 'targetLocation' in columns:
+		columns['targetLocation'] = ['NA' if value < 0 else value for value in columns['targetLocation']]
+	stimList = [dict(zip(table.names, values)) for values in zip(*[columns[name] for name in table.names])]
+	return (stimList, table.names)
+
+
 def importTrials(fileName, method="sequential", seed=random.randint(1, 100)):
-	(stimList, fieldNames) = data.importConditions(fileName, returnFieldNames=True)
+	"""Reads a trial file: tab/comma separated text or xlsx (via psychopy), or a columnar .npz/.arrow file"""
+	if os.path.splitext(fileName)[1].lower() in ('.npz', '.arrow'):
+		(stimList, fieldNames) = importColumnarTrials(fileName)
+	else:
+		(stimList, fieldNames) = data.importConditions(fileName, returnFieldNames=True)
 	trials = data.TrialHandler(stimList, 1, method=method,
 							   seed=seed)  # seed is ignored for sequential; used for 'random'
 	return (trials, fieldNames)
 
 
+def _parseCell(value):
+	"""Converts a cell of a text trial file like psychopy's importConditions: numbers to int/float, [..] to lists"""
+	try:
+		return int(value)
+	except ValueError:
+		pass
+	try:
+		return float(value)
+	except ValueError:
+		pass
+	if value[:1] in ('[', '('):
+		try:
+			return ast.literal_eval(value)
+		except (ValueError, SyntaxError):
+			pass
+	return value
+
+
+def _textDelimiter(fileName):
+	"""Returns the delimiter of a text trial file: tab if the header line has one (trial files are tab-separated whatever their extension), otherwise comma"""
+	with open(fileName, newline='') as trialFile:
+		return '\t' if '\t' in trialFile.readline() else ','
+
+
+def _skipLines(fileName, numLines):
+	"""Returns the byte offset just past the first numLines lines of a file. The file is memory-mapped and only
+	scanned for newlines, so nothing before the offset is decoded or parsed"""
+	with open(fileName, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return 0
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			offset = 0
+			for _ in range(numLines):
+				newline = mm.find(b'\n', offset)
+				if newline == -1:
+					return len(mm)
+				offset = newline + 1
+			return offset
+
+
+def readLastLine(fileName, blockSize=4096):
+	"""Returns (line, end): the last complete line of a text file without its newline, and the byte offset just past it.
+	The file is read backwards from the end in blocks, so only its tail is read however long it is. A last line cut off
+	by a crash (no newline) is skipped; end is where it starts. Returns (None, 0) if there is no complete line"""
+	with open(fileName, 'rb') as f:
+		pos = f.seek(0, os.SEEK_END)
+		tail = b''
+		while pos > 0:
+			readSize = min(blockSize, pos)
+			pos -= readSize
+			f.seek(pos)
+			tail = f.read(readSize) + tail
+			lastNewline = tail.rfind(b'\n')
+			if lastNewline == -1:
+				continue
+			prevNewline = tail.rfind(b'\n', 0, lastNewline)
+			if prevNewline != -1 or pos == 0:
+				return tail[prevNewline + 1:lastNewline].decode('utf-8'), pos + lastNewline + 1
+	return None, 0
+
+
+def readTrialFieldNames(fileName):
+	"""Returns the field names of a trial file (text or columnar)"""
+	if os.path.splitext(fileName)[1].lower() in ('.npz', '.arrow'):
+		import columnar
+		return columnar.read_table(fileName).names
+	with open(fileName, newline='') as trialFile:
+		return next(csv.reader(trialFile, delimiter=_textDelimiter(fileName)), [])
+
+
+def _readTrialRows(fileName, start=0):
+	"""Yields the trials of a trial file (text or columnar) one row at a time, starting at trial start.
+	Each trial is a TrialRecord (used like a dict): its values in a list, with one field index shared by every row"""
+	fieldIndex = dict((name, i) for i, name in enumerate(readTrialFieldNames(fileName)))
+	if os.path.splitext(fileName)[1].lower() in ('.npz', '.arrow'):
+		import columnar
+		for row in columnar.read_table(fileName).rows(start):
+			values = [value.tolist() for value in row.values()]
+			trial = TrialRecord(fieldIndex, [_parseCell(value) if isinstance(value, str) else value for value in values])
+			if 'targetLocation' in trial and trial['targetLocation'] < 0:
+				trial.values[fieldIndex['targetLocation']] = 'NA'
+			yield trial
+		return
+	with open(fileName, 'rb') as rawFile:
+		rawFile.seek(_skipLines(fileName, 1 + start))  # jump over the header and the first start trials
+		for row in csv.reader(io.TextIOWrapper(rawFile, newline=''), delimiter=_textDelimiter(fileName)):
+			if row:
+				yield TrialRecord(fieldIndex, [_parseCell(value) for value in row])
+
+
+class TrialStream:
+	"""Streams the trials of a trial file (text or columnar) instead of loading them all.
+	Trials are TrialRecords (see trialblock.py), which are used like dicts.
+	A background thread stays lookAhead trials ahead of the current one: it reads them and calls prepare(trial) on
+	each, storing the result in trial['prepared'] (e.g. the positions and textures of the search array), so the work
+	for the next trials happens during the current trial's response window. prepare must not touch OpenGL.
+	Use it as an iterator; peek(k) returns the trial k ahead of the last one returned (None past the end).
+	Streaming begins at trial start; the trials before it are skipped without being parsed (e.g. to resume a session)."""
+
+	def __init__(self, fileName, prepare=None, lookAhead=2, start=0):
+		self.fileName = fileName
+		self.prepare = prepare
+		self.lookAhead = max(1, lookAhead)
+		self.fieldNames = readTrialFieldNames(fileName)
+		self.rows = _readTrialRows(fileName, start)
+		self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='TrialStream')  # one worker keeps the trials in order
+		self.buffer = deque()
+		self.exhausted = False
+		self._fill()
+
+	def _fetch(self):
+		try:
+			trial = next(self.rows)
+		except StopIteration:
+			return None
+		if self.prepare is not None:
+			trial['prepared'] = self.prepare(trial)
+		return trial
+
+	def _fill(self, size=None):
+		while not self.exhausted and len(self.buffer) < (size or self.lookAhead):
+			self.buffer.append(self.pool.submit(self._fetch))
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if not self.buffer:
+			self._fill()
+		trial = self.buffer.popleft().result() if self.buffer else None
+		if trial is None:
+			self.exhausted = True
+			self.buffer.clear()
+			self.pool.shutdown(wait=False)
+			raise StopIteration
+		self._fill()
+		return trial
+
+	def peek(self, k=1):
+		"""Returns the trial k ahead without consuming it, or None if the file ends before it"""
+		self._fill(max(k, self.lookAhead))
+		if len(self.buffer) < k:
+			return None
+		return self.buffer[k - 1].result()
+
+	@staticmethod
+	def readRange(fileName, start, stop):
+		"""Returns the trials start..stop-1 of a trial file as a list (e.g. to sample practice trials from)"""
+		trials = []
+		for num, trial in enumerate(_readTrialRows(fileName, start), start):
+			if num >= stop:
+				break
+			trials.append(trial)
+		return trials
+
+
 def initGamepad():
+	import pygame
 	pygame.joystick.init()  # init main joystick device system
 	try:
 		stick = pygame.joystick.Joystick(0)
@@ -380,46 +960,51 @@ def initGamepad():
 		raise SystemExit("---->No joystick/gamepad found. Make sure one is plugged in<--")
 
 
-def getKeyboardResponse(validResponses, duration=0):
-	event.clearEvents()
-	responded = False
-	done = False
-	rt = '*'
-	responseTimer = core.Clock()
+_keyboard = None
+
+
+def getKeyboard():
+	"""Returns the psychopy.hardware.keyboard.Keyboard shared by the response functions (created on first use)"""
+	global _keyboard
+	if _keyboard is None:
+		_keyboard = keyboard.Keyboard()
+	return _keyboard
+
+
+def waitForKeyboardResponse(validResponses, duration=0, endOnResponse=True, pollInterval=.001):
+	"""Collects the first valid key press. Returns [key, rt] or ['*', '*'] if there was no response.
+	rt is the key's own (hardware) timestamp relative to the start of the response window, so it does not
+	depend on how often we poll. Between polls the thread sleeps for pollInterval instead of spinning.
+	duration=0 waits until a response; otherwise waits at most duration secs (the whole duration if endOnResponse is False)."""
+	kb = getKeyboard()
+	validResponses = list(validResponses)
+	kb.clearEvents()
+	kb.clock.reset()
+	response = None
 	while True:
-		if not responded:
-			responded = event.getKeys(validResponses, responseTimer)
-		if duration > 0:
-			if responseTimer.getTime() > duration:
-				break
-		else:  # end on response
-			if responded:
-				break
-	if not responded:
+		if response is None:
+			keys = kb.getKeys(keyList=validResponses, waitRelease=False)
+			if keys:
+				response = [keys[0].name, keys[0].rt]  # only get the first resp
+				if endOnResponse or duration <= 0:
+					break
+		timeLeft = duration - kb.clock.getTime()
+		if duration > 0 and timeLeft <= 0:
+			break
+		time.sleep(pollInterval if duration <= 0 else min(pollInterval, timeLeft))
+	if response is None:
 		return ['*', '*']
 	else:
-		return responded[0]  # only get the first resp
+		return response
+
+
+def getKeyboardResponse(validResponses, duration=0):
+	"""Waits for a response, or for exactly duration secs if duration > 0"""
+	return waitForKeyboardResponse(validResponses, duration, endOnResponse=False)
 
 
 def getKeyboardResponseEndResp(validResponses, duration=0, endOnResponse=True):
-	event.clearEvents()
-	responded = False
-	done = False
-	rt = '*'
-	responseTimer = core.Clock()
-	while True:
-		if not responded:
-			responded = event.getKeys(validResponses, responseTimer)
-		if duration > 0:
-			if responseTimer.getTime() > duration or responded:
-				break
-		else:  # end on response
-			if responded:
-				break
-	if not responded:
-		return ['*', '*']
-	else:
-		return responded[0]  # only get the first resp
+	return waitForKeyboardResponse(validResponses, duration, endOnResponse)
 
 
 def getMouseResponse(mouse, duration=0):
@@ -447,6 +1032,7 @@ def getMouseResponse(mouse, duration=0):
 # TO DO: move stick to the last parameter so it's treated as optional - that way we can have a generic response function that either takes or doesn't take a joystick parameter as provided.
 def getGamepadResponse(stick, validResponses, duration=0):
 	"""joystick needs to be initialized (with initGamepad or manually). Only returns the first response. """
+	import pygame
 
 	def getJoystickResponses():  # returns buttons. If none are pressed, checks the hat.
 		for n in range(stick.get_numbuttons()):
@@ -484,8 +1070,9 @@ def euclidDistance(pointA, pointB):
 
 
 def pressedSomething(validKeys):
+	import pygame
 	for event in pygame.event.get():
-		if event.type in (QUIT, KEYDOWN, MOUSEBUTTONDOWN):
+		if event.type in (pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN):
 			if event.key in validKeys:
 				return True
 
@@ -0,0 +1,345 @@
+"""Reads and writes tables of typed columns (trial lists and results).
+
+In the text formats every list-valued cell (distractorLocations, Locations,
+Rotations, ...) is the str() or json of a Python list that has to be parsed
+again for every trial. Here each column is a numpy array instead. A ragged
+column (a list per row) is stored as one flat values array plus an offsets
+array with len(table) + 1 entries, so row i is values[offsets[i]:offsets[i + 1]].
+Values may be fixed-width rows, e.g. the (x, y) pairs of Locations are stored
+as an (n, 2) values array.
+
+Two file formats are supported, chosen by the extension:
+    .npz   -- an uncompressed numpy archive. Every column is memory-mapped
+              straight out of the archive, so loading copies nothing.
+    .arrow -- an Arrow IPC file (needs pyarrow), memory-mapped with pyarrow.
+              Ragged columns are list columns.
+
+Classes:
+RaggedColumn -- A list-valued column stored as values and offsets.
+Table -- The columns of a table read with read_table.
+
+Functions:
+is_columnar -- Checks if a file name has a columnar extension.
+read_table -- Reads a columnar file.
+typed_column -- Converts a list of values that may contain None to a typed numpy array.
+write_table -- Writes columns to a columnar file.
+"""
+
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+columnar_extensions = ['.npz', '.arrow']
+
+
+def is_columnar(filename):
+    """Returns True if filename has one of the columnar extensions (.npz or .arrow).
+
+    Parameters:
+    filename -- The name of the file.
+    """
+    return os.path.splitext(filename)[1].lower() in columnar_extensions
+
+
+class RaggedColumn:
+    """A column with a variable-length array per row.
+
+    Indexing a row returns a view into values; nothing is copied.
+
+    Parameters:
+    values -- The values of all rows one after another (1d, or 2d for fixed-width values).
+    offsets -- An int array with len(column) + 1 entries; row i is values[offsets[i]:offsets[i+1]].
+
+    Methods:
+    lengths -- returns the length of every row.
+    tolist -- returns every row as a list.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, dtype=None):
+        """Builds a RaggedColumn from a list of lists (or arrays).
+
+        Parameters:
+        rows -- The list of rows.
+        dtype -- The dtype of the values (default is inferred).
+        """
+        lengths = [len(row) for row in rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        parts = [np.asarray(row, dtype=dtype) for row in rows if len(row)]
+        if parts:
+            values = np.concatenate(parts)
+        else:
+            values = np.zeros(0, dtype=dtype if dtype is not None else float)
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """Returns an array with the length of every row."""
+        return np.diff(self.offsets)
+
+    def tolist(self):
+        """Returns every row as a list of Python values."""
+        return [row.tolist() for row in self]
+
+
+def typed_column(values, missing='NA'):
+    """Returns a list of values as a typed numpy array.
+
+    Numbers (with None for missing values) become an int array, or a float array with nan for
+    the missing values. Anything else becomes a string array with missing for None.
+
+    Parameters:
+    values -- A list of values.
+    missing -- The string used for None in string columns.
+    """
+    present = [value for value in values if value is not None]
+    numeric = all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+                  for value in present)
+    if present and numeric:
+        if len(present) == len(values) and all(isinstance(value, (int, np.integer))
+                                               for value in present):
+            return np.asarray(values, dtype=np.int64)
+        return np.asarray([np.nan if value is None else value for value in values], dtype=float)
+    return np.asarray([missing if value is None else str(value) for value in values], dtype=str)
+
+
+def _is_ragged(column):
+    if isinstance(column, RaggedColumn):
+        return True
+    if isinstance(column, np.ndarray):
+        return column.dtype == object
+    return any(isinstance(value, (list, tuple, np.ndarray)) for value in column)
+
+
+def _as_column(column):
+    """Returns a RaggedColumn or a numpy array that can be stored without pickling."""
+    if isinstance(column, RaggedColumn):
+        return column
+    if _is_ragged(column):
+        return RaggedColumn.from_lists(list(column))
+    column = np.asarray(column)
+    if column.dtype == object:
+        column = column.astype(str)
+    return column
+
+
+class Table:
+    """The columns of a table. Columns are numpy arrays or RaggedColumns.
+
+    Parameters:
+    columns -- A dict of column name to column, in column order.
+
+    Methods:
+    rows -- iterates over the rows as dicts.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = list(columns)
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def rows(self, start=0):
+        """Iterates over the rows as dicts of column name to value (ragged values are views).
+
+        Parameters:
+        start -- The index of the first row.
+        """
+        for i in range(start, len(self)):
+            yield {name: column[i] for name, column in self.columns.items()}
+
+
+def write_table(filename, columns):
+    """Writes columns to filename (.npz or .arrow).
+
+    A column whose values are lists (or arrays) is written as a ragged column. Any other column
+    is written as a typed numpy array; object columns are converted to strings. The file is
+    written to a temporary name first, so a crash never leaves a half written table.
+
+    Parameters:
+    filename -- The name of the file. The extension chooses the format.
+    columns -- A dict of column name to a list, numpy array or RaggedColumn, in column order.
+    """
+    columns = {name: _as_column(column) for name, column in columns.items()}
+    lengths = set(len(column) for column in columns.values())
+    if len(lengths) > 1:
+        raise ValueError('All columns must have the same length, got %s.' % sorted(lengths))
+
+    extension = os.path.splitext(filename)[1].lower()
+    tmp_filename = filename + '.tmp'
+    if extension == '.npz':
+        _write_npz(tmp_filename, columns)
+    elif extension == '.arrow':
+        _write_arrow(tmp_filename, columns)
+    else:
+        raise ValueError('Unknown columnar extension %s (use one of %s).' % (
+            extension, columnar_extensions))
+    os.replace(tmp_filename, filename)
+
+
+def read_table(filename):
+    """Reads a table written by write_table and returns it as a Table.
+
+    The columns are memory-mapped from the file wherever possible.
+
+    Parameters:
+    filename -- The name of the file (.npz or .arrow).
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npz':
+        return _read_npz(filename)
+    if extension == '.arrow':
+        return _read_arrow(filename)
+    raise ValueError('Unknown columnar extension %s (use one of %s).' % (
+        extension, columnar_extensions))
+
+
+# .npz: one member per column, '<name>.values' and '<name>.offsets' for ragged columns and
+# '__columns__' with the column names in order.
+
+def _write_npz(filename, columns):
+    arrays = {'__columns__': np.array(list(columns), dtype=str)}
+    for name, column in columns.items():
+        if isinstance(column, RaggedColumn):
+            arrays[name + '.values'] = column.values
+            arrays[name + '.offsets'] = column.offsets
+        else:
+            arrays[name] = column
+
+    # np.savez stores members uncompressed, which is what lets _read_npz memory-map them
+    with open(filename, 'wb') as npz_file:
+        np.savez(npz_file, **arrays)
+
+
+def _npz_members(filename):
+    """Returns a dict of member name to array, memory-mapped for uncompressed members."""
+    members = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as raw:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    members[name] = np.lib.format.read_array(member)
+                continue
+
+            # Skip the zip local header to find where the .npy data starts
+            raw.seek(info.header_offset)
+            header = raw.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            raw.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(raw)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+            else:
+                with archive.open(info) as member:
+                    members[name] = np.lib.format.read_array(member)
+                continue
+
+            if dtype.hasobject:
+                raise ValueError('%s in %s holds Python objects.' % (name, filename))
+            if 0 in shape:
+                members[name] = np.zeros(shape, dtype=dtype)
+            else:
+                members[name] = np.memmap(filename, dtype=dtype, mode='r', offset=raw.tell(),
+                                          shape=shape, order='F' if fortran_order else 'C')
+    return members
+
+
+def _read_npz(filename):
+    members = _npz_members(filename)
+    columns = {}
+    for name in members['__columns__'].tolist():
+        if name in members:
+            columns[name] = members[name]
+        else:
+            columns[name] = RaggedColumn(members[name + '.values'], members[name + '.offsets'])
+    return Table(columns)
+
+
+# .arrow: ragged columns are list columns (of fixed size lists for 2d values)
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError('Reading and writing .arrow files needs pyarrow (pip install pyarrow).')
+
+
+def _write_arrow(filename, columns):
+    _require_pyarrow()
+    arrays = []
+    for column in columns.values():
+        if isinstance(column, RaggedColumn):
+            values = np.ascontiguousarray(column.values)
+            if values.ndim == 2:
+                values = pyarrow.FixedSizeListArray.from_arrays(
+                    pyarrow.array(values.reshape(-1)), values.shape[1])
+            else:
+                values = pyarrow.array(values)
+            arrays.append(pyarrow.LargeListArray.from_arrays(
+                pyarrow.array(column.offsets.astype(np.int64)), values))
+        else:
+            arrays.append(pyarrow.array(column))
+    table = pyarrow.Table.from_arrays(arrays, names=list(columns))
+
+    with pyarrow.OSFile(filename, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _arrow_to_numpy(array):
+    try:
+        return array.to_numpy(zero_copy_only=True)
+    except (pyarrow.ArrowInvalid, NotImplementedError):
+        return array.to_numpy(zero_copy_only=False)  # e.g. strings
+
+
+def _read_arrow(filename):
+    _require_pyarrow()
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(filename, 'r')).read_all()
+    columns = {}
+    for name, chunked in zip(table.column_names, table.columns):
+        array = chunked.combine_chunks() if chunked.num_chunks != 1 else chunked.chunk(0)
+        if pyarrow.types.is_list(array.type) or pyarrow.types.is_large_list(array.type):
+            offsets = _arrow_to_numpy(array.offsets)
+            values = array.values
+            if pyarrow.types.is_fixed_size_list(values.type):
+                width = values.type.list_size
+                values = _arrow_to_numpy(values.flatten()).reshape(-1, width)
+            else:
+                values = _arrow_to_numpy(values)
+            columns[name] = RaggedColumn(values, offsets)
+        else:
+            columns[name] = _arrow_to_numpy(array)
+    return Table(columns)
@@ -0,0 +1,157 @@
+"""Coordinate layouts for placing stimuli: rings, grids and combinations of them.
+
+Every layout is returned as an (n, 2) numpy array of x, y positions that can
+be indexed with a list of location numbers (e.g. exp.locations[[0, 3, 7]])
+and handed straight to a batched renderer such as
+searcharray.SearchArrayRenderer. Layouts are memoized by the layout, its
+parameters and the window units, so asking for the same layout again (every
+trial, or from another module) costs a dict lookup. The arrays are shared
+between callers and therefore read-only; use .copy() or .tolist() to get a
+version that can be changed.
+
+Functions:
+circular -- returns n positions evenly spaced on a ring.
+clear_cache -- forgets every memoized layout.
+grid -- returns the positions of a grid centered on the origin.
+jittered_ring -- returns n positions on a ring with random angle and radius jitter.
+multi_ring -- returns the positions of several concentric rings.
+polar -- returns the positions at a list of angles on a ring.
+"""
+
+import functools
+
+import numpy as np
+
+cache_size = 128  # the number of layouts kept per layout type
+
+
+def _read_only(coords):
+    coords.flags.writeable = False
+    return coords
+
+
+def _round(coords, decimals):
+    return coords if decimals is None else np.round(coords, decimals)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def _polar(angles, radius, units, decimals):
+    rad_angles = np.radians(np.asarray(angles, dtype=float))
+    coords = float(radius) * np.column_stack((np.cos(rad_angles), np.sin(rad_angles)))
+    return _read_only(_round(coords, decimals))
+
+
+def polar(angles, radius, units='pix', decimals=0):
+    """Returns the positions at a list of angles on a ring around the origin.
+
+    Parameters:
+    angles -- A list of angles in degrees (0 is to the right, 90 is up).
+    radius -- The radius of the ring in units.
+    units -- The units of the window the positions are used in.
+    decimals -- The number of decimals to round to (default 0, whole units), or None.
+    """
+    return _polar(tuple(float(angle) for angle in angles), radius, units, decimals)
+
+
+def circular(n, radius, start_angle=0, units='pix', decimals=0):
+    """Returns n positions evenly spaced on a ring around the origin.
+
+    Parameters:
+    n -- The number of positions.
+    radius -- The radius of the ring in units.
+    start_angle -- The angle of the first position in degrees. The rest follow counterclockwise.
+    units -- The units of the window the positions are used in.
+    decimals -- The number of decimals to round to (default 0, whole units), or None.
+    """
+    return polar([start_angle + 360.0 * i / n for i in range(n)], radius, units, decimals)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def _grid(distance_x, distance_y, n_cols, n_rows, x_offset, y_offset, units):
+    cols, rows = np.meshgrid(np.arange(n_cols), np.arange(n_rows), indexing='ij')
+    coords = np.column_stack((cols.ravel() * distance_x, rows.ravel() * distance_y)).astype(float)
+    coords -= [(n_cols - 1) * distance_x / 2.0 - x_offset, (n_rows - 1) * distance_y / 2.0 - y_offset]
+    return _read_only(coords)
+
+
+def grid(distance_x, distance_y, n_cols, n_rows, x_offset=0, y_offset=0, units='pix'):
+    """Returns the positions of a grid centered on the origin (then moved by the offsets).
+
+    The positions go column by column, from the bottom of each column to the top.
+
+    Parameters:
+    distance_x -- The distance between columns in units.
+    distance_y -- The distance between rows in units.
+    n_cols -- The number of columns.
+    n_rows -- The number of rows.
+    x_offset -- Moves the grid right by x_offset.
+    y_offset -- Moves the grid up by y_offset.
+    units -- The units of the window the positions are used in.
+    """
+    return _grid(distance_x, distance_y, n_cols, n_rows, x_offset, y_offset, units)
+
+
+def _jittered_ring(n, radius, angle_jitter, radius_jitter, seed, start_angle, units, decimals):
+    rng = np.random.default_rng(seed)
+    angles = start_angle + 360.0 * np.arange(n) / n + rng.uniform(-angle_jitter, angle_jitter, n)
+    radii = radius + rng.uniform(-radius_jitter, radius_jitter, n)
+    rad_angles = np.radians(angles)
+    coords = radii[:, np.newaxis] * np.column_stack((np.cos(rad_angles), np.sin(rad_angles)))
+    return _read_only(_round(coords, decimals))
+
+
+_cached_jittered_ring = functools.lru_cache(maxsize=cache_size)(_jittered_ring)
+
+
+def jittered_ring(n, radius, angle_jitter, radius_jitter=0, seed=None, start_angle=0,
+                  units='pix', decimals=0):
+    """Returns n positions on a ring, each moved by a random angle and radius.
+
+    The layout is only memoized if a seed is given; without one every call draws new jitter.
+
+    Parameters:
+    n -- The number of positions.
+    radius -- The radius of the ring in units.
+    angle_jitter -- Each angle is moved by up to this many degrees either way.
+    radius_jitter -- Each radius is moved by up to this many units either way.
+    seed -- The seed of the jitter, or None.
+    start_angle -- The angle of the first position (before jitter) in degrees.
+    units -- The units of the window the positions are used in.
+    decimals -- The number of decimals to round to (default 0, whole units), or None.
+    """
+    if seed is None:
+        return _jittered_ring(n, radius, angle_jitter, radius_jitter, None, start_angle, units,
+                              decimals)
+    return _cached_jittered_ring(n, radius, angle_jitter, radius_jitter, seed, start_angle, units,
+                                 decimals)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def _multi_ring(counts, radii, start_angles, units, decimals):
+    return _read_only(np.concatenate(
+        [circular(n, radius, start_angle, units, decimals)
+         for n, radius, start_angle in zip(counts, radii, start_angles)]))
+
+
+def multi_ring(counts, radii, start_angles=0, units='pix', decimals=0):
+    """Returns the positions of several concentric rings, the first ring's positions first.
+
+    Parameters:
+    counts -- The number of positions on each ring.
+    radii -- The radius of each ring in units.
+    start_angles -- The angle of the first position of each ring in degrees (one number for
+        every ring, or one per ring). Offsetting rings avoids lining positions up radially.
+    units -- The units of the window the positions are used in.
+    decimals -- The number of decimals to round to (default 0, whole units), or None.
+    """
+    if np.isscalar(start_angles):
+        start_angles = [start_angles] * len(counts)
+    if not len(counts) == len(radii) == len(start_angles):
+        raise ValueError('counts, radii and start_angles must have one entry per ring.')
+    return _multi_ring(tuple(counts), tuple(radii), tuple(start_angles), units, decimals)
+
+
+def clear_cache():
+    """Forgets every memoized layout."""
+    for cached in [_polar, _grid, _cached_jittered_ring, _multi_ring]:
+        cached.cache_clear()
@@ -0,0 +1,236 @@
+"""Ingests the data files of every session into one indexed SQLite database.
+
+Every session leaves its own files behind: the visSearch data file
+(data/<subjCode>.tsv), the TLTask csv (VisualSearch_NNN.csv) and the json
+with the info from the dialog box (VisualSearch_NNN_info.json, see
+template.BaseExperiment.save_experiment_info). Ingesting them into one
+database lets queries across subjects run on indexes instead of reopening
+thousands of files.
+
+Ingestion is incremental. Every file's path, modification time, size and
+SHA-1 are kept in the files table; a file whose modification time and size
+have not changed is skipped without being read, and one whose contents hash
+the same is only touched. A changed file has its old rows replaced in one
+transaction, so an interrupted ingest never leaves half a session behind.
+
+Tables:
+files -- path, kind, mtime, size, sha1, rows and ingested (time) of every ingested file.
+vissearch_trials -- the rows of the visSearch data files (see analysis.load_vissearch).
+tltask_trials -- the rows of the TLTask csv files.
+experiment_info -- the info json of every session, with its experiment and subject.
+
+Every trial row also has source (the path of its file) and session (its file name without the
+extension). Columns a file has that its table does not (e.g. the frame timing columns) are
+added to the table.
+
+If this file is run directly, it ingests the files matching the patterns given (default
+data/*.tsv, VisualSearch_*.csv and *_info.json) into --db (default cohort.sqlite).
+
+Functions:
+connect -- opens (and if needed creates) the database.
+file_kind -- returns which table a data file goes into.
+ingest -- ingests every changed file matching glob patterns.
+ingest_file -- ingests one file unless it has not changed.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import analysis
+
+default_patterns = ['data/*.tsv', 'VisualSearch_*.csv', '*_info.json']
+hash_block_size = 1 << 20  # bytes read at a time when hashing a file
+
+# Columns (with their types) every trial table starts with; files can add more
+trial_columns = {
+    'vissearch_trials': [('source', 'TEXT'), ('session', 'TEXT'), ('subjCode', 'TEXT'),
+                         ('block', 'INTEGER'), ('isPresent', 'INTEGER'), ('numItems', 'INTEGER'),
+                         ('part', 'TEXT'), ('trialIndex', 'INTEGER'), ('isRight', 'INTEGER'),
+                         ('rt', 'REAL')],
+    'tltask_trials': [('source', 'TEXT'), ('session', 'TEXT'), ('Subject', 'TEXT'),
+                      ('Block', 'INTEGER'), ('Trial', 'INTEGER'), ('SetSize', 'INTEGER'),
+                      ('RT', 'REAL'), ('ACC', 'INTEGER')],
+}
+indexed_columns = {
+    'vissearch_trials': ['source', 'subjCode', 'block', 'numItems', 'isPresent'],
+    'tltask_trials': ['source', 'Subject', 'Block', 'SetSize'],
+}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(filename='cohort.sqlite'):
+    """Opens the database, creating its tables and indexes if they do not exist, and returns the
+    sqlite3 connection.
+
+    Parameters:
+    filename -- The name of the database file.
+    """
+    connection = sqlite3.connect(filename)
+    connection.execute('PRAGMA journal_mode=WAL')  # queries can run while a refresh writes
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT, '
+                           'mtime REAL, size INTEGER, sha1 TEXT, rows INTEGER, ingested REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS experiment_info (source TEXT PRIMARY KEY, '
+                           'experiment TEXT, subject TEXT, info TEXT)')
+        for table, columns in trial_columns.items():
+            connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+                table, ', '.join('%s %s' % (_quote(name), sql_type) for name, sql_type in columns)))
+            for column in indexed_columns[table]:
+                connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                    _quote('%s_%s' % (table, column)), table, _quote(column)))
+    return connection
+
+
+def file_kind(path):
+    """Returns the table a data file is ingested into: 'vissearch_trials' for .tsv files,
+    'tltask_trials' for .csv files and 'experiment_info' for .json files.
+
+    Parameters:
+    path -- The name of the file.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    kinds = {'.tsv': 'vissearch_trials', '.csv': 'tltask_trials', '.json': 'experiment_info'}
+    if extension not in kinds:
+        raise ValueError('%s is not a .tsv, .csv or .json data file.' % path)
+    return kinds[extension]
+
+
+def _sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(hash_block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _table_columns(connection, table):
+    return [row[1] for row in connection.execute('PRAGMA table_info(%s)' % table)]
+
+
+def _python_value(value):
+    """Converts numpy scalars to Python ones and missing values to None for sqlite3."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _insert_trials(connection, table, path):
+    if table == 'vissearch_trials':
+        frame = analysis.read_vissearch_file(path)
+    else:
+        frame = analysis.read_tltask_file(path)
+        if 'Subject' not in frame.columns:
+            raise ValueError('%s is not a TLTask data file (it has no Subject column).' % path)
+    frame.insert(0, 'source', path)
+
+    existing = set(_table_columns(connection, table))
+    for column in frame.columns:
+        if column not in existing:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s' % (table, _quote(column)))
+
+    rows = ([_python_value(value) for value in row]
+            for row in frame.itertuples(index=False, name=None))
+    connection.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(_quote(column) for column in frame.columns),
+        ', '.join('?' * len(frame.columns))), rows)
+    return len(frame)
+
+
+def _insert_info(connection, path):
+    with open(path) as info_file:
+        info = json.load(info_file)
+    experiment = os.path.basename(path).rsplit('_', 2)[0]  # <experiment>_<subject>_info.json
+    connection.execute('INSERT INTO experiment_info VALUES (?, ?, ?, ?)', (
+        path, experiment, info.get('Subject Number'), json.dumps(info)))
+    return 1
+
+
+def ingest_file(connection, path, force=False):
+    """Ingests one file, replacing the rows it had before, unless it has not changed.
+
+    Returns 'ingested', 'touched' (the modification time changed but not the contents) or
+    'unchanged'.
+
+    Parameters:
+    connection -- A connection from connect().
+    path -- The name of the file.
+    force -- If True, the file is ingested even if it has not changed.
+    """
+    table = file_kind(path)
+    path = os.path.normpath(path)
+    stat = os.stat(path)
+    known = connection.execute('SELECT mtime, size, sha1 FROM files WHERE path = ?',
+                               (path,)).fetchone()
+    if not force and known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+        return 'unchanged'
+
+    sha1 = _sha1(path)
+    with connection:
+        if not force and known is not None and known[2] == sha1:
+            connection.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?',
+                               (stat.st_mtime, stat.st_size, path))
+            return 'touched'
+
+        connection.execute('DELETE FROM %s WHERE source = ?' % table, (path,))
+        if table == 'experiment_info':
+            rows = _insert_info(connection, path)
+        else:
+            rows = _insert_trials(connection, table, path)
+        connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            path, table, stat.st_mtime, stat.st_size, sha1, rows, time.time()))
+    return 'ingested'
+
+
+def ingest(connection, patterns=default_patterns, force=False, verbose=False):
+    """Ingests every file matching the glob patterns that changed since it was last ingested.
+
+    Returns a dict with the number of files ingested, touched, unchanged and failed. A file that
+    cannot be read is reported (if verbose) and left out; its old rows stay in the database.
+
+    Parameters:
+    connection -- A connection from connect().
+    patterns -- A glob pattern or a list of them.
+    force -- If True, every file is ingested even if it has not changed.
+    verbose -- If True, every ingested or failed file is printed.
+    """
+    counts = {'ingested': 0, 'touched': 0, 'unchanged': 0, 'failed': 0}
+    for path in analysis.find_files(patterns):
+        try:
+            outcome = ingest_file(connection, path, force)
+        except (ValueError, OSError, sqlite3.Error) as error:
+            outcome = 'failed'
+            if verbose:
+                print('failed %s: %s' % (path, error))
+        else:
+            if verbose and outcome == 'ingested':
+                print('ingested %s' % path)
+        counts[outcome] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest session data files into a database.')
+    parser.add_argument('patterns', nargs='*', default=default_patterns,
+                        help='glob patterns of the files to ingest')
+    parser.add_argument('--db', default='cohort.sqlite', help='the database file')
+    parser.add_argument('--force', action='store_true', help='ingest unchanged files too')
+    parser.add_argument('--quiet', action='store_true', help='only print the totals')
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    start = time.perf_counter()
+    totals = ingest(db, args.patterns, args.force, verbose=not args.quiet)
+    db.close()
+    print('%(ingested)d ingested, %(touched)d touched, %(unchanged)d unchanged, '
+          '%(failed)d failed' % totals + ' in %.2f s' % (time.perf_counter() - start))
@@ -0,0 +1,196 @@
+"""Records when every flip actually happened.
+
+Reaction times are measured from a clock that is started after flip()
+returns, and nothing records whether the stimulus made it onto the intended
+frame. FlipTimer wraps window.flip() and, per trial phase (e.g. fixation,
+search, feedback), records the flip timestamp, the time from the start of
+drawing to the flip, and how many frames were missed.
+
+Missed frames are counted on the refresh grid set by the previous flip: a
+flip should land on the first refresh after its drawing began (begin(), or
+the flip() call if begin() was not called), and every refresh between that
+one and the actual onset is a missed frame. So a draw that runs past a
+refresh counts even though flip() itself returned promptly. A draw that
+starts in the last half of a frame is allowed to land on the refresh after
+the next one.
+
+All times are on psychopy.core.monotonicClock, the clock window.flip()
+timestamps are on. Clock.getLastResetTime() is on the raw psychopy clock
+instead; convert it with clock_reset_time.
+
+Classes:
+FlipTimer -- Flips a window and records flip timing per trial and per session.
+
+Functions:
+clock_reset_time -- Returns when a psychopy clock was last reset, on the flip timestamp clock.
+trial_fields -- Returns the names of the per-trial timing columns for a list of phases.
+"""
+
+import json
+
+import numpy as np
+
+import psychopy.core
+
+
+def _column(phase):
+    return phase[:1].upper() + phase[1:]
+
+
+def _now():
+    return psychopy.core.monotonicClock.getTime()
+
+
+def clock_reset_time(clock):
+    """Returns when a psychopy clock (e.g. an RT clock) was last reset, on
+    psychopy.core.monotonicClock like the flip timestamps.
+
+    Parameters:
+    clock -- A psychopy.core.Clock or MonotonicClock.
+    """
+    return clock.getLastResetTime() - psychopy.core.monotonicClock.getLastResetTime()
+
+
+def trial_fields(phases):
+    """Returns the names of the per-trial columns FlipTimer.trial_data produces.
+
+    Parameters:
+    phases -- A list of phase names, e.g. ['fixation', 'search', 'feedback'].
+    """
+    fields = []
+    for phase in phases:
+        fields.extend([_column(phase) + 'Onset', _column(phase) + 'DrawMs'])
+    fields.extend(['DroppedFrames', 'RTOffsetMs'])
+    return fields
+
+
+class FlipTimer:
+    """Flips a window and records the timing of each flip.
+
+    If not enabled, flip() only flips the window.
+
+    Parameters:
+    window -- The psychopy window.
+    phases -- A list of the phase names used within a trial.
+    onset_phase -- The phase whose flip starts the response window (used for RTOffsetMs).
+    enabled -- Whether to record anything.
+
+    Methods:
+    begin -- marks the start of drawing for a phase.
+    flip -- flips the window and records the flip for a phase.
+    save_summary -- writes the per-session timing summary to a json file.
+    summary -- returns the per-session timing summary.
+    trial_data -- returns the timing columns for the current trial and starts a new trial.
+    """
+
+    def __init__(self, window, phases, onset_phase='search', enabled=True):
+        self.window = window
+        self.phases = list(phases)
+        self.onset_phase = onset_phase
+        self.enabled = enabled
+        self.frame_period = getattr(window, 'monitorFramePeriod', None) or 1 / 60.0
+
+        self.draw_start = None
+        self.last_onset = None
+        self.trial = {}
+        self.session = {phase: [] for phase in self.phases}  # (onset, draw ms, missed frames)
+
+    def begin(self, phase=None):
+        """Marks the start of drawing for the next flip.
+
+        Parameters:
+        phase -- The phase being drawn (only used for readability at the call site).
+        """
+        if self.enabled:
+            self.draw_start = _now()
+
+    def flip(self, phase=None):
+        """Flips the window. Returns the flip timestamp.
+
+        Parameters:
+        phase -- The phase this flip starts. Flips without a phase are not recorded.
+        """
+        if not self.enabled:
+            return self.window.flip()
+
+        flip_called = _now()
+        onset = self.window.flip()
+        if onset is None:
+            onset = _now()
+
+        if phase is not None:
+            draw_start = self.draw_start if self.draw_start is not None else flip_called
+            draw_ms = (onset - draw_start) * 1000
+            missed = self._missed_frames(draw_start, onset)
+            self.trial[phase] = (onset, draw_ms, missed)
+            self.session.setdefault(phase, []).append((onset, draw_ms, missed))
+
+        self.draw_start = None
+        self.last_onset = onset
+        return onset
+
+    def _missed_frames(self, draw_start, onset):
+        """Returns the number of refreshes between the one a frame was due at and its onset."""
+        if self.last_onset is None:
+            return max(0, int(np.floor((onset - draw_start) / self.frame_period - 0.5)))
+        # Refreshes happen every frame_period after the previous onset
+        refreshes = int(round((onset - self.last_onset) / self.frame_period))
+        due = max(1, int(np.ceil((draw_start - self.last_onset) / self.frame_period + 0.5)))
+        return max(0, refreshes - due)
+
+    def trial_data(self, response_clock_start=None):
+        """Returns a dict with the timing columns (see trial_fields) for the current trial and
+        starts a new trial.
+
+        Parameters:
+        response_clock_start -- The time the RT clock was started, on psychopy.core.monotonicClock
+            (see clock_reset_time). If given, RTOffsetMs is the time from the onset_phase flip to
+            the start of the RT clock, so RT + RTOffsetMs is the RT from stimulus onset.
+        """
+        data = {}
+        for phase in self.phases:
+            onset, draw_ms, _ = self.trial.get(phase, ('NA', 'NA', 0))
+            data[_column(phase) + 'Onset'] = onset
+            data[_column(phase) + 'DrawMs'] = draw_ms
+        data['DroppedFrames'] = sum(self.trial[phase][2] for phase in self.phases
+                                    if phase in self.trial)
+
+        if response_clock_start is not None and self.onset_phase in self.trial:
+            data['RTOffsetMs'] = (response_clock_start - self.trial[self.onset_phase][0]) * 1000
+        else:
+            data['RTOffsetMs'] = 'NA'
+
+        self.trial = {}
+        return data
+
+    def summary(self):
+        """Returns a dict summarizing the timing of all recorded flips in the session."""
+        phases = {}
+        for phase, flips in self.session.items():
+            if not flips:
+                continue
+            draw_ms = np.array([flip[1] for flip in flips])
+            missed = np.array([flip[2] for flip in flips])
+            phases[phase] = {
+                'flips': len(flips),
+                'mean_draw_ms': float(draw_ms.mean()),
+                'max_draw_ms': float(draw_ms.max()),
+                'dropped_frames': int(missed.sum()),
+                'flips_with_dropped_frames': int((missed > 0).sum()),
+            }
+
+        return {
+            'frame_period_ms': self.frame_period * 1000,
+            'flips': sum(phase['flips'] for phase in phases.values()),
+            'dropped_frames': sum(phase['dropped_frames'] for phase in phases.values()),
+            'phases': phases,
+        }
+
+    def save_summary(self, filename):
+        """Writes summary() to a json file.
+
+        Parameters:
+        filename -- The name of the json file.
+        """
+        with open(filename, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
@@ -1,97 +1,148 @@
-import glob, os, random, sys
-#from useful_functions_python3 import *
-import random
-from operator import itemgetter
-import copy
-import pandas as pd
-from psychopy import core, visual, prefs, event
-import random, sys
-from stimPresPsychoPy_python3 import *
-#from useful_functions_python3 import *
-#I added these base functions to get get runTimeVars to work
-from baseDefsPsychoPy import *
-from generateTrials import *
-import webbrowser as web
-import socket
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from distutils.util import strtobool
-import psychopy.hardware.keyboard
-from baseDefsPsychoPy import *
-from stimPresPsychoPy import *
-import constants
+import columnar
+from textfiles import writeToFile, syncFile
+#pandas takes a while to import, so it is only imported by the functions that use it (after the subject dialog)
 
-from psychopy import logging
-logging.console.setLevel(logging.CRITICAL)
+numItems = [4,6,12]
+isPresent = ['present','absent']
+numPositions = 12
+trialFields = ['block', 'targetName', 'targetPic', 'distractorName', 'distractorPic', 'targetLocation', 'isPresent', 'numItems', 'distractorLocations']
 
-def generateTrials(runTimeVars,runTimeVarsOrder):
+def crossTrialList(targetInfo,blocks):
+	"""Builds the full factorial design (block x target x distractor x presence x numItems x location) as one DataFrame.
+	Targets/distractors are crossed the same way the trial list is read: every targetPic of a targetName,
+	every distractorName paired with that targetName and every distractorPic of that distractorName."""
+	import pandas as pd
+	pairs = targetInfo[['block','targetName']].drop_duplicates()
+	pairs = pairs.merge(targetInfo[['targetName','targetPic']].drop_duplicates(), on='targetName')
+	pairs = pairs.merge(targetInfo[['targetName','distractorName']].drop_duplicates(), on='targetName')
+	pairs = pairs.merge(targetInfo[['distractorName','distractorPic']].drop_duplicates(), on='distractorName')
+	pairs = pairs[pairs.block.isin(blocks)].sort_values(['block','targetName','targetPic','distractorName','distractorPic'], kind='stable')
+	conditions = pd.MultiIndex.from_product([isPresent,numItems,range(numPositions)], names=['isPresent','numItems','targetLocation']).to_frame(index=False)
+	return pairs.merge(conditions, how='cross').reset_index(drop=True)
+
+def sampleDistractorLocations(design,rng):
+	"""Draws the distractor locations for every trial in one batch.
+	Each trial gets a row of random keys; the target's own position is excluded and the lowest keys
+	within each half of the display are the sampled locations (i.e., sampling without replacement)."""
+	half = int(numPositions/2)
+	numTrials = len(design)
+	present = (design.isPresent == 'present').values
+	targetLocation = design.targetLocation.values.astype(int)
+	curNumItems = design.numItems.values.astype(int)
+	targetOnLeft = present & (targetLocation < half)
+	targetOnRight = present & (targetLocation >= half)
+	numLeft = np.where(targetOnLeft, (curNumItems-1)//2, curNumItems//2)
+	numRight = np.where(targetOnRight, (curNumItems-1)//2, curNumItems//2)
+
+	keys = rng.random((numTrials,numPositions))
+	keys[np.flatnonzero(present),targetLocation[present]] = np.inf
+	leftOrder = np.argsort(keys[:,:half],axis=1,kind='stable')
+	rightOrder = np.argsort(keys[:,half:],axis=1,kind='stable')+half
+	leftLocations = leftOrder.tolist()
+	rightLocations = rightOrder.tolist()
+	return [leftLocations[i][:numLeft[i]] + rightLocations[i][:numRight[i]] for i in range(numTrials)]
+
+def writeColumnarTrials(fileName,runTimeVars,runTimeVarsOrder,trialBlocks):
+	"""Writes the trials as typed columns (see columnar.py): the run-time variables and names as strings,
+	numItems and targetLocation as ints (targetLocation is -1 when the target is absent) and
+	distractorLocations as a ragged int column"""
+	import pandas as pd
+	trials = pd.concat(trialBlocks)
+	numTrials = len(trials)
+	columns = dict((curRuntimeVar, [str(runTimeVars[curRuntimeVar])]*numTrials) for curRuntimeVar in runTimeVarsOrder)
+	for curField in ['block', 'targetName', 'targetPic', 'distractorName', 'distractorPic']:
+		columns[curField] = trials[curField].astype(str).values
+	columns['targetLocation'] = pd.to_numeric(trials.targetLocation, errors='coerce').fillna(-1).values.astype(np.int16)
+	columns['isPresent'] = trials.isPresent.astype(str).values
+	columns['numItems'] = trials.numItems.values.astype(np.int16)
+	columns['distractorLocations'] = columnar.RaggedColumn.from_lists(list(trials.distractorLocations), dtype=np.int16)
+	columnar.write_table(fileName,columns)
+
+def generateTrials(runTimeVars,runTimeVarsOrder,targetInfo=None,fileFormat='txt'):
+	"""Writes trials/<subjCode>_trials.<fileFormat>: a tab-separated text file for 'txt', or a columnar file for 'npz' or 'arrow'"""
+	import pandas as pd
 	if not runTimeVars['subjCode']:
 		sys.exit('Please provide a new subject code')
 	try:
-		random.seed(int(runTimeVars['seed']))
+		rng = np.random.default_rng(int(runTimeVars['seed']))
 	except:
 		sys.exit("Could not set seed. Check that there are no trailing spaces")
 
-	targetInfo = pd.read_csv('trialList_'+runTimeVars['lang']+'.txt',sep="\t")
-	numItems=[4,6,12]
-	isPresent = ['present','absent']
-	numPositions=12
-	positionIndices = range(numPositions)
-	(leftLocations,rightLocations) = (list(range(int(numPositions/2))), list(range(int(numPositions/2),numPositions)))
+	if targetInfo is None:
+		targetInfo = pd.read_csv('trialList_'+runTimeVars['lang']+'.txt',sep="\t")
 	blocksInTrialFile = list(set(list(targetInfo.block.values)))
 	blocks = list(runTimeVars['blockOrder'])
 	if set(blocks) != set(blocksInTrialFile):
-		sys.exit("Blocks do not match. Check trialList.txt")		
-	trialInfo={}
-	for curBlock in blocks:
-		curTrialIndex=0
-		trialInfo[curBlock]=[]
-		for curTargetName in set(targetInfo[(targetInfo.block == curBlock)]['targetName'].values):
-			for curTargetPic in set(targetInfo[(targetInfo.targetName == curTargetName)]['targetPic'].values):
-				for curDistractorName in set(targetInfo[(targetInfo.targetName == curTargetName)]['distractorName'].values):
-					for curDistractorPic in  set(targetInfo[(targetInfo.distractorName == curDistractorName)]['distractorPic'].values):
-						for curIsPres in isPresent:
-							for curNumItems in numItems:
-								for curTargetLocation in range(numPositions):
-									(leftDistractors,rightDistractors) = (copy.copy(leftLocations),copy.copy(rightLocations))
-									if curIsPres=="present":
-										if curTargetLocation in leftDistractors:
-											leftDistractors.remove(curTargetLocation)
-											leftDistractors =  random.sample(leftDistractors,int((curNumItems-1)/2))
-											rightDistractors = random.sample(rightDistractors,int(curNumItems/2))
-										else:
-											rightDistractors.remove(curTargetLocation)
-											leftDistractors =  random.sample(leftDistractors,int(curNumItems/2))
-											rightDistractors = random.sample(rightDistractors,int((curNumItems-1)/2))
-									else:
-										curTargetLocation="NA"
-										leftDistractors =  random.sample(leftDistractors,int(curNumItems/2))
-										rightDistractors = random.sample(rightDistractors,int(curNumItems/2))
-										
-									distractorLocations = leftDistractors + rightDistractors
-
-									trialInfo[curBlock].append([])
-									for curRuntimeVar in runTimeVarsOrder:
-										trialInfo[curBlock][curTrialIndex].append(runTimeVars[curRuntimeVar])
-						
-									trialInfo[curBlock][curTrialIndex].extend([curBlock, curTargetName, curTargetPic, curDistractorName, curDistractorPic, curTargetLocation, curIsPres, curNumItems, distractorLocations])
-									curTrialIndex+=1
-
-	
-	outputFile = open('trials/'+runTimeVars['subjCode']+'_trials.txt','w')
-	header = runTimeVarsOrder
-	header.extend (['block', 'targetName', 'targetPic', 'distractorName', 'distractorPic', 'targetLocation', 'isPresent', 'numItems', 'distractorLocations'])
-	writeToFile(outputFile,header)
+		sys.exit("Blocks do not match. Check trialList.txt")
+
+	design = crossTrialList(targetInfo,blocks)
+	design['distractorLocations'] = sampleDistractorLocations(design,rng)
+	design['targetLocation'] = design.targetLocation.astype(object).where(design.isPresent == 'present', "NA")
+
+	trialBlocks = []
 	for curBlock in blocks:
-		trialBlock = trialInfo[curBlock]
-		random.shuffle(trialBlock)
-		for curTrial in trialBlock:
-			writeToFile(outputFile,curTrial)
-	outputFile.close()
+		trialBlock = design[design.block == curBlock]
+		trialBlocks.append(trialBlock.iloc[rng.permutation(len(trialBlock))])
+
+	fileName = 'trials/'+runTimeVars['subjCode']+'_trials.'+fileFormat
+	if columnar.is_columnar(fileName):
+		writeColumnarTrials(fileName,runTimeVars,runTimeVarsOrder,trialBlocks)
+		return True
+
+	outputFile = open(fileName,'w')
+	header = list(runTimeVarsOrder)
+	header.extend(trialFields)
+	writeToFile(outputFile,header,sync=False)
+	subjVars = [runTimeVars[curRuntimeVar] for curRuntimeVar in runTimeVarsOrder]
+	for trialBlock in trialBlocks:
+		for curTrial in trialBlock[trialFields].itertuples(index=False):
+			writeToFile(outputFile,subjVars+list(curTrial),sync=False)
+	syncFile(outputFile)
 	outputFile.close()
 	return True
 
+_workerTrialLists = {}
+
+def _initWorker(trialLists):
+	global _workerTrialLists
+	_workerTrialLists = trialLists
+
+def _generateTrialsWorker(job):
+	"""Runs generateTrials for one subject inside a pool worker. Returns an error message instead of exiting the worker."""
+	(runTimeVars,runTimeVarsOrder,fileFormat) = job
+	try:
+		generateTrials(runTimeVars,runTimeVarsOrder,_workerTrialLists[runTimeVars['lang']],fileFormat)
+	except SystemExit as e:
+		return runTimeVars['subjCode']+': '+str(e)
+	return ''
+
+def readRoster(fileName):
+	"""Reads a tab-separated roster with one subject per row (subjCode, seed, lang, blockOrder, ...)"""
+	import pandas as pd
+	return pd.read_csv(fileName,sep="\t",dtype=str).to_dict('records')
+
+def generateTrialsBatch(roster,runTimeVarsOrder,processes=None,fileFormat='txt'):
+	"""Generates trials/<subjCode>_trials.<fileFormat> for every subject in the roster (a list of runTimeVars dicts) across a process pool.
+	Each trialList_<lang>.txt is parsed once and shared with the workers. Every subject draws from its own
+	Generator seeded by its 'seed', so the files are the same however the jobs are scheduled."""
+	import pandas as pd
+	trialLists = {}
+	for curLang in set(curSubj['lang'] for curSubj in roster):
+		trialLists[curLang] = pd.read_csv('trialList_'+curLang+'.txt',sep="\t")
+	jobs = [(curSubj,runTimeVarsOrder,fileFormat) for curSubj in roster]
+	with ProcessPoolExecutor(max_workers=processes,initializer=_initWorker,initargs=(trialLists,)) as pool:
+		errors = [error for error in pool.map(_generateTrialsWorker,jobs) if error]
+	if errors:
+		sys.exit('\n'.join(errors))
+	return True
+
 if __name__ == '__main__':
-	generateTrials({'subjCode':'testSubj1', 'seed':'20', 'lang':'e','blockOrder':'LR'}, ['subjCode', 'seed', 'lang','blockOrder'])	
-	generateTrials({'subjCode':'testSubj2', 'seed':'20', 'lang':'e','blockOrder':'RL'}, ['subjCode', 'seed', 'lang','blockOrder'])	
+	if len(sys.argv) > 1:
+		generateTrialsBatch(readRoster(sys.argv[1]), ['subjCode', 'seed', 'lang','blockOrder'])
+	else:
+		generateTrialsBatch([{'subjCode':'testSubj1', 'seed':'20', 'lang':'e','blockOrder':'LR'},
+			{'subjCode':'testSubj2', 'seed':'20', 'lang':'e','blockOrder':'RL'}], ['subjCode', 'seed', 'lang','blockOrder'])
 
-	
\ No newline at end of file
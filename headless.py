@@ -0,0 +1,431 @@
+"""Runs whole sessions with a simulated participant, for benchmarking.
+
+Neither visSearch.Exp nor TLTask.run can be timed without a monitor, a
+participant and the run-time dialogs. The runners in this module replace the
+dialogs with preset values, every key press with a SyntheticResponder and
+every psychopy.core.wait (and time.sleep on the main thread) with a
+VirtualClock that only adds up the time that would have been waited. The
+session then runs as fast as generation, rendering and logging allow, and the
+report gives the wall time of each part per trial.
+
+Rendering is real: a small window is opened with waitBlanking=False so flips
+do not wait for the refresh. On a machine without a display, run under a
+virtual X server with software OpenGL, e.g.
+    xvfb-run -a python headless.py tltask --software-gl
+
+Classes:
+HeadlessTLTask -- A TLTask that runs without a display, dialogs or participant.
+SyntheticResponder -- Draws responses with a set accuracy and an ex-Gaussian RT distribution.
+VirtualClock -- Replaces waits with a counter of virtual time.
+
+Functions:
+run_tltask -- Runs a whole TLTask session headless and returns the timing report.
+run_vissearch -- Runs a whole visSearch session headless and returns the timing report.
+summarize -- Builds the timing report from the recorded timings.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import psychopy.core
+import psychopy.event
+import psychopy.visual
+
+import audiofeedback
+import visualsearch
+
+
+class SyntheticResponder:
+    """Draws responses for a simulated participant.
+
+    RTs are ex-Gaussian (a normal plus an exponential), the usual shape of
+    choice RT distributions, and grow linearly with set size.
+
+    Parameters:
+    accuracy -- The probability of a correct response.
+    rt_mu -- The mean of the normal component in seconds.
+    rt_sigma -- The standard deviation of the normal component in seconds.
+    rt_tau -- The mean of the exponential component in seconds.
+    rt_slope -- Seconds added per item in the display.
+    seed -- Seed for the random generator, or None.
+
+    Methods:
+    respond -- returns a key and an RT in seconds.
+    """
+
+    def __init__(self, accuracy=.95, rt_mu=.45, rt_sigma=.05, rt_tau=.15, rt_slope=.02,
+                 seed=None):
+        self.accuracy = accuracy
+        self.rt_mu = rt_mu
+        self.rt_sigma = rt_sigma
+        self.rt_tau = rt_tau
+        self.rt_slope = rt_slope
+        self.rng = np.random.default_rng(seed)
+
+    def respond(self, correct_key, keys, set_size=0):
+        """Returns the pressed key and the RT in seconds.
+
+        Parameters:
+        correct_key -- The correct response.
+        keys -- All valid responses. Errors are drawn uniformly from the others.
+        set_size -- The number of items in the display.
+        """
+        key = correct_key
+        wrong_keys = [k for k in keys if k != correct_key]
+        if wrong_keys and self.rng.random() >= self.accuracy:
+            key = wrong_keys[self.rng.integers(len(wrong_keys))]
+
+        rt = (self.rng.normal(self.rt_mu, self.rt_sigma) + self.rng.exponential(self.rt_tau) +
+              self.rt_slope * set_size)
+
+        return key, max(rt, .1)
+
+
+class VirtualClock:
+    """Replaces psychopy.core.wait and time.sleep with a counter of virtual time.
+
+    Only waits on the main thread are virtual, so background threads (e.g.
+    the TrialLogger) keep their real timing.
+
+    Methods:
+    install -- patches the waits until the given ExitStack is closed.
+    wait -- adds secs to the virtual time instead of waiting.
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self._sleep = time.sleep
+
+    def wait(self, secs, hogCPUperiod=0.2):
+        """Adds secs to the virtual time (really sleeps if not called on the main thread).
+
+        Parameters:
+        secs -- The number of seconds to wait.
+        hogCPUperiod -- Ignored, accepted for compatibility with psychopy.core.wait.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            self._sleep(secs)
+        else:
+            self.elapsed += max(secs, 0)
+
+    def install(self, stack):
+        """Patches psychopy.core.wait and time.sleep until stack is closed.
+
+        Parameters:
+        stack -- A contextlib.ExitStack.
+        """
+        _patch(stack, psychopy.core, 'wait', self.wait)
+        _patch(stack, time, 'sleep', self.wait)
+
+
+def _patch(stack, obj, name, value):
+    stack.callback(setattr, obj, name, getattr(obj, name))
+    setattr(obj, name, value)
+
+
+def _timed(timings, key, func):
+    """Wraps func so the wall time of each call is appended to timings[key] in ms."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings.setdefault(key, []).append((time.perf_counter() - start) * 1000)
+    return wrapper
+
+
+def _wait_keys(maxWait=float('inf'), keyList=None, modifiers=False, timeStamped=False,
+               clearEvents=True):
+    """Stands in for psychopy.event.waitKeys and presses the first valid key immediately."""
+    key = keyList[0] if keyList else 'space'
+    if timeStamped:
+        return [[key, 0.0]]
+    return [key]
+
+
+def _install_input(stack, clock):
+    clock.install(stack)
+    _patch(stack, psychopy.event, 'waitKeys', _wait_keys)
+
+
+def _stats(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {
+        'n': len(values),
+        'total': float(values.sum()),
+        'mean': float(values.mean()),
+        'median': float(np.median(values)),
+        'p95': float(np.percentile(values, 95)),
+        'max': float(values.max()),
+    }
+
+
+def summarize(timings, wall_s, virtual_s):
+    """Returns the timing report of a headless session as a dict.
+
+    Each entry of timings (a list of ms per call) is summarized with its count, total, mean,
+    median, 95th percentile and max. The per-trial times are kept as well.
+
+    Parameters:
+    timings -- A dict of lists of wall times in ms, e.g. {'trial_ms': [...], 'generation_ms': [...]}
+    wall_s -- The wall time of the whole session in seconds.
+    virtual_s -- The seconds of waits and responses that were skipped.
+    """
+    n_trials = len(timings.get('trial_ms', []))
+
+    report = {
+        'trials': n_trials,
+        'wall_s': wall_s,
+        'virtual_wait_s': virtual_s,
+        'trials_per_s': n_trials / wall_s if wall_s > 0 else None,
+    }
+    for key, values in sorted(timings.items()):
+        report[key] = _stats(values)
+    report['per_trial_ms'] = list(timings.get('trial_ms', []))
+
+    return report
+
+
+class HeadlessTLTask(visualsearch.TLTask):
+    """A TLTask that runs without a display, dialogs or participant.
+
+    Parameters:
+    experiment_info -- The values that would have been entered in the dialog.
+    responder -- The SyntheticResponder that answers every trial.
+    window_size -- The size of the (non fullscreen) window in pixels.
+    Additional keyword arguments are sent to visualsearch.TLTask().
+
+    Methods:
+    get_experiment_info_from_dialog -- Uses the preset experiment_info.
+    get_response -- Returns the responder's key and RT for the current trial.
+    make_block -- Makes a block of trials, timing it as generation.
+    open_window -- Opens a window that does not wait for the refresh.
+    run_trial -- Runs and times a single trial.
+    save_data_to_csv -- Saves the csv file, timing it as logging.
+    update_experiment_data -- Adds and writes new data, timing it as logging.
+    """
+
+    def __init__(self, experiment_info=None, responder=None, window_size=(800, 600), **kwargs):
+        super().__init__(**kwargs)
+
+        self.preset_info = {'Subject Number': '0', 'Age': '0', 'Experimenter Initials': 'HL',
+                            'Unique Subject Identifier': '000000'}
+        self.preset_info.update(experiment_info or {})
+        self.responder = responder if responder is not None else SyntheticResponder()
+        self.window_size = window_size
+        self.virtual_clock = None
+        self.current_trial = None
+        self.timings = {}
+        self.overwrite_ok = True
+        self.resume_ok = False
+
+    def get_experiment_info_from_dialog(self, additional_fields_dict=None, screen=0):
+        """Uses the preset experiment_info instead of showing the dialog."""
+        self.experiment_info = dict(self.preset_info)
+        return True
+
+    def open_window(self, **kwargs):
+        """Opens a window of window_size that does not wait for the refresh when flipping."""
+        kwargs.update(fullscr=False, size=self.window_size, waitBlanking=False)
+        super().open_window(**kwargs)
+
+    def make_block(self, block_num=None):
+        """Makes a block of trials, timing it as generation."""
+        return _timed(self.timings, 'generation_ms', super().make_block)(block_num)
+
+    def save_data_to_csv(self):
+        """Saves the csv file, timing it as logging."""
+        return _timed(self.timings, 'logging_ms', super().save_data_to_csv)()
+
+    def update_experiment_data(self, new_data):
+        """Adds new data and writes it to the csv file, timing it as logging."""
+        return _timed(self.timings, 'logging_ms', super().update_experiment_data)(new_data)
+
+    def run_trial(self, trial, block_num, trial_num):
+        """Runs and times a single trial."""
+        self.current_trial = trial
+        return _timed(self.timings, 'trial_ms', super().run_trial)(trial, block_num, trial_num)
+
+    def get_response(self, allow_quit=True):
+        """Returns the responder's key and RT (in ms) for the current trial."""
+        key, rt = self.responder.respond(
+            self.current_trial['cresp'], self.keys, self.current_trial['set_size'])
+        self.response_clock_start = psychopy.core.monotonicClock.getTime()
+
+        if self.response_time_limit is not None and rt > self.response_time_limit:
+            rt = self.response_time_limit
+            key = None
+
+        if self.virtual_clock is not None:
+            self.virtual_clock.wait(rt)
+
+        if key is None:
+            return None, None
+
+        return key, rt * 1000
+
+
+def run_tltask(responder=None, data_directory=None, software_gl=False, **kwargs):
+    """Runs a whole TLTask session headless. Returns the timing report (see summarize).
+
+    Parameters:
+    responder -- A SyntheticResponder (default is one with the default values).
+    data_directory -- Where the data files are written (default is a new temporary directory).
+    software_gl -- If True, asks for Mesa's software OpenGL renderer.
+    Additional keyword arguments are sent to HeadlessTLTask().
+    """
+    if software_gl:
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    if data_directory is None:
+        data_directory = tempfile.mkdtemp(prefix='headless_')
+
+    kwargs.setdefault('experiment_name', visualsearch.exp_name)
+    kwargs.setdefault('data_fields', visualsearch.data_fields)
+    kwargs.setdefault('monitor_distance', visualsearch.distance_to_monitor)
+
+    cwd = os.getcwd()
+    clock = VirtualClock()
+    exp = HeadlessTLTask(responder=responder, data_directory=data_directory, **kwargs)
+    exp.virtual_clock = clock
+
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        stack.callback(os.chdir, cwd)
+        _install_input(stack, clock)
+        try:
+            exp.run()
+        except SystemExit:
+            pass  # quit_experiment always exits
+    wall_s = time.perf_counter() - start
+
+    return summarize(exp.timings, wall_s, clock.elapsed)
+
+
+def run_vissearch(responder=None, run_time_vars=None, window_size=(800, 600), software_gl=False):
+    """Runs a whole visSearch session headless. Returns the timing report (see summarize).
+
+    Must be run from the folder with the stimuli, trials and data folders. The survey is not
+    opened.
+
+    Parameters:
+    responder -- A SyntheticResponder (default is one with the default values).
+    run_time_vars -- Values that replace the defaults normally entered in the run-time dialog.
+    window_size -- The size of the (non fullscreen) window in pixels.
+    software_gl -- If True, asks for Mesa's software OpenGL renderer.
+    """
+    if software_gl:
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+    import visSearch
+
+    preset = {'subjCode': 'headless_101', 'instructions': 'text', 'seed': 10, 'lang': 'e',
+              'showTargetImage': 'True', 'showTargetText': 'True', 'gender': 'female',
+              'blockOrder': 'RL'}
+    preset.update(run_time_vars or {})
+    responder = responder if responder is not None else SyntheticResponder()
+    clock = VirtualClock()
+    timings = {}
+    current = {}
+
+    def get_run_time_vars(varsToGet, order, expVersion):
+        order.extend(['dateStr', 'expVersion'])
+        return dict(preset, dateStr=time.strftime('%Y_%b_%d_%H%M'), expVersion=expVersion)
+
+    def get_keyboard_response(validResponses, duration=0):
+        validResponses = list(validResponses)
+        correct = [k for k in validResponses
+                   if current['exp'].validResponses[k] == current['trial']['isPresent']]
+        set_size = (len(current['trial']['distractorLocations']) +
+                    int(current['trial']['isPresent'] == 'present'))
+        key, rt = responder.respond(correct[0], validResponses, set_size)
+        clock.wait(rt)
+        return [key, rt]
+
+    class HeadlessWindow(psychopy.visual.Window):
+        def __init__(self, *args, **kwargs):
+            kwargs.update(fullscr=False, size=window_size, waitBlanking=False)
+            super().__init__(*args, **kwargs)
+
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        _install_input(stack, clock)
+        _patch(stack, visSearch, 'getRunTimeVars', get_run_time_vars)
+        _patch(stack, visSearch, 'getKeyboardResponse', get_keyboard_response)
+        _patch(stack, visSearch, 'popupConfirm', lambda text: False)  # always a new session
+        _patch(stack, visSearch, 'initAudio', lambda: None)  # NullBackend needs no audio device
+        _patch(stack, visSearch, 'FeedbackAudio',
+               lambda window=None: audiofeedback.FeedbackAudio(audiofeedback.NullBackend(), window))
+        _patch(stack, visSearch, 'generateTrials',
+               _timed(timings, 'generation_ms', visSearch.generateTrials))
+        _patch(stack, psychopy.visual, 'Window', HeadlessWindow)
+
+        exp = visSearch.Exp()
+        exp.logger.write = _timed(timings, 'logging_ms', exp.logger.write)
+        exp.logger.endBlock = _timed(timings, 'logging_ms', exp.logger.endBlock)
+        exp.logger.close = _timed(timings, 'logging_ms', exp.logger.close)
+        show_search_trial = exp.showSearchTrial
+
+        def timed_search_trial(curTrial, part, curTrialIndex):
+            current['trial'] = curTrial
+            return show_search_trial(curTrial, part, curTrialIndex)
+
+        current['exp'] = exp
+        exp.showSearchTrial = _timed(timings, 'trial_ms', timed_search_trial)
+
+        visSearch.runSession(exp, openSurvey=False)
+        exp.win.close()
+    wall_s = time.perf_counter() - start
+
+    return summarize(timings, wall_s, clock.elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a whole session with a simulated participant.')
+    parser.add_argument('experiment', choices=['tltask', 'vissearch'])
+    parser.add_argument('--accuracy', type=float, default=.95)
+    parser.add_argument('--rt-mu', type=float, default=.45, help='seconds')
+    parser.add_argument('--rt-sigma', type=float, default=.05, help='seconds')
+    parser.add_argument('--rt-tau', type=float, default=.15, help='seconds')
+    parser.add_argument('--rt-slope', type=float, default=.02, help='seconds per item')
+    parser.add_argument('--seed', type=int, default=None, help='seeds the responder and layouts')
+    parser.add_argument('--blocks', type=int, default=None, help='TLTask number_of_blocks')
+    parser.add_argument('--trials', type=int, default=None, help='TLTask trials per block')
+    parser.add_argument('--software-gl', action='store_true')
+    parser.add_argument('--report', default=None, help='json file for the full report')
+    args = parser.parse_args()
+
+    responder = SyntheticResponder(accuracy=args.accuracy, rt_mu=args.rt_mu,
+                                   rt_sigma=args.rt_sigma, rt_tau=args.rt_tau,
+                                   rt_slope=args.rt_slope, seed=args.seed)
+
+    if args.experiment == 'tltask':
+        task_kwargs = {'layout_seed': args.seed}
+        if args.blocks is not None:
+            task_kwargs['number_of_blocks'] = args.blocks
+        if args.trials is not None:
+            task_kwargs['number_of_trials_per_block'] = args.trials
+        report = run_tltask(responder, software_gl=args.software_gl, **task_kwargs)
+    else:
+        run_time_vars = {'seed': args.seed} if args.seed is not None else None
+        report = run_vissearch(responder, run_time_vars, software_gl=args.software_gl)
+
+    if args.report is not None:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    print('%d trials in %.2f s (%.1f trials/s), %.1f s of waits skipped' % (
+        report['trials'], report['wall_s'], report['trials_per_s'] or 0, report['virtual_wait_s']))
+    for key in ['trial_ms', 'generation_ms', 'logging_ms']:
+        if report.get(key):
+            print('%-14s mean %8.2f  median %8.2f  p95 %8.2f  max %8.2f  total %9.1f' % (
+                key, report[key]['mean'], report[key]['median'], report[key]['p95'],
+                report[key]['max'], report[key]['total']))
@@ -0,0 +1,138 @@
+"""An append-only journal (write-ahead log) for recovering an experiment after a crash.
+
+Every record (a trial's data, the trials of a new block, ...) is appended to the journal as one
+line of json as soon as it exists, so saving a trial costs the same at the end of a session as at
+the start. The settings needed to rebuild the experiment (experiment_info, file names, ...) are
+kept in a small checkpoint file next to the journal that is replaced atomically.
+
+After a crash, read_records returns every record that was completely written; a half written
+last line is ignored.
+
+Classes:
+Journal -- An open journal that records are appended to.
+
+Functions:
+checkpoint_filename -- Returns the name of the checkpoint file of a journal.
+read_checkpoint -- Reads the checkpoint of a journal.
+read_records -- Reads the records of a journal.
+write_checkpoint -- Atomically replaces the checkpoint of a journal.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+def _to_json(value):
+    """Converts the numpy values json does not know about."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('%r can not be written to the journal.' % (value,))
+
+
+class Journal:
+    """An append-only file of json records, one per line.
+
+    Parameters:
+    filename -- The name of the journal file. Records are appended if it exists.
+    fsync -- If True (the default), every record is synced to disk before append returns. If
+        False it is only flushed, which survives a crash of the experiment but not of the system.
+
+    Methods:
+    append -- appends a record.
+    close -- closes the journal.
+    extend -- appends a list of records.
+    """
+
+    def __init__(self, filename, fsync=True):
+        self.filename = filename
+        self.fsync = fsync
+        self.journal_file = open(filename, 'a', encoding='utf-8')
+
+    def append(self, record):
+        """Appends a record to the journal.
+
+        Parameters:
+        record -- A dict that can be written as json (numpy values are converted).
+        """
+        self.journal_file.write(json.dumps(record, default=_to_json) + '\n')
+        self.journal_file.flush()
+        if self.fsync:
+            os.fsync(self.journal_file.fileno())
+
+    def extend(self, records):
+        """Appends a list of records, syncing once at the end.
+
+        Parameters:
+        records -- A list of dicts that can be written as json.
+        """
+        self.journal_file.writelines(json.dumps(record, default=_to_json) + '\n'
+                                     for record in records)
+        self.journal_file.flush()
+        if self.fsync:
+            os.fsync(self.journal_file.fileno())
+
+    def close(self):
+        """Closes the journal file."""
+        self.journal_file.close()
+
+
+def read_records(filename):
+    """Returns the list of records in a journal, or an empty list if it does not exist.
+
+    A last line that was cut off by a crash is ignored.
+
+    Parameters:
+    filename -- The name of the journal file.
+    """
+    if not os.path.isfile(filename):
+        return []
+
+    records = []
+    with open(filename, encoding='utf-8') as journal_file:
+        for line in journal_file:
+            if not line.endswith('\n'):
+                break  # the write of this record never completed
+            records.append(json.loads(line))
+    return records
+
+
+def checkpoint_filename(filename):
+    """Returns the name of the checkpoint file of the journal filename.
+
+    Parameters:
+    filename -- The name of the journal file.
+    """
+    return os.path.splitext(filename)[0] + '.checkpoint.json'
+
+
+def write_checkpoint(filename, header):
+    """Replaces the checkpoint of a journal. The old checkpoint stays intact until the new one
+    is completely written.
+
+    Parameters:
+    filename -- The name of the journal file.
+    header -- A dict that can be written as json.
+    """
+    checkpoint = checkpoint_filename(filename)
+    with open(checkpoint + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(header, checkpoint_file, default=_to_json)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def read_checkpoint(filename):
+    """Returns the checkpoint of a journal as a dict, or None if there is none.
+
+    Parameters:
+    filename -- The name of the journal file.
+    """
+    checkpoint = checkpoint_filename(filename)
+    if not os.path.isfile(checkpoint):
+        return None
+    with open(checkpoint, encoding='utf-8') as checkpoint_file:
+        return json.load(checkpoint_file)
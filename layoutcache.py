@@ -0,0 +1,159 @@
+"""Precompiles every trial of a TLTask session into a compact binary file.
+
+Generating layouts between the instructions and the first trial delays the
+start of each block. Instead, all blocks for a subject can be built before the
+session and stored as one numpy structured array (.npy) holding, per trial,
+the block, set size, tested location, correct response and fixed-width
+arrays of locations, rotations and stimulus indices. At run time the file is
+memory-mapped, so reading a block needs no layout computation.
+
+Next to the .npy file is a small .json header with every task setting that
+changes the layouts (set sizes, trial counts, distances, seed, stimulus
+names, ...). If the header does not match the task, or either file is missing,
+the layouts are stale and are rebuilt. A task without a layout_seed gets new
+layouts for every new session (TLTask.run passes rebuild=True); its file is
+only reused to continue a session after a crash.
+
+If this file is run directly, it precompiles the layouts for one subject
+with the defaults in visualsearch.py. Give --seed, as the layouts of a task
+without a layout_seed are rebuilt when its session starts.
+
+Functions:
+compile_layouts -- builds every block for a task and writes them to a file.
+layout_settings -- returns the task settings the layouts depend on.
+load_layouts -- memory-maps a layout file, rebuilding it first if it is stale.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+layout_version = 1
+
+
+def layout_settings(task):
+    """Returns a dict of the task settings that the layouts depend on.
+
+    Parameters:
+    task -- A TLTask (or subclass) instance.
+    """
+    return {
+        'version': layout_version,
+        'number_of_blocks': task.number_of_blocks,
+        'trials_per_set_size': task.trials_per_set_size,
+        'set_sizes': list(task.set_sizes),
+        'allowed_deg_from_fix': task.allowed_deg_from_fix,
+        'min_distance': task.min_distance,
+        'max_per_quad': task.max_per_quad,
+        'layout_seed': task.layout_seed,
+        'possible_orientations': list(task.possible_orientations),
+        'keys': list(task.keys),
+        'stim_names': list(task.stim_names),
+    }
+
+
+def _layout_dtype(max_set_size):
+    return np.dtype([
+        ('block', '<i2'),
+        ('set_size', '<i2'),
+        ('test_location', '<i2'),
+        ('cresp', '<i2'),  # index into keys
+        ('locations', '<f4', (max_set_size, 2)),
+        ('rotations', '<i2', (max_set_size,)),
+        ('stimuli', '<i2', (max_set_size,)),  # indices into stim_names
+    ])
+
+
+def _paths(filename):
+    if filename.endswith('.npy'):
+        filename = filename[:-4]
+    return filename + '.npy', filename + '.json'
+
+
+def compile_layouts(task, filename):
+    """Generates every block for task and writes them to filename.
+
+    Trials are stored in the order they will be run, block after block.
+
+    Parameters:
+    task -- A TLTask (or subclass) instance.
+    filename -- The name of the layout file (the .npy extension is optional).
+    """
+    data_path, header_path = _paths(filename)
+
+    blocks = [task.generate_block() for _ in range(task.number_of_blocks)]
+    n_trials = sum(len(block) for block in blocks)
+    max_set_size = max(task.set_sizes)
+
+    stim_index = {name: i for i, name in enumerate(task.stim_names)}
+    layouts = np.zeros(n_trials, dtype=_layout_dtype(max_set_size))
+
+    i = 0
+    for block_num, block in enumerate(blocks):
+        for trial in block:
+            n = trial['set_size']
+            layouts[i]['block'] = block_num
+            layouts[i]['set_size'] = n
+            layouts[i]['test_location'] = trial['test_location']
+            layouts[i]['cresp'] = task.keys.index(trial['cresp'])
+            layouts[i]['locations'][:n] = trial['locations']
+            layouts[i]['rotations'][:n] = trial['rotations']
+            layouts[i]['stimuli'][:n] = [stim_index[stim] for stim in trial['stimuli']]
+            i += 1
+
+    # Write to temporary files first so a crash never leaves a half written layout file
+    np.save(data_path + '.tmp', layouts)
+    os.replace(data_path + '.tmp.npy', data_path)
+    with open(header_path + '.tmp', 'w') as header_file:
+        json.dump(layout_settings(task), header_file)
+    os.replace(header_path + '.tmp', header_path)
+
+
+def _is_stale(task, data_path, header_path):
+    if not (os.path.isfile(data_path) and os.path.isfile(header_path)):
+        return True
+
+    with open(header_path) as header_file:
+        try:
+            settings = json.load(header_file)
+        except ValueError:
+            return True
+
+    return settings != json.loads(json.dumps(layout_settings(task)))
+
+
+def load_layouts(task, filename, rebuild=False):
+    """Memory-maps the layout file for task, compiling it first if it is missing or stale.
+
+    Returns a read-only numpy structured array with one record per trial.
+
+    Parameters:
+    task -- A TLTask (or subclass) instance.
+    filename -- The name of the layout file (the .npy extension is optional).
+    rebuild -- If True, the file is compiled again even if it is up to date.
+    """
+    data_path, header_path = _paths(filename)
+
+    if rebuild or _is_stale(task, data_path, header_path):
+        compile_layouts(task, filename)
+
+    return np.load(data_path, mmap_mode='r')
+
+
+if __name__ == '__main__':
+    import visualsearch
+
+    parser = argparse.ArgumentParser(description='Precompile the TLTask layouts for a subject.')
+    parser.add_argument('subject_number', help='Subject number as entered in the dialog')
+    parser.add_argument('--seed', type=int, default=None, help='layout_seed for the task')
+    args = parser.parse_args()
+
+    exp = visualsearch.TLTask(experiment_name=visualsearch.exp_name,
+                              data_fields=visualsearch.data_fields,
+                              monitor_distance=visualsearch.distance_to_monitor,
+                              layout_seed=args.seed)
+    exp.experiment_info['Subject Number'] = args.subject_number
+    exp.chdir()
+    compile_layouts(exp, exp.layout_filename())
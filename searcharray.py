@@ -0,0 +1,171 @@
+"""Draws a whole search array with one draw call per texture.
+
+Instead of moving one ImageStim and drawing it once per item, every item
+that shares a texture is packed into a single psychopy ElementArrayStim with
+per-element positions, orientations and sizes. A display of 18 items made of
+2 images costs 2 draw calls, the same as a display of 2 items.
+
+ElementArrayStim only needs the standard OpenGL pipeline that psychopy
+already uses, so this also runs on software OpenGL (e.g. Mesa llvmpipe) for
+headless testing.
+
+Classes:
+SearchArrayRenderer -- Keeps one ElementArrayStim per texture and draws
+    search arrays with them.
+"""
+
+import numpy as np
+
+import psychopy.visual
+
+
+class SearchArrayRenderer:
+    """Draws search arrays with one ElementArrayStim per texture.
+
+    Each ElementArrayStim is allocated with room for capacity elements. Unused
+    elements are hidden with an opacity of 0, and the array is rebuilt with
+    a larger capacity if a display needs more items.
+
+    Parameters:
+    window -- The psychopy window the arrays are drawn in.
+    size -- The default size of each item in window units (a number or [w, h]).
+    capacity -- The number of elements initially allocated per texture.
+    units -- The units for positions and sizes (default is the window units).
+    Additional keyword arguments are sent to psychopy.visual.ElementArrayStim().
+
+    Methods:
+    add_texture -- names a texture (e.g. an image array) so draw can refer to it by name.
+    draw -- draws a search array.
+    draw_prepared -- draws a search array computed with prepare.
+    preload -- creates the element arrays for a list of textures.
+    prepare -- computes the element values of a search array (no OpenGL or shared state, thread safe).
+    upload -- creates the element arrays a prepared search array needs.
+    """
+
+    def __init__(self, window, size, capacity=18, units=None, **kwargs):
+        self.window = window
+        self.size = size
+        self.capacity = capacity
+        self.units = units if units is not None else window.units
+        self.stim_kwargs = kwargs
+        self.arrays = {}
+        self.textures = {}
+
+    def _cycles_per_unit(self, sizes):
+        """Returns the spatial frequencies that show each texture exactly once per element."""
+        if self.units in ['norm', 'pix', 'height']:
+            return np.ones_like(sizes)  # cycles per element
+        return 1.0 / sizes  # cycles per unit
+
+    def _make_array(self, texture, capacity):
+        return psychopy.visual.ElementArrayStim(
+            self.window, units=self.units, nElements=capacity,
+            elementTex=self.textures.get(texture, texture),
+            elementMask=None, xys=np.zeros((capacity, 2)), sizes=self.size,
+            opacities=np.zeros(capacity), interpolate=True, **self.stim_kwargs)
+
+    def _get_array(self, texture, n):
+        array = self.arrays.get(texture)
+        if array is None or array.nElements < n:
+            array = self._make_array(texture, max(n, self.capacity))
+            self.arrays[texture] = array
+        return array
+
+    def add_texture(self, name, texture):
+        """Names a texture that is not an image file, e.g. a derived image variant.
+
+        Parameters:
+        name -- The name to use for the texture in draw and preload.
+        texture -- Anything ElementArrayStim accepts as elementTex (e.g. a PIL image).
+        """
+        self.textures[name] = texture
+        self.arrays.pop(name, None)
+
+    def preload(self, textures):
+        """Creates the element arrays up front so no texture is loaded mid-trial.
+
+        Parameters:
+        textures -- An iterable of image paths (or anything ElementArrayStim accepts as elementTex).
+        """
+        for texture in textures:
+            self._get_array(texture, self.capacity)
+
+    def prepare(self, positions, textures, oris=0, sizes=None):
+        """Computes the per-texture element values of a search array without touching OpenGL, so it
+        can run on a background thread. Returns the state to pass to upload and draw_prepared.
+
+        Parameters:
+        positions -- A list of x,y positions in window units, one per item.
+        textures -- A list of image paths (or names given to add_texture), one per item.
+        oris -- The rotation of each item in degrees (a number or one per item).
+        sizes -- The size of the items (a number, [w, h] or one [w, h] per item). Defaults to size.
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        n_items = len(positions)
+        oris = np.broadcast_to(np.asarray(oris, dtype=float), (n_items,))
+        sizes = np.asarray(self.size if sizes is None else sizes, dtype=float)
+        if sizes.ndim < 2:
+            sizes = np.broadcast_to(sizes, (n_items, 2))
+
+        texture_names, texture_index = np.unique(np.asarray(textures, dtype=str),
+                                                 return_inverse=True)
+
+        prepared = []
+        for i, texture in enumerate(texture_names):
+            items = np.flatnonzero(texture_index == i)
+            prepared.append((str(texture), positions[items], oris[items], sizes[items]))
+        return prepared
+
+    def upload(self, prepared, resolve=None):
+        """Creates (on the main thread) any element arrays and textures a prepared array needs.
+
+        prepare runs on a background thread and so must not change textures or arrays; textures
+        that still have to be named with add_texture are added here, through resolve.
+
+        Parameters:
+        prepared -- The state returned by prepare.
+        resolve -- An optional function called with every texture name before its array is made,
+            e.g. to add_texture a derived image the first time it is used.
+        """
+        for texture, xys, _, _ in prepared:
+            if resolve is not None:
+                resolve(texture)
+            self._get_array(texture, len(xys))
+
+    def draw_prepared(self, prepared):
+        """Draws a search array from the state returned by prepare. Does not flip the window.
+
+        Parameters:
+        prepared -- The state returned by prepare.
+        """
+        for texture, item_xys, item_oris, item_sizes in prepared:
+            n_items = len(item_xys)
+            array = self._get_array(texture, n_items)
+            n_elements = array.nElements
+
+            xys = np.zeros((n_elements, 2))
+            xys[:n_items] = item_xys
+            element_oris = np.zeros(n_elements)
+            element_oris[:n_items] = item_oris
+            element_sizes = np.ones((n_elements, 2))
+            element_sizes[:n_items] = item_sizes
+            opacities = np.zeros(n_elements)
+            opacities[:n_items] = 1
+
+            array.xys = xys
+            array.oris = element_oris
+            array.sizes = element_sizes
+            array.sfs = self._cycles_per_unit(element_sizes)
+            array.opacities = opacities
+            array.draw()
+
+    def draw(self, positions, textures, oris=0, sizes=None):
+        """Draws every item of a search array. Does not flip the window.
+
+        Parameters:
+        positions -- A list of x,y positions in window units, one per item.
+        textures -- A list of image paths (or names given to add_texture), one per item.
+        oris -- The rotation of each item in degrees (a number or one per item).
+        sizes -- The size of the items (a number, [w, h] or one [w, h] per item). Defaults to size.
+        """
+        self.draw_prepared(self.prepare(positions, textures, oris, sizes))
@@ -0,0 +1,105 @@
+"""Measures how long the experiment takes to import, i.e. until the subject dialog can be shown.
+
+Runs `python -X importtime -c "import visSearch"` in a fresh interpreter and
+reports the total import time and the modules that take the longest, both
+cumulative (with everything they import) and by themselves. Use it to check
+that nothing heavy (pandas, pygame, the audio device, ...) is imported before
+the dialog again.
+
+If this file is run directly, it profiles visSearch (or the module given) from
+the current directory and exits with status 1 if the import takes longer than
+--target seconds (default 1).
+
+Functions:
+parse_importtime -- parses the report written by -X importtime.
+profile_import -- imports a module in a new interpreter and returns its import profile.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+def parse_importtime(report):
+    """Returns a list of (module, depth, self_us, cumulative_us) for every module in the report,
+    in the order they finished importing. depth is 0 for modules imported by the profiled code
+    itself, 1 for the modules they import and so on.
+
+    Parameters:
+    report -- The text -X importtime writes to stderr.
+    """
+    modules = []
+    for line in report.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the column header
+        name = fields[2]
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(fields[0]), int(fields[1])))
+    return modules
+
+
+def profile_import(module='visSearch', python=sys.executable, cwd=None):
+    """Imports module in a new interpreter and returns a dict with its import profile.
+
+    The dict holds the wall time of the whole interpreter run (wall_s), the time spent importing
+    (import_s) and the parsed modules (see parse_importtime).
+
+    Parameters:
+    module -- The name of the module to import.
+    python -- The Python interpreter to use.
+    cwd -- The directory to run in (default is the current directory).
+    """
+    start = time.perf_counter()
+    result = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=cwd, capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError('Importing %s failed:\n%s' % (module, result.stderr[-2000:]))
+
+    modules = parse_importtime(result.stderr)
+    return {
+        'module': module,
+        'wall_s': wall_s,
+        'import_s': sum(cumulative for _, depth, _, cumulative in modules if depth == 0) / 1e6,
+        'modules': modules,
+    }
+
+
+def _print_report(profile, top):
+    print('import %s: %.3f s importing, %.3f s wall' % (
+        profile['module'], profile['import_s'], profile['wall_s']))
+
+    print('\nslowest modules with what they import (cumulative ms):')
+    for name, depth, _, cumulative in sorted(profile['modules'], key=lambda m: -m[3])[:top]:
+        print('%10.1f  %s%s' % (cumulative / 1000, '  ' * min(depth, 10), name))
+
+    print('\nslowest modules by themselves (self ms):')
+    for name, _, self_us, _ in sorted(profile['modules'], key=lambda m: -m[2])[:top]:
+        print('%10.1f  %s' % (self_us / 1000, name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the import time of the experiment.')
+    parser.add_argument('module', nargs='?', default='visSearch')
+    parser.add_argument('--target', type=float, default=1.0,
+                        help='the longest acceptable import time in seconds')
+    parser.add_argument('--top', type=int, default=20, help='the number of modules to list')
+    parser.add_argument('--json', action='store_true', help='print the profile as json')
+    args = parser.parse_args()
+
+    profile = profile_import(args.module)
+    if args.json:
+        print(json.dumps(profile, indent=2))
+    else:
+        _print_report(profile, args.top)
+
+    if profile['import_s'] > args.target:
+        print('\n%s takes %.3f s to import, over the %.3f s target.' % (
+            args.module, profile['import_s'], args.target))
+        sys.exit(1)
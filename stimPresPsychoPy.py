@@ -3,6 +3,8 @@
 ############################
 import numpy
 import glob, os, random, sys, gc, time
+import coordinates
+import textcache
 
 try:
 	import winsound
@@ -62,25 +64,13 @@ def randomButNot(arr, index):
 
 
 def polarToRect(angleList, radius):
-	coords = []
-	for curAngle in angleList:
-		radAngle = (float(curAngle) * 2.0 * pi) / 360.0
-		xCoord = round(float(radius) * cos(radAngle), 0)
-		yCoord = round(float(radius) * sin(radAngle), 0)
-		coords.append([xCoord, yCoord])
-	return coords
+	"""Returns [x,y] (rounded to whole units) for each angle (in degrees) on a circle of radius; see coordinates.polar for the array version"""
+	return coordinates.polar(angleList, radius).tolist()
 
 
 def calculateRectangularCoordinates(distanceX, distanceY, numCols, numRows):
-	coord = [[0, 0]] * numCols * numRows
-	curObj = 0
-	for curCol in range(0, numCols):  # x-coord
-		for curRow in range(0, numRows):  # y-coord
-			coord[curObj] = (curCol * distanceX, curRow * distanceY)
-			curObj = curObj + 1
-	xCorrect = max(map(lambda x: x[0], coord)) / 2
-	yCorrect = max(map(lambda x: x[1], coord)) / 2
-	return map(lambda x: [x[0] - xCorrect, x[1] - yCorrect], coord)
+	"""Returns [x,y] for each cell of a grid centered on 0,0, column by column; see coordinates.grid for the array version"""
+	return coordinates.grid(distanceX, distanceY, numCols, numRows).tolist()
 
 
 def setAndPresentStimulus(win, stimuli, duration=0):
@@ -143,15 +133,12 @@ def newRect(win, size=[0, 0], pos=[0, 0], color="gray"):
 
 def playAndWait(sound, soundPath='', winSound=False, waitFor=-1):
 	"""Sound (other than winSound) runs on a separate thread. Waitfor controls how long to pause before resuming. -1 for length of sound"""
-	print("Audiolib:", prefs.hardware['audioLib'])
-
 	if not winSoundLoaded:
 		winSound = False
 	if prefs.hardware['audioLib'] == ['pygame']:
 		# default to using winsound
 		winSound = True
 	if winSound:
-		print('using winsound to play sound')
 		if waitFor != 0:
 			winsound.PlaySound(sound, winsound.SND_MEMORY)
 		else:  # playing asynchronously - need to load the path.
@@ -192,7 +179,7 @@ def showText(win, textToShow, color=[-1, -1, -1], waitForKey=True, acceptOnly=0,
 		wrapWidth = 30
 	else:
 		wrapWidth = None
-	textStim = visual.TextStim(win, pos=pos, wrapWidth=wrapWidth, color=color, height=height, text=textToShow)
+	textStim = textcache.get_text(win, textToShow, pos=pos, wrapWidth=wrapWidth, color=color, height=height)
 	textStim.draw()
 	win.flip()
 	if mouse:
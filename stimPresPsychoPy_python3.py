@@ -3,6 +3,8 @@
 ############################
 import numpy
 import glob,os,random,sys,gc,time
+import coordinates
+import textcache
 from math import *
 from psychopy import core,event,data,info,prefs
 
@@ -68,26 +70,13 @@ def randomButNot (arr, index):
 	return arr[randIndex]
 	
 def polarToRect(angleList,radius):
-	coords=[]
-	for curAngle in angleList:
-		radAngle = (float(curAngle)*2.0*pi)/360.0
-		xCoord = round(float(radius)*cos(radAngle),0)
-		yCoord = round(float(radius)*sin(radAngle),0)
-		coords.append([xCoord,yCoord])
-	return coords
+	"""Returns [x,y] (rounded to whole units) for each angle (in degrees) on a circle of radius; see coordinates.polar for the array version"""
+	return coordinates.polar(angleList,radius).tolist()
 
 	
 def	calculateRectangularCoordinates(distanceX, distanceY, numCols, numRows,yOffset=0,xOffset=0):
-	coords = [[0,0]]*numCols*numRows
-	curObj=0
-	for curCol in range(0,numCols): #x-coord
-		for curRow in range(0,numRows): #y-coord
-			coords[curObj]= (curCol*distanceX, curRow*distanceY)
-			curObj=curObj+1
-	xCorrected = max([coord[0] for coord in coords])/2 -xOffset
-	yCorrected = max([coord[1] for coord in coords])/2 -yOffset
-
-	return [(coord[0]-xCorrected, coord[1]-yCorrected) for coord in coords]
+	"""Returns (x,y) for each cell of a grid centered on 0,0 (then moved by the offsets), column by column; see coordinates.grid for the array version"""
+	return [tuple(coord) for coord in coordinates.grid(distanceX,distanceY,numCols,numRows,xOffset,yOffset).tolist()]
 	
 	
 def setAndPresentStimulus(win,stimuli,duration=0):
@@ -153,7 +142,6 @@ def playAndWait(sound,soundPath='',winSound=False,waitFor=-1):
                 #default to using winsound
                 winSound=True
 	if winSound:
-		print ('using winsound to play sound')
 		if waitFor != 0:
 			winsound.PlaySound(sound,winsound.SND_MEMORY)
 		else: #playing asynchronously - need to load the path.
@@ -177,7 +165,6 @@ def playAndWait(sound,soundPath='',winSound=False,waitFor=-1):
 			return
 		else:
 			sound.play()
-			print ('returning right away')
 			return
 
 def showText(win,textToShow,color=[-1,-1,-1],waitForKey=True,acceptOnly=0,inputDevice="keyboard",mouse=False,pos=[0,0],scale=1,font="NA"):
@@ -193,9 +180,9 @@ def showText(win,textToShow,color=[-1,-1,-1],waitForKey=True,acceptOnly=0,inputD
 	else:
 		wrapWidth=None
 	if font!= "NA":
-		textStim = visual.TextStim(win, pos=pos,wrapWidth=wrapWidth,color=color,height=height,text=textToShow,font=font)
+		textStim = textcache.get_text(win,textToShow,pos=pos,wrapWidth=wrapWidth,color=color,height=height,font=font)
 	else:
-		textStim = visual.TextStim(win, pos=pos,wrapWidth=wrapWidth,color=color,height=height,text=textToShow)	
+		textStim = textcache.get_text(win,textToShow,pos=pos,wrapWidth=wrapWidth,color=color,height=height)
 	textStim.draw()
 	win.flip()
 	if mouse:
@@ -0,0 +1,395 @@
+"""Packs a folder of stimulus images into one texture atlas.
+
+Every image stimulus is normally its own texture, so each draw in a frame
+binds a different texture. build_atlas packs all the images of a folder into
+one atlas image (shelf packing: images sorted by height are placed left to
+right on rows) and writes a json index with the pixel rectangle and the UV
+rectangle of every image. AtlasStim draws one image of the atlas as a
+textured quad, and draw_many draws any number of them with a single texture
+bind. The atlas width and height are powers of two.
+
+baseDefsPsychoPy.loadFiles(..., fileType='atlas') builds (or reuses) the atlas
+for a folder and returns AtlasStims by name like the 'image' file type.
+
+If this file is run directly, it builds the atlas for a folder, e.g.
+    python stimatlas.py stimuli/visual .stimcache/visual_atlas.png
+
+Classes:
+Atlas -- The index of an atlas: names, pixel sizes and UV rectangles.
+AtlasStim -- Draws one image of an atlas.
+
+Functions:
+atlas_is_stale -- Checks if the images in a folder changed since the atlas was built.
+build_atlas -- Packs the images of a folder into an atlas image and a json index.
+draw_many -- Draws several images of an atlas with one texture bind.
+load_atlas -- Reads the json index of an atlas.
+"""
+
+import argparse
+import ctypes
+import glob
+import json
+import math
+import os
+
+import numpy as np
+import PIL.Image
+
+atlas_version = 1
+image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp']
+
+
+def _next_power_of_two(n):
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+
+def _index_filename(atlas_filename):
+    return os.path.splitext(atlas_filename)[0] + '.json'
+
+
+def _source_files(directory, extensions):
+    files = []
+    for extension in extensions:
+        files.extend(glob.glob(os.path.join(directory, '*' + extension)))
+    return sorted(files)
+
+
+def _source_info(path):
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'mtime_ns': stat.st_mtime_ns, 'bytes': stat.st_size}
+
+
+def _shelf_pack(sizes, width, padding):
+    """Places rectangles of sizes (w, h) on shelves of the given width.
+
+    Returns a list of (x, y) positions (in the order of sizes) and the total height.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+
+    for i in order:
+        w, h = sizes[i][0] + 2 * padding, sizes[i][1] + 2 * padding
+        if x + w > width:  # start a new shelf
+            y += shelf_height
+            x = shelf_height = 0
+        positions[i] = (x + padding, y + padding)
+        x += w
+        shelf_height = max(shelf_height, h)
+
+    return positions, y + shelf_height
+
+
+def build_atlas(directory, atlas_filename, extensions=image_extensions, padding=2,
+                max_width=4096):
+    """Packs every image in directory into one RGBA atlas image and writes its json index.
+
+    Returns the Atlas.
+
+    Parameters:
+    directory -- The folder with the stimulus images. Each image is named by its file name
+        without the extension.
+    atlas_filename -- The atlas image (.png). The index is written next to it with a .json
+        extension.
+    extensions -- The image file extensions to include.
+    padding -- Pixels of transparent border around each image, so neighbours never bleed in
+        when the texture is filtered.
+    max_width -- The largest allowed atlas width in pixels.
+    """
+    files = _source_files(directory, extensions)
+    if not files:
+        raise ValueError('No images with extensions %s in %s' % (extensions, directory))
+
+    images = []
+    for path in files:
+        with PIL.Image.open(path) as image:
+            images.append(image.convert('RGBA'))
+    sizes = [image.size for image in images]
+
+    # Start from a square estimate and widen the atlas until everything fits in a square-ish area
+    area = sum((w + 2 * padding) * (h + 2 * padding) for w, h in sizes)
+    widest = max(w for w, _ in sizes) + 2 * padding
+    width = _next_power_of_two(max(widest, math.sqrt(area)))
+    positions, height = _shelf_pack(sizes, width, padding)
+    while height > width and width < max_width:
+        width *= 2
+        positions, height = _shelf_pack(sizes, width, padding)
+    if width > max_width:
+        raise ValueError('The images in %s do not fit in an atlas %d pixels wide.' % (
+            directory, max_width))
+    height = _next_power_of_two(height)
+
+    atlas = PIL.Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    rects = {}
+    for path, image, (x, y) in zip(files, images, positions):
+        atlas.paste(image, (x, y))
+        w, h = image.size
+        name = os.path.splitext(os.path.basename(path))[0]
+        rects[name] = {
+            'x': x, 'y': y, 'w': w, 'h': h,
+            # u0, v0, u1, v1 with v measured from the bottom like OpenGL texture coordinates
+            'uv': [x / width, 1 - (y + h) / height, (x + w) / width, 1 - y / height],
+        }
+
+    index = {
+        'version': atlas_version,
+        'image': os.path.basename(atlas_filename),
+        'size': [width, height],
+        'directory': os.path.abspath(directory),
+        'sources': [_source_info(path) for path in files],
+        'rects': rects,
+    }
+
+    atlas_directory = os.path.dirname(os.path.abspath(atlas_filename))
+    os.makedirs(atlas_directory, exist_ok=True)
+
+    # Write to temporary files first so a crash never leaves a half written atlas
+    atlas.save(atlas_filename + '.tmp', format='PNG')
+    os.replace(atlas_filename + '.tmp', atlas_filename)
+    index_filename = _index_filename(atlas_filename)
+    with open(index_filename + '.tmp', 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    os.replace(index_filename + '.tmp', index_filename)
+
+    return Atlas(index, atlas_filename)
+
+
+def atlas_is_stale(directory, atlas_filename, extensions=image_extensions):
+    """Returns True if the atlas or its index is missing, or any image in directory was added,
+    removed or changed since the atlas was built.
+
+    Parameters:
+    directory -- The folder with the stimulus images.
+    atlas_filename -- The atlas image (.png).
+    extensions -- The image file extensions to include.
+    """
+    index_filename = _index_filename(atlas_filename)
+    if not (os.path.isfile(atlas_filename) and os.path.isfile(index_filename)):
+        return True
+
+    with open(index_filename) as index_file:
+        try:
+            index = json.load(index_file)
+        except ValueError:
+            return True
+
+    return (index.get('version') != atlas_version or
+            index.get('sources') != [_source_info(path)
+                                     for path in _source_files(directory, extensions)])
+
+
+def load_atlas(atlas_filename):
+    """Reads the json index of an atlas and returns the Atlas.
+
+    Parameters:
+    atlas_filename -- The atlas image (.png).
+    """
+    with open(_index_filename(atlas_filename)) as index_file:
+        return Atlas(json.load(index_file), atlas_filename)
+
+
+class Atlas:
+    """The index of a texture atlas.
+
+    Parameters:
+    index -- The dict written by build_atlas.
+    filename -- The atlas image (.png).
+
+    Attributes:
+    names -- The image names, in the order of the rows of pixel_sizes and uvs.
+    pixel_sizes -- An (n, 2) array with the width and height of each image in pixels.
+    uvs -- An (n, 4) float32 array with the u0, v0, u1, v1 rectangle of each image.
+
+    Methods:
+    lookup -- returns the row of an image name.
+    """
+
+    def __init__(self, index, filename):
+        self.filename = filename
+        self.size = tuple(index['size'])
+        self.names = sorted(index['rects'])
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        rects = [index['rects'][name] for name in self.names]
+        self.pixel_sizes = np.array([[rect['w'], rect['h']] for rect in rects], dtype=float)
+        self.uvs = np.array([rect['uv'] for rect in rects], dtype=np.float32)
+
+    def lookup(self, name):
+        """Returns the row of name in pixel_sizes and uvs.
+
+        Parameters:
+        name -- The image name (the file name without the extension).
+        """
+        try:
+            return self.rows[name]
+        except KeyError:
+            raise KeyError('%s is not in the atlas %s' % (name, self.filename))
+
+
+_textures = {}  # (window id, atlas file) -> OpenGL texture id
+
+
+def _atlas_texture(window, atlas):
+    """Returns the OpenGL texture of atlas for window, uploading it on first use."""
+    import pyglet.gl as GL
+
+    key = (id(window), os.path.abspath(atlas.filename))
+    if key in _textures:
+        return _textures[key]
+
+    with PIL.Image.open(atlas.filename) as image:
+        # OpenGL expects the first row at the bottom
+        pixels = image.convert('RGBA').transpose(PIL.Image.FLIP_TOP_BOTTOM).tobytes()
+
+    window.backend.setCurrent()
+    texture = GL.GLuint()
+    GL.glGenTextures(1, ctypes.byref(texture))
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, atlas.size[0], atlas.size[1], 0,
+                    GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, pixels)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    _textures[key] = texture
+    return texture
+
+
+def _to_pix(window, units, pos, size):
+    """Converts positions and sizes (arrays of x, y) from units to pixels."""
+    from psychopy.tools.monitorunittools import convertToPix
+
+    pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+    size = np.asarray(size, dtype=float).reshape(-1, 2)
+    return (convertToPix(np.zeros_like(pos), pos, units, window),
+            convertToPix(size, np.zeros(2), units, window))
+
+
+def draw_many(window, atlas, names, positions, oris=0, sizes=None, units=None, opacity=1.0,
+              flip_horiz=False, flip_vert=False):
+    """Draws several images of an atlas as textured quads with one texture bind.
+
+    Does not flip the window.
+
+    Parameters:
+    window -- The psychopy window.
+    atlas -- The Atlas.
+    names -- The image name of each item.
+    positions -- The x, y position of each item in units.
+    oris -- The clockwise rotation of each item in degrees (a number or one per item).
+    sizes -- The size of each item in units (a number, [w, h] or one [w, h] per item). Defaults to
+        the image size in pixels.
+    units -- The units of positions and sizes (default is the window units).
+    opacity -- The opacity of every item.
+    flip_horiz -- Whether to mirror each item left to right (a bool or one per item).
+    flip_vert -- Whether to mirror each item upside down (a bool or one per item).
+    """
+    import pyglet.gl as GL
+
+    units = window.units if units is None else units
+    rows = [atlas.lookup(name) for name in names]
+    n_items = len(rows)
+    if n_items == 0:
+        return
+
+    if sizes is None:
+        pos_pix, _ = _to_pix(window, units, positions, np.zeros((n_items, 2)))
+        size_pix = atlas.pixel_sizes[rows]
+    else:
+        sizes = np.asarray(sizes, dtype=float)
+        if sizes.ndim < 2:
+            sizes = np.broadcast_to(sizes, (n_items, 2))
+        pos_pix, size_pix = _to_pix(window, units, positions, sizes)
+
+    # A negative width or height mirrors the quad, and so the texture on it
+    size_pix = size_pix * np.stack([
+        np.where(np.broadcast_to(flip_horiz, (n_items,)), -1, 1),
+        np.where(np.broadcast_to(flip_vert, (n_items,)), -1, 1)], axis=1)
+    theta = np.radians(np.broadcast_to(np.asarray(oris, dtype=float), (n_items,)))
+    cos, sin = np.cos(theta), np.sin(theta)
+    # corners in the order of the uv rectangle: (u0, v0), (u1, v0), (u1, v1), (u0, v1)
+    corners = np.array([[-.5, -.5], [.5, -.5], [.5, .5], [-.5, .5]])
+    uvs = atlas.uvs[rows]
+    uv_corners = [(0, 1), (2, 1), (2, 3), (0, 3)]
+
+    texture = _atlas_texture(window, atlas)
+
+    GL.glPushMatrix()
+    window.setScale('pix')
+    GL.glUseProgram(0)
+    GL.glEnable(GL.GL_TEXTURE_2D)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+    GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE, GL.GL_MODULATE)
+    GL.glColor4f(1, 1, 1, opacity)
+    GL.glBegin(GL.GL_QUADS)
+    for i in range(n_items):
+        for (cx, cy), (u, v) in zip(corners * size_pix[i], uv_corners):
+            GL.glTexCoord2f(uvs[i, u], uvs[i, v])
+            # psychopy orientations are clockwise
+            GL.glVertex2f(pos_pix[i, 0] + cx * cos[i] + cy * sin[i],
+                          pos_pix[i, 1] - cx * sin[i] + cy * cos[i])
+    GL.glEnd()
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    GL.glDisable(GL.GL_TEXTURE_2D)
+    GL.glPopMatrix()
+
+
+class AtlasStim:
+    """Draws one image of an atlas. Can be used in place of an ImageStim for pos, ori, size and
+    opacity.
+
+    Parameters:
+    window -- The psychopy window.
+    atlas -- The Atlas.
+    name -- The image name.
+    pos -- The x, y position in units.
+    ori -- The clockwise rotation in degrees.
+    size -- The size in units (default is the image size in pixels).
+    units -- The units of pos and size (default is the window units).
+    opacity -- The opacity of the image.
+    flipHoriz -- Whether to mirror the image left to right (named like ImageStim's).
+    flipVert -- Whether to mirror the image upside down (named like ImageStim's).
+    base_ori -- A clockwise rotation in degrees applied before ori, e.g. for a rotated variant
+        of the image (see baseDefsPsychoPy.StimMatrix).
+
+    Methods:
+    draw -- draws the image.
+    setPos -- sets the position.
+    """
+
+    def __init__(self, window, atlas, name, pos=(0, 0), ori=0, size=None, units=None,
+                 opacity=1.0, flipHoriz=False, flipVert=False, base_ori=0):
+        atlas.lookup(name)  # fail early on unknown names
+        self.win = window
+        self.atlas = atlas
+        self.name = name
+        self.pos = pos
+        self.ori = ori
+        self.size = size
+        self.units = window.units if units is None else units
+        self.opacity = opacity
+        self.flipHoriz = flipHoriz
+        self.flipVert = flipVert
+        self.base_ori = base_ori
+
+    def setPos(self, pos):
+        """Sets the position (for code written against ImageStim.setPos)."""
+        self.pos = pos
+
+    def draw(self):
+        """Draws the image. Does not flip the window."""
+        draw_many(self.win, self.atlas, [self.name], [self.pos], self.base_ori + self.ori,
+                  None if self.size is None else [self.size], self.units, self.opacity,
+                  self.flipHoriz, self.flipVert)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a folder of images into a texture atlas.')
+    parser.add_argument('directory', help='folder with the stimulus images')
+    parser.add_argument('atlas_filename', help='atlas image to write (.png)')
+    parser.add_argument('--padding', type=int, default=2)
+    args = parser.parse_args()
+
+    atlas = build_atlas(args.directory, args.atlas_filename, padding=args.padding)
+    print('Packed %d images into a %dx%d atlas' % (len(atlas.names), atlas.size[0], atlas.size[1]))
@@ -25,11 +25,14 @@ BaseExperiment -- All experiments inherit from BaseExperiment. Provides basic
     functionality needed by all experiments.
     See 'print templateexperiments.BaseExperiment.__doc__' for simple class
     docs or help(templateexperiments.BaseExperiment) for everything.
+StimulusPool -- A cache of ImageStims keyed by image path that are reused
+    by changing their position, orientation and size.
 """
 
+import collections
+import csv
 import json
 import os
-import pickle
 import sys
 
 import psychopy.monitors
@@ -38,6 +41,10 @@ import psychopy.gui
 import psychopy.core
 import psychopy.event
 
+import frametiming
+import journal
+import textcache
+
 
 # Convenience
 def convert_color_value(color):
@@ -57,26 +64,35 @@ class BaseExperiment:
     bg_color -- list of 3 values (0-255) defining the background color
     data_fields -- list of strings defining data fields
     experiment_name -- string defining the experiment title
+    frame_timing_phases -- list of trial phases to record flip timing for, or None
     monitor_distance -- int describing participant distance from monitor in cm
     monitor_name -- name of the monitor to be used
     monitor_px -- list containing monitor resolution (x,y)
     monitor_width -- int describing length of display monitor in cm
 
     Methods:
+    add_journal_record -- appends a record to the crash recovery journal.
+    begin_draw -- marks the start of drawing for the next recorded flip.
+    close_csv_data_file -- saves any remaining data and closes the csv data file.
     display_text_screen -- draws a string centered on the screen.
+    flip -- flips the window, recording the flip timing if enabled.
     get_experiment_info_from_dialog -- gets subject info from a dialog box.
+    journal_filename -- returns the name of the crash recovery journal.
     open_csv_data_file -- opens a csv data file and writes the header.
     open_window -- open a psychopy window.
+    open_journal -- open the crash recovery journal.
     quit_experiment -- ends the experiment.
-    save_data_to_csv -- append new entries in experiment_data to csv data file.
+    recover_from_journal -- restore the state saved before a crash.
+    save_data_to_csv -- makes the rows written to the csv data file durable.
     save_experiment_info -- write the info from the dialog box to a text file.
-    save_experiment_pickle -- save a pickle so crashes can be recovered from.
-    update_experiment_data -- extends any new data to the experiment_data list.
+    save_checkpoint -- save the settings needed to recover from a crash.
+    update_experiment_data -- adds new data and writes it to the csv data file.
     """
 
     def __init__(self, experiment_name, data_fields, bg_color=[128, 128, 128],
                  monitor_name='Experiment Monitor', monitor_width=53,
-                 monitor_distance=70, monitor_px=[1920, 1080], **kwargs):
+                 monitor_distance=70, monitor_px=[1920, 1080], frame_timing_phases=None,
+                 **kwargs):
         """Creates a new BaseExperiment object.
 
         Parameters:
@@ -85,6 +101,10 @@ class BaseExperiment:
         data_fields -- list of strings containing the data fields to be stored
         experiment_name -- A string for the experiment title that also defines
             the filename the experiment info from the dialog box is saved to.
+        frame_timing_phases -- An optional list of the trial phases (e.g.
+            ['blank', 'search']) whose flips are recorded. If given, the timing
+            columns from frametiming.trial_fields are added to data_fields and
+            a timing summary is saved when the experiment ends.
         monitor_distance -- An int describing the distance the participant sits
             from the monitor in cm (default 70).
         monitor_name -- The name of the monitor to be used
@@ -98,19 +118,32 @@ class BaseExperiment:
 
         self.experiment_name = experiment_name
         self.data_fields = data_fields
+        self.frame_timing_phases = frame_timing_phases
+        if frame_timing_phases is not None:
+            self.data_fields = data_fields + frametiming.trial_fields(frame_timing_phases)
         self.bg_color = convert_color_value(bg_color)
         self.monitor_name = monitor_name
         self.monitor_width = monitor_width
         self.monitor_distance = monitor_distance
         self.monitor_px = monitor_px
 
+        # experiment_data only holds the rows that are not yet saved to disk,
+        # unless keep_experiment_data is True (e.g. to write them elsewhere too)
         self.experiment_data = []
         self.experiment_data_filename = None
         self.data_lines_written = 0
+        self.data_lines_evicted = 0
+        self.keep_experiment_data = False
+        self.data_file = None
+        self.data_writer = None
+        self.journal = None
         self.experiment_info = {}
         self.experiment_window = None
+        self.flip_timer = None
+        self.background_rect = None
 
         self.overwrite_ok = None
+        self.resume_ok = None
 
         self.experiment_monitor = psychopy.monitors.Monitor(
             self.monitor_name, width=self.monitor_width,
@@ -138,6 +171,27 @@ class BaseExperiment:
 
         return overwrite_dlg.OK
 
+    @staticmethod
+    def _confirm_resume(trials_done, screen=0):
+        """Private, static method that shows a dialog asking if an unfinished
+        session should be continued.
+
+        Returns a bool describing if the session should be continued.
+
+        Parameters:
+        trials_done -- the number of trials the unfinished session ran
+        screen -- an int describing the screen you want the dialog to appear on
+        """
+
+        resume_dlg = psychopy.gui.Dlg(
+            'Continue?', labelButtonOK='Continue',
+            labelButtonCancel='Start Over', screen=screen)
+        resume_dlg.addText('This subject has an unfinished session (%d trials '
+                           'run). Continue it?' % trials_done)
+        resume_dlg.show()
+
+        return resume_dlg.OK
+
     def get_experiment_info_from_dialog(self, additional_fields_dict=None, screen=0):
         """Gets subject info from dialog box.
 
@@ -231,58 +285,107 @@ class BaseExperiment:
 
         self.experiment_data_filename = data_filename + '.csv'
 
-        # Write the header
-        with open(self.experiment_data_filename, 'w+') as data_file:
-            for field in self.data_fields:
-                data_file.write('"')
-                data_file.write(field)
-                data_file.write('"')
-                if field != self.data_fields[-1]:
-                    data_file.write(',')
-            data_file.write('\n')
+        # The file stays open for the whole session; rows are appended as they arrive
+        self._open_data_writer('w')
+        self.data_writer.writerow(self.data_fields)
+        self.data_file.flush()
+
+    def _open_data_writer(self, mode):
+        self.data_file = open(self.experiment_data_filename, mode, newline='')
+        self.data_writer = csv.writer(self.data_file, quoting=csv.QUOTE_ALL,
+                                      lineterminator='\n')
+
+    def _write_new_rows(self):
+        """Writes the rows of experiment_data that are not in the file yet."""
+        first = self.data_lines_written - self.data_lines_evicted
+        fields = self.data_fields
+        self.data_writer.writerows(
+            [str(row[field]) if field in row else 'NA' for field in fields]
+            for row in self.experiment_data[first:])
+        self.data_lines_written = self.data_lines_evicted + len(self.experiment_data)
 
     def update_experiment_data(self, new_data):
-        """Extends any new data to the experiment_data list.
+        """Adds new data to experiment_data and writes it to the csv file.
+
+        The rows are written to the open file right away, but only become
+        durable (and are dropped from experiment_data) in save_data_to_csv().
 
         Parameters:
         new_data -- A list of dictionaries that are extended to
-            experiment_data. Only keys that are included in data_fields should
-            be included, as only those will be written in save_data_to_csv()
+            experiment_data. Only keys that are included in data_fields will
+            be written; missing fields are written as NA.
         """
         if not isinstance(new_data, list):
             raise TypeError('Experiment data must be type list.')
 
         self.experiment_data.extend(new_data)
+        if self.data_writer is not None:
+            self._write_new_rows()
+        for row in new_data:
+            self.add_journal_record('data', data=row)
 
     def save_data_to_csv(self):
-        """Opens the data file and appends new entries in experiment_data.
+        """Makes every row written to the csv file so far durable.
 
-        Only appends lines (tracked by data_lines_written) that have not yet
-        been written to the csv.
+        Writes any rows not written yet (tracked by data_lines_written), then
+        flushes the file to disk. The saved rows are dropped from
+        experiment_data unless keep_experiment_data is True, so memory does
+        not grow over long sessions.
 
         Update the experiment data to be written with update_experiment_data.
         """
+        if self.data_writer is None or self.data_file.closed:
+            self._open_data_writer('a')
+
+        self._write_new_rows()
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+
+        if not self.keep_experiment_data:
+            del self.experiment_data[:]
+            self.data_lines_evicted = self.data_lines_written
+
+    def close_csv_data_file(self):
+        """Saves any rows not saved yet and closes the csv data file."""
+        if self.data_writer is None or self.data_file.closed:
+            return
+        self.save_data_to_csv()
+        self.data_file.close()
+
+    def journal_filename(self):
+        """Returns the name of the journal file (experimentname_subjectnumber.journal)."""
+        return (self.experiment_name + '_' +
+                self.experiment_info['Subject Number'].zfill(3) + '.journal')
+
+    def open_journal(self):
+        """Starts a new crash recovery journal, replacing any old one.
+
+        From then on every row passed to update_experiment_data is appended
+        to the journal, so saving a trial costs the same however long the
+        session has run. See journal.py.
+        """
+        filename = self.journal_filename()
+        if os.path.isfile(filename):
+            os.remove(filename)
+        self.journal = journal.Journal(filename)
 
-        with open(self.experiment_data_filename, 'a') as data_file:
-            for trial in range(
-                    self.data_lines_written, len(self.experiment_data)):
-                for field in self.data_fields:
-                    data_file.write('"')
-                    try:
-                        data_file.write(
-                            str(self.experiment_data[trial][field]))
-                    except KeyError:
-                        data_file.write('NA')
-                    data_file.write('"')
-                    if field != self.data_fields[-1]:
-                        data_file.write(',')
-                data_file.write('\n')
-
-        self.data_lines_written = len(self.experiment_data)
-
-    def save_experiment_pickle(self, additional_fields_dict=None):
-        """Saves the pickle containing the experiment data so that a crash can
-        be recovered from.
+    def add_journal_record(self, record_type, **fields):
+        """Appends a record to the journal if one is open.
+
+        Parameters:
+        record_type -- A string stored as the 'type' of the record (e.g.
+            'data' for the rows of update_experiment_data).
+        Additional keyword arguments are stored in the record.
+        """
+        if self.journal is None:
+            return
+        record = {'type': record_type}
+        record.update(fields)
+        self.journal.append(record)
+
+    def save_checkpoint(self, additional_fields_dict=None):
+        """Saves the settings needed to recover from a crash next to the
+        journal. The data itself is in the journal.
 
         This method uses dict.update() so if any keys in the
         additional_fields_dict are in the default dictionary the new values
@@ -290,39 +393,101 @@ class BaseExperiment:
 
         Parameters:
         additional_fields_dict -- An optional dictionary that updates the
-            dictionary that is saved in the pickle file.
+            dictionary that is saved in the checkpoint (e.g. {'finished': True}
+            once the experiment is complete).
         """
 
-        pickle_dict = {
+        checkpoint_dict = {
             'experiment_name': self.experiment_name,
             'data_fields': self.data_fields,
             'bg_color': self.bg_color,
             'monitor_name': self.monitor_name,
             'monitor_width': self.monitor_width,
             'monitor_distance': self.monitor_distance,
-            'experiment_data': self.experiment_data,
             'experiment_data_filename': self.experiment_data_filename,
-            'data_lines_written': self.data_lines_written,
             'experiment_info': self.experiment_info,
+            'finished': False,
         }
 
         if additional_fields_dict is not None:
-            pickle_dict.update(additional_fields_dict)
+            checkpoint_dict.update(additional_fields_dict)
+
+        journal.write_checkpoint(self.journal_filename(), checkpoint_dict)
+
+    def recover_from_journal(self):
+        """Restores the state of an experiment that did not finish.
+
+        Uses the journal of the current subject (so experiment_info must be
+        filled in). Unless resume_ok is set, the experimenter is asked first
+        whether to continue the session. The csv data file is rewritten from
+        the journal and both are reopened to append to.
+
+        Returns the list of journal records, or None if there is nothing to
+        recover or the session should start over.
+        """
+        filename = self.journal_filename()
+        checkpoint = journal.read_checkpoint(filename)
+        if checkpoint is None or checkpoint['finished']:
+            return None
+
+        records = journal.read_records(filename)
+        if self.resume_ok is None:
+            self.resume_ok = self._confirm_resume(
+                sum(record['type'] == 'data' for record in records))
+        if not self.resume_ok:
+            return None
+
+        self.experiment_info = checkpoint['experiment_info']
+        self.experiment_data_filename = checkpoint['experiment_data_filename']
+        self.experiment_data = [record['data'] for record in records
+                                if record['type'] == 'data']
+        self.data_lines_written = 0
+        self.data_lines_evicted = 0
 
-        pickle_filename = (self.experiment_name + '_' +
-                           self.experiment_info['Subject Number'].zfill(3) + '.pickle')
+        self._open_data_writer('w')
+        self.data_writer.writerow(self.data_fields)
+        self.save_data_to_csv()
 
-        with open(pickle_filename, 'wb+') as pickle_file:
-            pickle.dump(pickle_dict, pickle_file)
+        # Rewrite the journal without a record the crash may have cut off
+        self.open_journal()
+        self.journal.extend(records)
+
+        return records
 
     def open_window(self, **kwargs):
         """Opens the psychopy window.
 
-        Additional keyword arguments are sent to psychopy.visual.Window().
+        Additional keyword arguments are sent to psychopy.visual.Window() and
+        override the defaults (e.g. fullscr=False for a windowed run).
         """
-        self.experiment_window = psychopy.visual.Window(
+        window_kwargs = dict(
             monitor=self.experiment_monitor, fullscr=True, color=self.bg_color,
-            colorSpace='rgb', units='deg', allowGUI=False, **kwargs)
+            colorSpace='rgb', units='deg', allowGUI=False)
+        window_kwargs.update(kwargs)
+        self.experiment_window = psychopy.visual.Window(**window_kwargs)
+        self.flip_timer = frametiming.FlipTimer(
+            self.experiment_window, self.frame_timing_phases or [],
+            enabled=self.frame_timing_phases is not None)
+
+    def begin_draw(self, phase=None):
+        """Marks the start of drawing for the next recorded flip.
+
+        Parameters:
+        phase -- The phase about to be drawn.
+        """
+        if self.flip_timer is not None:
+            self.flip_timer.begin(phase)
+
+    def flip(self, phase=None):
+        """Flips the window. Returns the flip timestamp.
+
+        Parameters:
+        phase -- The trial phase this flip starts. Recorded if frame timing is
+            enabled.
+        """
+        if self.flip_timer is None:
+            return self.experiment_window.flip()
+        return self.flip_timer.flip(phase)
 
     def display_text_screen(
             self, text='', text_color=[0, 0, 0], text_height=36,
@@ -334,7 +499,8 @@ class BaseExperiment:
         color after any keyboard input.
 
         This works by drawing a rect on top of the background
-        that fills the whole screen with the selected color.
+        that fills the whole screen with the selected color. The rect and the
+        laid-out text are reused between calls (see textcache.py).
 
         Parameters:
         text -- A string containing the text to be displayed.
@@ -355,38 +521,119 @@ class BaseExperiment:
         else:
             bg_color = convert_color_value(bg_color)
 
-        backgroundRect = psychopy.visual.Rect(
-            self.experiment_window, fillColor=bg_color, units='norm', width=2,
-            height=2)
+        if self.background_rect is None:
+            self.background_rect = psychopy.visual.Rect(
+                self.experiment_window, fillColor=bg_color, units='norm',
+                width=2, height=2)
+        else:
+            self.background_rect.fillColor = bg_color
 
         text_color = convert_color_value(text_color)
 
-        textObject = psychopy.visual.TextStim(
-            self.experiment_window, text=text, color=text_color, units='pix',
+        self.background_rect.draw()
+        textcache.draw_text(
+            self.experiment_window, text, color=text_color, units='pix',
             height=text_height, alignHoriz='center', alignVert='center',
             wrapWidth=round(.8*self.experiment_window.size[0]), **kwargs)
-
-        backgroundRect.draw()
-        textObject.draw()
-        self.experiment_window.flip()
+        self.flip('text')
 
         keys = None
 
         if wait_for_input:
             psychopy.core.wait(.2)  # Prevents accidental key presses
             keys = psychopy.event.waitKeys(keyList=keyList)
-            self.experiment_window.flip()
+            self.flip()
 
         return keys
 
     def quit_experiment(self):
         """Completes anything that must occur when the experiment ends."""
+        self.close_csv_data_file()
+        if self.journal is not None:
+            self.journal.close()
+            # Quitting on purpose is not a crash, so the next run must not resume
+            self.save_checkpoint({'finished': True})
+        if self.flip_timer is not None and self.flip_timer.enabled:
+            self.flip_timer.save_summary(
+                self.experiment_name + '_' +
+                self.experiment_info.get('Subject Number', '0').zfill(3) + '_timing.json')
         if self.experiment_window:
             self.experiment_window.close()
         print('The experiment has ended.')
         sys.exit(0)
 
 
+class StimulusPool:
+    """A cache of psychopy ImageStims keyed by image path.
+
+    Each image is decoded and uploaded as a texture once. Drawing the same
+    image several times in a frame reuses the one stim by changing its pos,
+    ori and size before each draw.
+
+    Parameters:
+    window -- The psychopy window the stimuli are drawn in.
+    max_size -- An optional int. If set, the least recently used stimuli are
+        dropped once more than max_size images are cached.
+    Additional keyword arguments are sent to psychopy.visual.ImageStim().
+
+    Methods:
+    draw -- draws the image at a path with the given pos, ori and size.
+    get -- returns the ImageStim for an image path, creating it if needed.
+    preload -- creates the ImageStims for a list of paths.
+    """
+
+    def __init__(self, window, max_size=None, **kwargs):
+        self.window = window
+        self.max_size = max_size
+        self.stim_kwargs = kwargs
+        self.stimuli = collections.OrderedDict()
+
+    def get(self, path):
+        """Returns the ImageStim for path, creating it if it is not cached.
+
+        Parameters:
+        path -- A string containing the path to the image file.
+        """
+        try:
+            self.stimuli.move_to_end(path)
+            return self.stimuli[path]
+        except KeyError:
+            pass
+
+        stim = psychopy.visual.ImageStim(self.window, image=path, **self.stim_kwargs)
+        self.stimuli[path] = stim
+
+        if self.max_size is not None and len(self.stimuli) > self.max_size:
+            self.stimuli.popitem(last=False)
+
+        return stim
+
+    def preload(self, paths):
+        """Creates the ImageStims for all paths so no image is decoded mid-trial.
+
+        Parameters:
+        paths -- An iterable of strings containing paths to image files.
+        """
+        for path in paths:
+            self.get(path)
+
+    def draw(self, path, pos=(0, 0), ori=0, size=None):
+        """Draws the image at path.
+
+        Parameters:
+        path -- A string containing the path to the image file.
+        pos -- The x,y position of the image in window units.
+        ori -- The rotation of the image in degrees.
+        size -- The size of the image in window units (default is unchanged).
+        """
+        stim = self.get(path)
+        stim.pos = pos
+        stim.ori = ori
+        if size is not None:
+            stim.size = size
+        stim.draw()
+
+
 class EyeTrackingEEGExperiment(BaseExperiment):
     def __init__(self, *args, tracker=None, eeg=None, **kwargs):
         super().__init__(*args, **kwargs)
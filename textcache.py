@@ -0,0 +1,109 @@
+"""A least recently used cache of laid-out psychopy TextStims.
+
+Creating a TextStim lays out the text and rasterizes its glyphs, which takes
+several ms every time. Instructions, break screens and the fixation cross
+show the same few strings over and over, so the stims are kept and reused
+instead. A stim is keyed by its window, text and every setting that changes
+the layout (font, height, color, wrapWidth, units, ...). The position is not
+part of the key: it is set before every draw, which does not lay the text out
+again.
+
+template.BaseExperiment, visSearch.Exp and stimPresPsychoPy.showText all
+share the module level cache through get_text and draw_text.
+
+Classes:
+TextCache -- A least recently used cache of TextStims.
+
+Functions:
+draw_text -- draws a string with a stim from the shared cache.
+get_text -- returns a TextStim from the shared cache.
+"""
+
+import collections
+
+import psychopy.visual
+
+cache_size = 64  # the number of TextStims the shared cache keeps
+
+
+def _hashable(value):
+    """Converts lists and arrays (e.g. colors) to tuples so they can be part of a key."""
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class TextCache:
+    """A least recently used cache of TextStims.
+
+    Parameters:
+    max_size -- The number of stims kept. When more are needed, the least recently used one is
+        dropped.
+
+    Methods:
+    clear -- drops every cached stim.
+    draw -- draws a string at a position.
+    get -- returns the TextStim for a string, creating it if needed.
+    """
+
+    def __init__(self, max_size=cache_size):
+        self.max_size = max_size
+        self.stimuli = collections.OrderedDict()
+
+    def get(self, window, text, pos=(0, 0), **kwargs):
+        """Returns a TextStim showing text at pos, creating it only if no cached stim has the same
+        window, text and settings.
+
+        Parameters:
+        window -- The psychopy window the text is drawn in.
+        text -- The string to show.
+        pos -- The x,y position of the text in its units.
+        Additional keyword arguments are sent to psychopy.visual.TextStim().
+        """
+        kwargs.setdefault('units', getattr(window, 'units', None))
+        key = (window, text) + tuple(sorted((name, _hashable(value))
+                                            for name, value in kwargs.items()))
+        try:
+            self.stimuli.move_to_end(key)
+            stim = self.stimuli[key]
+        except KeyError:
+            stim = psychopy.visual.TextStim(window, text=text, pos=pos, **kwargs)
+            self.stimuli[key] = stim
+            if len(self.stimuli) > self.max_size:
+                self.stimuli.popitem(last=False)
+            return stim
+
+        stim.pos = pos
+        return stim
+
+    def draw(self, window, text, pos=(0, 0), **kwargs):
+        """Draws text at pos with a cached TextStim and returns the stim.
+
+        Parameters:
+        window -- The psychopy window the text is drawn in.
+        text -- The string to show.
+        pos -- The x,y position of the text in its units.
+        Additional keyword arguments are sent to psychopy.visual.TextStim().
+        """
+        stim = self.get(window, text, pos, **kwargs)
+        stim.draw()
+        return stim
+
+    def clear(self):
+        """Drops every cached stim."""
+        self.stimuli.clear()
+
+
+shared = TextCache()
+
+
+def get_text(window, text, pos=(0, 0), **kwargs):
+    """Returns a TextStim from the shared cache (see TextCache.get)."""
+    return shared.get(window, text, pos, **kwargs)
+
+
+def draw_text(window, text, pos=(0, 0), **kwargs):
+    """Draws text with a TextStim from the shared cache (see TextCache.draw)."""
+    return shared.draw(window, text, pos, **kwargs)
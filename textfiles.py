@@ -0,0 +1,29 @@
+"""Writes tab separated rows to text files and makes them durable.
+
+These helpers are used by code that must not import psychopy, e.g.
+generateTrials and the generateTrialsBatch pool workers, which only write
+trial files. baseDefsPsychoPy imports them, so
+`from baseDefsPsychoPy import *` still provides them.
+
+Functions:
+syncFile -- flushes a file and fsyncs it to disk.
+writeToFile -- writes a row as a tab separated line.
+"""
+
+import os
+
+
+def writeToFile(fileHandle, trial, sync=True):
+    """Writes a trial (array of lists) to a fileHandle"""
+    line = '\t'.join([str(i) for i in trial])  # TABify
+    line += '\n'  # add a newline
+    fileHandle.write(line)
+    if sync:
+        fileHandle.flush()
+        os.fsync(fileHandle)
+
+
+def syncFile(fileHandle):
+    """syncs file to prevent buffer loss"""
+    fileHandle.flush()
+    os.fsync(fileHandle)
@@ -0,0 +1,229 @@
+"""Compact storage for the trials of an experiment.
+
+A block of trials kept as a list of dicts costs a dict per trial plus a
+Python list (and a float object per number) for every per-item value, such
+as the locations, rotations and stimuli of a search array. Over long
+multi-block sessions these millions of small objects take memory and make
+the garbage collector pause. A TrialBlock instead keeps the scalar fields
+of all its trials in one numpy structured array and every list field in a
+columnar.RaggedColumn (all values in one array plus row offsets).
+
+Indexing a TrialBlock returns a TrialView, a small slotted object that
+reads the trial's values from the block on access, so code written for
+trial dicts (trial['set_size'], trial.get('cresp'), hooks that set
+trial['x'] = ...) keeps working. List fields are returned as numpy arrays
+(views into the block, nothing is copied); use .tolist() where a list is
+needed, e.g. for json.dumps.
+
+TrialRecord is the same idea for trials read one at a time from a trial
+file (see baseDefsPsychoPy.TrialStream): the values of a row in a list,
+with the field names shared by every row of the file.
+
+Classes:
+TrialBlock -- The trials of a block as a structured array plus ragged list columns.
+TrialRecord -- A trial read from a trial file: its values plus field names shared by all rows.
+TrialView -- One trial of a TrialBlock, accessed like a dict.
+"""
+
+import numpy as np
+
+import columnar
+
+
+def _python_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class _Trial:
+    """The dict-like access shared by TrialView and TrialRecord. Subclasses provide _fields (the
+    stored field names) and _lookup(name) (which raises KeyError for unknown names). Values set
+    with trial[name] = value are kept in extra, created on the first assignment."""
+
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        if self.extra is not None and name in self.extra:
+            return self.extra[name]
+        return self._lookup(name)
+
+    def __setitem__(self, name, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[name] = value
+
+    def __contains__(self, name):
+        return name in self._fields() or (self.extra is not None and name in self.extra)
+
+    def get(self, name, default=None):
+        """Returns the value of a field, or default if the trial has no such field."""
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """Returns the field names of the trial, the stored ones first."""
+        names = list(self._fields())
+        if self.extra is not None:
+            names.extend(name for name in self.extra if name not in names)
+        return names
+
+    def to_dict(self):
+        """Returns the trial as a plain dict, with lists for the list fields."""
+        trial = {}
+        for name in self.keys():
+            value = self[name]
+            trial[name] = value.tolist() if isinstance(value, np.ndarray) else value
+        return trial
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+
+class TrialView(_Trial):
+    """One trial of a TrialBlock, accessed like a dict.
+
+    Scalar fields are returned as Python values and list fields as read-only numpy array views.
+
+    Parameters:
+    block -- The TrialBlock.
+    index -- The number of the trial in the block.
+
+    Methods:
+    get -- returns a field, or a default if there is no such field.
+    keys -- returns the field names.
+    to_dict -- returns the trial as a plain dict.
+    """
+
+    __slots__ = ('block', 'index', 'extra')
+
+    def __init__(self, block, index):
+        self.block = block
+        self.index = index
+        self.extra = None
+
+    def _fields(self):
+        return self.block.fields
+
+    def _lookup(self, name):
+        block = self.block
+        if name in block.ragged:
+            return block.ragged[name][self.index]
+        if block.records.dtype.names and name in block.records.dtype.names:
+            return _python_value(block.records[name][self.index])
+        raise KeyError(name)
+
+
+class TrialRecord(_Trial):
+    """A trial read from a trial file: the values of its row plus the field names, which are
+    shared by every row of the file.
+
+    Parameters:
+    index -- A dict from field name to position in values, shared by all rows.
+    values -- The values of the row.
+
+    Methods:
+    get -- returns a field, or a default if there is no such field.
+    keys -- returns the field names.
+    to_dict -- returns the trial as a plain dict.
+    """
+
+    __slots__ = ('index', 'values', 'extra')
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+        self.extra = None
+
+    def _fields(self):
+        return self.index
+
+    def _lookup(self, name):
+        return self.values[self.index[name]]
+
+
+class TrialBlock:
+    """The trials of a block: the scalar fields of every trial in a numpy structured array and the
+    list fields (e.g. locations) in columnar.RaggedColumns.
+
+    Parameters:
+    records -- A structured array with one record per trial.
+    ragged -- A dict from field name to a RaggedColumn with one row per trial.
+    fields -- The field names in order (default is the record fields, then the ragged ones).
+
+    Methods:
+    from_dicts -- builds a TrialBlock from a list of trial dicts (class method).
+    take -- returns a new TrialBlock with the trials in a given order.
+    to_dicts -- returns the trials as a list of plain dicts.
+    """
+
+    def __init__(self, records, ragged=None, fields=None):
+        self.records = records
+        self.ragged = ragged or {}
+        for column in self.ragged.values():
+            column.values.flags.writeable = False  # views handed out must not change the block
+        self.fields = fields or list(records.dtype.names or []) + list(self.ragged)
+
+    @classmethod
+    def from_dicts(cls, trials):
+        """Builds a TrialBlock from a list of trial dicts (or TrialViews) with the same fields.
+
+        Fields whose values are lists, tuples or arrays become ragged columns; all others become
+        fields of the structured array, with the dtype numpy infers for them.
+
+        Parameters:
+        trials -- The list of trials.
+        """
+        if isinstance(trials, cls):
+            return trials
+        trials = list(trials)
+        fields = list(trials[0].keys()) if trials else []
+
+        columns, ragged = [], {}
+        for name in fields:
+            values = [trial[name] for trial in trials]
+            if isinstance(values[0], (list, tuple, np.ndarray)):
+                ragged[name] = columnar.RaggedColumn.from_lists(values)
+            else:
+                columns.append((name, np.asarray(values)))
+
+        records = np.empty(len(trials), dtype=[(name, column.dtype) for name, column in columns])
+        for name, column in columns:
+            records[name] = column
+        return cls(records, ragged, fields)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('trial index out of range')
+        return TrialView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TrialView(self, i)
+
+    def take(self, order):
+        """Returns a new TrialBlock with the trials in order (e.g. a permutation to shuffle them).
+
+        Parameters:
+        order -- A list or array of trial numbers.
+        """
+        order = np.asarray(order, dtype=np.int64)
+        ragged = {}
+        for name, column in self.ragged.items():
+            lengths = column.lengths()[order]
+            offsets = np.zeros(len(order) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            # Position of every value of the new column in the old one
+            gather = np.repeat(column.offsets[order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+            ragged[name] = columnar.RaggedColumn(column.values[gather], offsets)
+        return TrialBlock(self.records[order], ragged, self.fields)
+
+    def to_dicts(self):
+        """Returns the trials as a list of plain dicts, with lists for the list fields (e.g. to
+        write them to a json journal)."""
+        return [trial.to_dict() for trial in self]
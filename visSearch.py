@@ -1,25 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from psychopy import core, visual, prefs, event
-import random, sys
-from stimPresPsychoPy_python3 import *
-#from useful_functions_python3 import *
-#I added these base functions to get get runTimeVars to work
-from baseDefsPsychoPy import *
-from generateTrials import *
-import webbrowser as web
-import socket
-import numpy as np
-from distutils.util import strtobool
-import psychopy.hardware.keyboard
-from baseDefsPsychoPy import *
-from stimPresPsychoPy import *
-import constants
-
-from psychopy import logging
-logging.console.setLevel(logging.CRITICAL)
+#only what is needed to show the subject dialog is imported here; pandas (generateTrials), webbrowser, socket and the
+#audio device (initAudio) are loaded when first used. Run startupprofile.py to check the import time
+import os, random
+from psychopy import core, visual, event, logging
+from baseDefsPsychoPy import getRunTimeVars, popupError, popupConfirm, initAudio, strToBool, loadFiles, TrialLogger, TrialStream, \
+	readLastLine, readTrialFieldNames, getKeyboard, getKeyboardResponse
+from generateTrials import generateTrials
+from searcharray import SearchArrayRenderer
+import coordinates
+import textcache
+from frametiming import FlipTimer, trial_fields, clock_reset_time
+from audiofeedback import FeedbackAudio
 
-print (prefs.general)
+logging.console.setLevel(logging.CRITICAL)
 
 
 class Exp:
@@ -33,17 +27,21 @@ class Exp:
 			if 'Choose' in self.runTimeVars.values():
 				popupError('Need to choose a value from a dropdown box')
 			else:
-				self.outputFile = open('data/' + self.runTimeVars['subjCode'] + '.tsv', 'w')
+				self.trialFile = 'trials/'+self.runTimeVars['subjCode']+'_trials.txt'
+				self.outputFileName = 'data/' + self.runTimeVars['subjCode'] + '.tsv'
+				self.resumeFrom = self.findResumePoint()
+				self.practiceDone = self.resumeFrom is not None #only sessions that reached the real trials are resumed
+				self.outputFile = open(self.outputFileName, 'w' if self.resumeFrom is None else 'a')
 				if self.outputFile:
 					break
 
+		import socket
 		self.runTimeVars['room'] = socket.gethostname().upper()
 		#self.runTimeVars['room'] = 'LiadLab'
 
-		generateTrials(self.runTimeVars,runTimeVarsOrder)
+		if self.resumeFrom is None:
+			generateTrials(self.runTimeVars,runTimeVarsOrder)
 	# 	commented this out 6/29/23
-		(self.header,self.trialInfo) = importTrials('trials/'+self.runTimeVars['subjCode']+'_trials.tsv')
-		self.trialInfo = list(self.trialInfo)
 
 		#open the main window
 		self.win = visual.Window(fullscr=True,allowGUI=False, color=[0,0,0], units='pix')
@@ -51,16 +49,24 @@ class Exp:
 
 
 		self.pics =  loadFiles('stimuli/visual','.png','image', win=self.win)
-		self.sounds =  loadFiles('stimuli/sounds','.wav','sound', win=self.win)
+		initAudio()
+		self.audio = FeedbackAudio(window=self.win) #feedback sounds are preloaded and, on ptb, start with the next flip
+		self.audio.load_folder('stimuli/sounds')
 		self.postSoundDelayCorrect = .3
 		self.postSoundDelayIncorrect = .75
 		self.fixationWait = .5
 		self.takeBreakEveryXTrials = 100
 		self.numPracticeTrials = 5
 		self.radius = 200
-		angles = list(np.array(range(15,360,30))-90)
-		self.locations = polarToRect(angles,self.radius)
+		self.locations = coordinates.circular(12,self.radius,start_angle=-75) #(12,2) array; 12 locations 30 deg apart, none straight up or down
 		self.validResponses = {'up':'present','down':'absent'}
+		self.logger = TrialLogger(self.outputFile, everyNRows=20) #rows are also committed during the ITI, breaks and feedback
+		self.searchArray = SearchArrayRenderer(self.win, size=40, capacity=len(self.locations))
+		self.recordFrameTiming = False #if True, adds the flip timing of each trial phase to every row and saves a summary to data/<subjCode>_timing.json
+		self.flipTimer = FlipTimer(self.win, ['blank','fixation','search','clear'], enabled=self.recordFrameTiming)
+		self.lookAhead = 2 #number of upcoming trials read and prepared in the background while the current one runs
+		self.trialStream = TrialStream(self.trialFile, prepare=self.prepareSearch, lookAhead=self.lookAhead, start=self.resumeFrom or 0)
+		self.header = self.trialStream.fieldNames
 		
 		self.instructionsText = {
 				'e': "Thank you for participating!  In this experiment, your job is to search for a target image which you will see on the next screen. On each trial, you will see a display with some letters or letter-like characters. Sometimes the target will be among them. Other times not. If you spot the target, press the 'up' key. If not, press the 'down' key. You should respond as quickly and accurately as you can. If you make a mistake, you will hear a buzzing sound. \n\n The experimenter will go over these instructions with you and then you can begin.",
@@ -106,12 +112,10 @@ class Exp:
 	# 		event.waitKeys(keyList=keyList)
 
 	def displayText(self,text,keyList=["enter","return"],pos=(0,0),show=True):
-		visual.TextStim(self.win,\
-        	text=text,
-            pos=pos,
-            units='pix').draw()
+		textcache.draw_text(self.win,text,pos=pos,units='pix') #reuses the laid-out text if it was shown before
 		if show:
 			self.win.flip()
+			self.logger.idle()
 			print ('waiting for', keyList)
 			event.waitKeys(keyList=keyList)
 
@@ -125,10 +129,10 @@ class Exp:
 
 
 	def drawFixation(self):
-		visual.TextStim(win=self.win,text='+',color="black",height=40).draw()
+		textcache.draw_text(self.win,'+',color="black",height=40)
 
 	def showTarget(self,targetPic,targetName,lang,showTargetImage,showTargetText):
-		(showTargetImage,showTargetText) = (strtobool(showTargetImage), strtobool(showTargetText))
+		(showTargetImage,showTargetText) = (strToBool(showTargetImage), strToBool(showTargetText))
 		if showTargetImage:
 			self.pics[targetPic]['stim'].setPos([0,0])
 			self.pics[targetPic]['stim'].draw()
@@ -154,39 +158,82 @@ class Exp:
 			self.displayText(text=u"וצחל"+"\n"+"ENTER"+"\n"+u".םינכומ םתאשכ", pos=[0,-350],show=False)
 
 		self.win.flip()
+		self.logger.idle()
 		event.waitKeys()
 		
+	def findResumePoint(self):
+		"""If the subject already has a trial file and a data file (e.g. after a crash) and the experimenter chooses to continue,
+		returns the index of the next real trial, which is then run with the same trial file; otherwise None (a new session).
+		A session that stopped during the practice is started over, as its practice cannot be continued.
+		Only the tail of the data file is read to find the last trial written; a row cut off by the crash is removed"""
+		if not (os.path.isfile(self.trialFile) and os.path.isfile(self.outputFileName)):
+			return None
+		(lastLine,end) = readLastLine(self.outputFileName)
+		if lastLine is None:
+			return None
+		#each row is the trial's fields followed by part and curTrialIndex (see showSearchTrial)
+		numTrialFields = len(readTrialFieldNames(self.trialFile))
+		row = lastLine.split('\t')
+		if row[numTrialFields]!='real': #stopped during the practice
+			return None
+		nextTrialIndex = int(row[numTrialFields+1])+1
+		if not popupConfirm('Found a session of '+self.runTimeVars['subjCode']+' that stopped after '+str(nextTrialIndex)+' trials. Press OK to continue it or Cancel to start over.'):
+			return None
+		os.truncate(self.outputFileName, end)
+		return nextTrialIndex
+
+	def searchTexture(self,picName):
+		"""Names the search array texture of a picture the first time it is used: its file, or for a variant such as L@flipY
+		the image derived from L. Changes the renderer's textures, so it only runs on the main thread (see upload)"""
+		if picName not in self.searchArray.textures:
+			if '@' in picName:
+				self.searchArray.add_texture(picName, self.pics.image(picName))
+			else:
+				self.searchArray.add_texture(picName, os.path.join('stimuli/visual', self.pics[picName]['fileName']))
+		return picName
+
+	def prepareSearch(self,curTrial):
+		"""Computes the search array of a trial without drawing it; the TrialStream runs this for upcoming trials in the background,
+		so it only does numpy work and reads, and never adds textures or picture variants (showSearchTrial does that)"""
+		locationIndices = [int(curDistractorLocation) for curDistractorLocation in curTrial['distractorLocations']]
+		pics = [curTrial['distractorPic']]*len(locationIndices)
+		if curTrial['isPresent']=="present":
+			locationIndices.append(int(curTrial['targetLocation']))
+			pics.append(curTrial['targetPic'])
+		positions = self.locations[locationIndices]
+		#one draw call per image; each item keeps the image's native size (read from the file header, so no ImageStim is created)
+		return self.searchArray.prepare(positions, pics, sizes=[self.pics.size(curPic) for curPic in pics])
+
 	def showSearchTrial(self,curTrial,part,curTrialIndex):
-		self.win.flip()
+		prepared = curTrial.get('prepared') or self.prepareSearch(curTrial) #practice trials are not streamed
+		self.flipTimer.flip('blank')
+		self.logger.idle()
 		core.wait(.100)
+		self.flipTimer.begin('fixation')
 		self.drawFixation()
-		self.win.flip()
+		self.flipTimer.flip('fixation')
+		self.searchArray.upload(prepared, resolve=self.searchTexture) #any new textures go to the GPU while the fixation is up
 		core.wait(self.fixationWait)
 		
+		self.flipTimer.begin('search')
 		self.drawFixation()
-		if curTrial['isPresent']=="present":
-			self.pics[curTrial['targetPic']]['stim'].setPos(self.locations[int(curTrial['targetLocation'])])
-			self.pics[curTrial['targetPic']]['stim'].draw()
-		
-		for curDistractorLocation in curTrial['distractorLocations']:
-			self.pics[curTrial['distractorPic']]['stim'].setPos(self.locations[int(curDistractorLocation)])
-			self.pics[curTrial['distractorPic']]['stim'].draw()
-			
-		self.win.flip()
+		self.searchArray.draw_prepared(prepared)
+		self.flipTimer.flip('search')
 		(response,rt) = getKeyboardResponse(self.validResponses.keys())
-		self.win.flip()
-		
+		responseClockStart = clock_reset_time(getKeyboard().clock)
 		isRight = int(self.validResponses[response]==curTrial['isPresent'])
 		
 		#if isRight:
-		#	self.sounds['bleep']['stim'].play()
-		#	core.wait(self.postSoundDelayCorrect)
+		#	self.audio.play('bleep')
+		if not isRight:
+			self.audio.play('buzz') #scheduled for the clear flip below
+		self.flipTimer.flip('clear')
 		if not isRight:
-			self.sounds['buzz']['stim'].play()
+			self.logger.idle()
 			core.wait(self.postSoundDelayIncorrect)
+			self.audio.measure()
 
-		curTrial['header']=self.header
-		responses=[curTrial[_] for _ in curTrial['header']]
+		responses=[curTrial[_] for _ in self.header]
 		#write dep variables
 		responses.extend(
 			[part,
@@ -194,39 +241,52 @@ class Exp:
 			response,
 			isRight,
 			rt])
-		writeToFile(self.outputFile,responses,writeNewLine=True)
+		if self.flipTimer.enabled:
+			timing = self.flipTimer.trial_data(responseClockStart)
+			responses.extend([timing[_] for _ in trial_fields(self.flipTimer.phases)])
+		self.logger.write(responses)
 
 
-if __name__ == '__main__':
-	exp = Exp()
-#	printHeader(exp.header+['response','categoryChosen','exemplarChosen', 'isRight', 'rt'])
-	
-
-	if exp.runTimeVars['instructions']=='text' or exp.runTimeVars['lang']=='e':
-		exp.displayText(exp.instructionsText[exp.runTimeVars['lang']],['z'])
-	else:
-		exp.displayImage(exp.pics['instructions']['stim'],['z'])
-	
-	exp.displayText(exp.practiceTrials[exp.runTimeVars['lang']])
-	practiceTrialInfo = random.sample(exp.trialInfo[20:50],exp.numPracticeTrials) #take the practice trials from the first block
-	exp.showTarget(practiceTrialInfo[0]['targetPic'],practiceTrialInfo[0]['targetName'],exp.runTimeVars['lang'],exp.runTimeVars['showTargetImage'],exp.runTimeVars['showTargetText'])
-	for curTrialIndex,curTrial in enumerate(practiceTrialInfo):
-		exp.showSearchTrial(curTrial,"practice",curTrialIndex)
+def runSession(exp, openSurvey=True):
+	"""Runs the instructions, practice and real trials of an Exp, then opens the survey if openSurvey"""
+	if not exp.practiceDone: #a resumed session skips the instructions and practice
+		if exp.runTimeVars['instructions']=='text' or exp.runTimeVars['lang']=='e':
+			exp.displayText(exp.instructionsText[exp.runTimeVars['lang']],['z'])
+		else:
+			exp.displayImage(exp.pics['instructions']['stim'],['z'])
+		
+		exp.displayText(exp.practiceTrials[exp.runTimeVars['lang']])
+		practiceTrialInfo = random.sample(TrialStream.readRange(exp.trialFile,20,50),exp.numPracticeTrials) #take the practice trials from the first block
+		exp.showTarget(practiceTrialInfo[0]['targetPic'],practiceTrialInfo[0]['targetName'],exp.runTimeVars['lang'],exp.runTimeVars['showTargetImage'],exp.runTimeVars['showTargetText'])
+		for curTrialIndex,curTrial in enumerate(practiceTrialInfo):
+			exp.showSearchTrial(curTrial,"practice",curTrialIndex)
 
 	exp.displayText(exp.realTrials[exp.runTimeVars['lang']])
-	for curTrialIndex,curTrial in enumerate(exp.trialInfo):
-		if curTrialIndex>0 and curTrialIndex % exp.takeBreakEveryXTrials == 0:
+	prevTrial = None
+	for curTrialIndex,curTrial in enumerate(exp.trialStream, exp.resumeFrom or 0):
+		if curTrialIndex>0 and curTrialIndex % exp.takeBreakEveryXTrials == 0 and curTrialIndex!=exp.resumeFrom: #no break right after resuming
 			exp.displayText(exp.takeBreak[exp.runTimeVars['lang']]) #take a break
 		try:
-			if curTrialIndex==0 or exp.trialInfo[curTrialIndex-1]['targetPic'] != exp.trialInfo[curTrialIndex]['targetPic']:
-				exp.showTarget(exp.trialInfo[curTrialIndex]['targetPic'],exp.trialInfo[curTrialIndex]['targetName'],exp.runTimeVars['lang'],exp.runTimeVars['showTargetImage'],exp.runTimeVars['showTargetText'])
+			if prevTrial is None or prevTrial['targetPic'] != curTrial['targetPic']:
+				exp.showTarget(curTrial['targetPic'],curTrial['targetName'],exp.runTimeVars['lang'],exp.runTimeVars['showTargetImage'],exp.runTimeVars['showTargetText'])
 		except:
 			pass
 		exp.showSearchTrial(curTrial,"real",curTrialIndex)
+		nextTrial = exp.trialStream.peek()
+		if nextTrial is None or nextTrial['block'] != curTrial['block']:
+			exp.logger.endBlock()
+		prevTrial = curTrial
+	exp.logger.close()
+	if exp.flipTimer.enabled:
+		exp.flipTimer.save_summary('data/'+exp.runTimeVars['subjCode']+'_timing.json')
+		exp.audio.save_summary('data/'+exp.runTimeVars['subjCode']+'_audio.json')
 	exp.displayText(exp.thanksText[exp.runTimeVars['lang']])
-	web.open(exp.surveyURL[exp.runTimeVars['lang']])
-
-
-
+	if openSurvey:
+		import webbrowser
+		webbrowser.open(exp.surveyURL[exp.runTimeVars['lang']])
 
 
+if __name__ == '__main__':
+	exp = Exp()
+#	printHeader(exp.header+['response','categoryChosen','exemplarChosen', 'isRight', 'rt'])
+	runSession(exp)
@@ -19,10 +19,10 @@ TLTask -- The class that runs the experiment.
     See 'print TLTask.__doc__' for simple class docs or help(TLTask) for everything.
 """
 
+import ast
 import errno
 import json
 import os
-import random
 import sys
 import time
 
@@ -32,7 +32,13 @@ import psychopy.core
 import psychopy.event
 import psychopy.visual
 
+import columnar
+import frametiming
+import layoutcache
+import searcharray
+import stimatlas
 import template
+import trialblock
 
 # Things you probably want to change
 exp_name = 'VisualSearch'
@@ -42,6 +48,10 @@ number_of_blocks = 2
 
 set_sizes = [2, 6, 10, 14, 18]
 
+# image files in stim_path (without the .jpg extension)
+stim_names = ['BF1A', 'BF1H', 'BF2A', 'BF2H', 'BM1A', 'BM1H', 'BM2A', 'BM2H',
+              'WF1A', 'WF1H', 'WF2A', 'WF2H', 'WM1A', 'WM1H', 'WM2A', 'WM2H']
+
 instruct_text = [
     ('Welcome to the experiment. Press space to begin.'),
     ('In this experiment you will see a set of faces and will be asked yes/no questions.\n\n'
@@ -71,6 +81,16 @@ allowed_deg_from_fix = 6
 # min_distance should be greater than stim_size
 min_distance = 2
 max_per_quad = None  # int or None for totally random displays
+layout_seed = None  # int or None for different trial layouts every session (a resumed one keeps its own)
+use_layout_file = True  # read trials from a precompiled layout file (see layoutcache.py)
+
+stim_cache_size = None  # int or None to keep every stimulus texture loaded
+batch_draw = True  # draw each search array with one ElementArrayStim per image
+use_atlas = False  # draw every search array from one texture atlas of stim_path (see stimatlas.py)
+record_frame_timing = False  # adds flip timing columns and saves a timing summary (frametiming.py)
+
+data_format = 'csv'  # 'csv', or 'npz'/'arrow' to also save typed columnar results (see columnar.py)
+resume_after_crash = True  # continue an unfinished session from its journal (see journal.py)
 
 iti_time = 1  # seconds
 response_time_limit = None  # None or int in seconds
@@ -133,23 +153,43 @@ class TLTask(template.BaseExperiment):
     Parameters:
     allowed_deg_from_fix -- The maximum distance in visual degrees the stimuli can appear from
         fixation
+    batch_draw -- If True, all items that share an image are drawn with a single element array.
+        If False, each item is drawn from the stimulus pool one at a time.
+    data_format -- 'csv', or 'npz' or 'arrow' to also save the results as a columnar file next to
+        the csv, with Locations, Rotations and Stimuli as typed list columns.
     data_directory -- Where the data should be saved.
     instruct_text -- The text to be displayed to the participant at the beginning of the
         experiment.
     iti_time -- The number of seconds in between a response and the next trial.
     keys -- The keys to be used for making a response. Should match possible_orientations.
+    layout_seed -- Seed for the random generator used to build trials (locations, rotations,
+        stimuli and the tested item). If None, every new session gets new layouts, even under
+        a subject number that was run before; only a session resumed after a crash reuses its
+        layout file.
     max_per_quad -- The number of stimuli allowed in each quadrant. If None, displays are
         completely random. Useful for generating more "spread out" displays
     min_distance -- The minimum distance in visual degrees between stimuli.
     number_of_blocks -- The number of blocks in the experiment.
     number_of_trials_per_block -- The number of trials within each block.
     possible_orientations -- A list of strings possibly including "left", "up", "right", or "down"
+    record_frame_timing -- If True, the blank, search and clear flips of every trial are timed. The
+        timing is saved as extra data columns and as a summary at the end of the session.
     questionaire_dict -- Questions to be included in the dialog.
     response_time_limit -- How long in seconds the participant has to respond.
+    resume_after_crash -- If True and the journal of the subject shows an unfinished session
+        (one that crashed; quitting with Q finishes it), run asks whether to continue it and, if
+        so, continues at the block and trial where it stopped instead of starting over.
     set_sizes -- A list of all the set sizes. An equal number of trials will be shown for each set
         size.
+    stim_cache_size -- The number of stimulus images kept loaded. If None, all are kept.
+    stim_names -- A list of the image names (without the .jpg extension) in stim_path.
     stim_path -- A string containing the path to the stim folder
     stim_size -- The size of the stimuli in visual angle.
+    use_atlas -- If True, the images in stim_path are packed into one texture atlas and every
+        search array is drawn from it with a single texture bind. Overrides batch_draw.
+    use_layout_file -- If True, every block is precompiled into a layout file before the first
+        trial (or read from it if it is up to date and layout_seed is set, or the session is
+        resumed) instead of being generated between blocks.
     Additional keyword arguments are sent to template.BaseExperiment().
 
     Methods:
@@ -157,12 +197,18 @@ class TLTask(template.BaseExperiment):
     display_break -- Displays a screen during the break between blocks.
     display_blank -- Displays a blank screen.
     display_search -- Displays the search array.
+    generate_block -- Generates a new block of trials.
+    generate_block_locations -- Generates the locations for a whole block of trials.
     generate_locations -- Helper function that generates locations for make_trial
     get_response -- Waits for a response from the participant.
+    load_stimuli -- Creates the renderer or stimulus pool used by display_search.
+    layout_filename -- Returns the name of the subject's layout file.
     make_block -- Creates a block of trials to be run.
     make_trial -- Creates a single trial.
+    resume_position -- Finds where to continue an unfinished session from its journal.
     run_trial -- Runs a single trial.
     run -- Runs the entire experiment.
+    save_data_columnar -- Writes the data to a columnar file if data_format is 'npz' or 'arrow'.
     send_data -- Updates the experiment data with the information from the last trial.
     """
 
@@ -172,7 +218,11 @@ class TLTask(template.BaseExperiment):
                  allowed_deg_from_fix=allowed_deg_from_fix, min_distance=min_distance,
                  max_per_quad=max_per_quad, instruct_text=instruct_text, iti_time=iti_time,
                  data_directory=data_directory, questionaire_dict=questionaire_dict,
-                 response_time_limit=response_time_limit, **kwargs):
+                 response_time_limit=response_time_limit, stim_names=stim_names,
+                 stim_cache_size=stim_cache_size, batch_draw=batch_draw, layout_seed=layout_seed,
+                 use_layout_file=use_layout_file, record_frame_timing=record_frame_timing,
+                 use_atlas=use_atlas, data_format=data_format,
+                 resume_after_crash=resume_after_crash, **kwargs):
 
         self.number_of_trials_per_block = number_of_trials_per_block
         self.number_of_blocks = number_of_blocks
@@ -192,30 +242,30 @@ class TLTask(template.BaseExperiment):
         self.allowed_deg_from_fix = allowed_deg_from_fix
         self.min_distance = min_distance
         self.max_per_quad = max_per_quad
+        self.layout_seed = layout_seed
+        self.rng = np.random.default_rng(layout_seed)
+        self.use_layout_file = use_layout_file
+        self.layouts = None
 
         self.instruct_text = instruct_text
 
         self.iti_time = iti_time
 
         self.data_directory = data_directory
+        self.data_format = data_format
+        self.trial_arrays = []  # the list values of each trial for save_data_columnar
+        self.resume_after_crash = resume_after_crash
         self.questionaire_dict = questionaire_dict
 
-        self.BF1A_stim_path = os.path.join(stim_path, 'BF1A.jpg')
-        self.BF1H_stim_path = os.path.join(stim_path, 'BF1H.jpg')
-        self.BF2A_stim_path = os.path.join(stim_path, 'BF2A.jpg')
-        self.BF2H_stim_path = os.path.join(stim_path, 'BF2H.jpg')
-        self.BM1A_stim_path = os.path.join(stim_path, 'BM1A.jpg')
-        self.BM1H_stim_path = os.path.join(stim_path, 'BM1H.jpg')
-        self.BM2A_stim_path = os.path.join(stim_path, 'BM2A.jpg')
-        self.BM2H_stim_path = os.path.join(stim_path, 'BM2H.jpg')
-        self.WF1A_stim_path = os.path.join(stim_path, 'WF1A.jpg')
-        self.WF1A_stim_path = os.path.join(stim_path, 'WF1H.jpg')
-        self.WF2A_stim_path = os.path.join(stim_path, 'WF2A.jpg')
-        self.WF2H_stim_path = os.path.join(stim_path, 'WF2H.jpg')
-        self.WM1A_stim_path = os.path.join(stim_path, 'WM1A.jpg')
-        self.WM1H_stim_path = os.path.join(stim_path, 'WM1H.jpg')
-        self.WM2A_stim_path = os.path.join(stim_path, 'WM2A.jpg')
-        self.WM2H_stim_path = os.path.join(stim_path, 'WM2H.jpg')
+        self.stim_names = stim_names
+        self.stim_path = stim_path
+        self.stim_paths = {name: os.path.join(stim_path, name + '.jpg') for name in stim_names}
+        self.stim_cache_size = stim_cache_size
+        self.batch_draw = batch_draw
+        self.use_atlas = use_atlas
+        self.stimulus_pool = None
+        self.search_renderer = None
+        self.atlas = None
 
         self.trials_per_set_size = number_of_trials_per_block / len(set_sizes)
 
@@ -224,8 +274,15 @@ class TLTask(template.BaseExperiment):
 
         self.trials_per_set_size = int(self.trials_per_set_size)
 
+        self.response_clock_start = None  # on psychopy.core.monotonicClock, like flip timestamps
+
+        if record_frame_timing:
+            kwargs['frame_timing_phases'] = ['blank', 'search', 'clear']
+
         super().__init__(**kwargs)
 
+        self.keep_experiment_data = data_format != 'csv'  # save_data_columnar rewrites every row
+
     def chdir(self):
         """Changes the directory to where the data will be saved."""
 
@@ -237,21 +294,69 @@ class TLTask(template.BaseExperiment):
 
         os.chdir(self.data_directory)
 
-    def make_block(self):
+    def layout_filename(self):
+        """Returns the name of the layout file for the current subject."""
+
+        return (self.experiment_name + '_' +
+                self.experiment_info['Subject Number'].zfill(3) + '_layouts.npy')
+
+    def make_block(self, block_num=None):
         """Makes a block of trials.
 
-        Returns a shuffled list of trials created by self.make_trial.
+        Returns a trialblock.TrialBlock with the trials of block_num from the layout file if one is
+        loaded, otherwise a newly generated block (see generate_block).
+
+        Parameters:
+        block_num -- The number of the block in the experiment.
         """
-        trial_list = []
+        if self.layouts is None or block_num is None:
+            return self.generate_block()
+
+        n_trials = self.number_of_trials_per_block
+        block_layouts = self.layouts[block_num * n_trials:(block_num + 1) * n_trials]
 
-        for set_size in self.set_sizes:
-            for _ in range(self.trials_per_set_size):
-                trial = self.make_trial(set_size)
-                trial_list.append(trial)
+        return self._block_from_layouts(block_layouts)
 
-        random.shuffle(trial_list)
+    def _block_from_layouts(self, layouts):
+        """Converts records of the layout file into a TrialBlock without a per trial loop.
 
-        return trial_list
+        Parameters:
+        layouts -- Records of the array returned by layoutcache.load_layouts.
+        """
+        set_sizes = layouts['set_size'].astype(np.int64)
+        offsets = np.zeros(len(layouts) + 1, dtype=np.int64)
+        np.cumsum(set_sizes, out=offsets[1:])
+        # The layout file pads every trial to the largest set size; keep the first set_size items
+        used = np.arange(layouts['rotations'].shape[1]) < set_sizes[:, np.newaxis]
+
+        records = np.empty(len(layouts), dtype=[
+            ('set_size', np.int64), ('cresp', np.asarray(self.keys).dtype),
+            ('test_location', np.int64)])
+        records['set_size'] = set_sizes
+        records['cresp'] = np.asarray(self.keys)[layouts['cresp']]
+        records['test_location'] = layouts['test_location']
+
+        return trialblock.TrialBlock(records, {
+            'locations': columnar.RaggedColumn(layouts['locations'][used], offsets),
+            'rotations': columnar.RaggedColumn(layouts['rotations'][used], offsets),
+            'stimuli': columnar.RaggedColumn(np.asarray(self.stim_names)[layouts['stimuli'][used]],
+                                             offsets),
+        }, fields=['set_size', 'cresp', 'locations', 'rotations', 'stimuli', 'test_location'])
+
+    def generate_block(self):
+        """Generates a new block of trials.
+
+        Returns a trialblock.TrialBlock of the trials created by self.make_trial, shuffled.
+        """
+        trial_set_sizes = [set_size for set_size in self.set_sizes
+                           for _ in range(self.trials_per_set_size)]
+        block_locations = self.generate_block_locations(trial_set_sizes)
+
+        trial_list = [self.make_trial(set_size, locs)
+                      for set_size, locs in zip(trial_set_sizes, block_locations)]
+
+        return trialblock.TrialBlock.from_dicts(trial_list).take(
+            self.rng.permutation(len(trial_list)))
 
     @staticmethod
     def _which_quad(loc):
@@ -271,61 +376,153 @@ class TLTask(template.BaseExperiment):
         else:
             return 3
 
-    def _too_close(self, attempt, locs):
-        """Checks that an attempted location is valid.
+    def _layout_capacity(self):
+        """Estimates the largest set size that can be placed with the current distance values.
+
+        Random sequential placement jams once discs of diameter min_distance cover about 54.7% of
+        the area. Using only the area available to stimulus centers (the square within
+        allowed_deg_from_fix minus the disc kept clear around fixation) keeps the estimate below
+        the number that random placement actually reaches. Returns infinity if min_distance is 0.
+        """
+        if self.min_distance <= 0:
+            return np.inf
+
+        area = (2 * self.allowed_deg_from_fix) ** 2 - np.pi * self.min_distance ** 2
+
+        return int(0.547 * area / (np.pi * (self.min_distance / 2) ** 2))
 
-        This method is used by generate_locations to ensure the min_distance condition is followed.
+    def _check_layout_feasible(self, set_size):
+        """Raises a ValueError if set_size stimuli cannot be placed with the current values.
 
         Parameters:
-        attempt -- A list of two values (x,y) in visual angle.
-        locs -- A list of previous successful attempts to be checked.
+        set_size -- The number of stimuli for a trial.
         """
-        if np.linalg.norm(np.array(attempt)) < self.min_distance:
-            return True  # Too close to center
+        capacity = self._layout_capacity()
+
+        if self.max_per_quad is not None:
+            capacity = min(capacity, 4 * self.max_per_quad)
+
+        if set_size > capacity:
+            raise ValueError(
+                'Cannot place %d stimuli: at most about %d fit with allowed_deg_from_fix=%s, '
+                'min_distance=%s and max_per_quad=%s.' % (
+                    set_size, capacity, self.allowed_deg_from_fix, self.min_distance,
+                    self.max_per_quad))
 
-        for loc in locs:
-            if np.linalg.norm(np.array(attempt) - np.array(loc)) < self.min_distance:
-                return True  # Too close to another square
+    def _draw_candidates(self, n):
+        """Draws n uniform candidate locations and drops those too close to fixation.
 
-        return False
+        Returns a list of [x, y] lists.
 
-    def generate_locations(self, set_size):
+        Parameters:
+        n -- The number of candidates to draw.
+        """
+        candidates = self.rng.uniform(
+            -self.allowed_deg_from_fix, self.allowed_deg_from_fix, size=(n, 2))
+        far_enough = np.einsum('ij,ij->i', candidates, candidates) >= self.min_distance ** 2
+
+        return candidates[far_enough].tolist()
+
+    def generate_locations(self, set_size, candidates=None):
         """Creates the locations for a trial. A helper function for self.make_trial.
 
         Returns a list of acceptable locations (as multiple [x, y] lists).
 
+        Candidates are accepted in order if they are at least min_distance from every accepted
+        location and their quadrant is not full. Accepted locations are stored in a spatial hash
+        with cells min_distance wide, so each candidate is only compared with the locations in
+        its 3x3 neighbourhood of cells.
+
         Parameters:
         set_size -- The number of stimuli for this trial.
+        candidates -- An optional list of [x, y] candidates to try first (see
+            generate_block_locations). More are drawn if they run out.
         """
-        if self.max_per_quad is not None:
-            # quad boundries (x1, x2, y1, y2)
-            quad_count = [0, 0, 0, 0]
+        self._check_layout_feasible(set_size)
+
+        for _ in range(10):
+            locs = self._place_candidates(set_size, candidates)
+            if locs is not None:
+                return locs
+            candidates = None  # An unlucky early arrangement left no room, start over
+
+        raise ValueError('Timeout -- Cannot generate locations with given values.')
+
+    def _place_candidates(self, set_size, candidates=None, max_batches=25):
+        """Accepts candidate locations for one trial. A helper function for generate_locations.
+
+        Returns the list of locations, or None if max_batches batches of candidates were used
+        without placing set_size stimuli.
+
+        Parameters:
+        set_size -- The number of stimuli for this trial.
+        candidates -- An optional list of [x, y] candidates to try first.
+        max_batches -- How many extra batches of candidates to draw before giving up.
+        """
+        cell_size = self.min_distance
+        min_distance_sq = self.min_distance ** 2
+        grid = {}
+        quad_count = [0, 0, 0, 0]
 
         locs = []
-        counter = 0
+        batches = 0
+        if candidates is None:
+            candidates = []
         while len(locs) < set_size:
-            counter += 1
-            if counter > 1000:
-                raise ValueError('Timeout -- Cannot generate locations with given values.')
+            if not candidates:
+                batches += 1
+                if batches > max_batches:
+                    return None
+                candidates = self._draw_candidates(4 * set_size)
+                continue
 
-            attempt = [random.uniform(-self.allowed_deg_from_fix, self.allowed_deg_from_fix)
-                       for _ in range(2)]
+            attempt = candidates.pop()
 
-            if self._too_close(attempt, locs):
-                continue
+            if cell_size > 0:
+                cell = (int(attempt[0] // cell_size), int(attempt[1] // cell_size))
+                neighbours = [loc for i in range(cell[0] - 1, cell[0] + 2)
+                              for j in range(cell[1] - 1, cell[1] + 2)
+                              for loc in grid.get((i, j), ())]
+                if any((attempt[0] - loc[0]) ** 2 + (attempt[1] - loc[1]) ** 2 < min_distance_sq
+                       for loc in neighbours):
+                    continue  # Too close to another stimulus
 
             if self.max_per_quad is not None:
                 quad = self._which_quad(attempt)
+                if quad_count[quad] >= self.max_per_quad:
+                    continue
+                quad_count[quad] += 1
 
-                if quad_count[quad] < self.max_per_quad:
-                    quad_count[quad] += 1
-                    locs.append(attempt)
-            else:
-                locs.append(attempt)
+            if cell_size > 0:
+                grid.setdefault(cell, []).append(attempt)
+            locs.append(attempt)
 
         return locs
 
-    def make_trial(self, set_size):
+    def generate_block_locations(self, set_sizes):
+        """Creates the locations for every trial of a block.
+
+        The candidates for all trials are drawn in one batch and each trial is then built from its
+        own share with generate_locations.
+
+        Returns a list with one list of locations per trial.
+
+        Parameters:
+        set_sizes -- A list with the set size of each trial.
+        """
+        for set_size in set(set_sizes):
+            self._check_layout_feasible(set_size)
+
+        per_trial = 4 * max(set_sizes, default=0)
+        candidates = self.rng.uniform(
+            -self.allowed_deg_from_fix, self.allowed_deg_from_fix,
+            size=(len(set_sizes), per_trial, 2))
+        far_enough = np.einsum('tij,tij->ti', candidates, candidates) >= self.min_distance ** 2
+
+        return [self.generate_locations(set_size, candidates[t][far_enough[t]].tolist())
+                for t, set_size in enumerate(set_sizes)]
+
+    def make_trial(self, set_size, locs=None):
         """Creates a single trial dict. A helper function for self.make_block.
 
         Returns the trial dict with the following fields:
@@ -340,12 +537,14 @@ class TLTask(template.BaseExperiment):
 
         Parameters:
         set_size -- The number of stimuli for this trial.
+        locs -- Optional locations for this trial. If None, they are generated.
         """
-        test_location = random.randint(0, set_size - 1)
+        test_location = int(self.rng.integers(set_size))
 
-        locs = self.generate_locations(set_size)
+        if locs is None:
+            locs = self.generate_locations(set_size)
 
-        ori_idx = [random.randint(0, len(self.possible_orientations) - 1) for _ in range(set_size)]
+        ori_idx = self.rng.integers(len(self.possible_orientations), size=set_size).tolist()
         oris = [self.possible_orientations[i] for i in ori_idx]
 
         replacement_orientations = {
@@ -358,8 +557,7 @@ class TLTask(template.BaseExperiment):
         oris = [replacement_orientations[ori] for ori in oris]
         cresp = self.keys[ori_idx[test_location]]
 
-        stims = [random.choice(['BF1A', 'BF1H', 'BF2A', 'BF2H', 'BM1A', 'BM1H', 'BM2A', 'BM2H', 'WF1A', 'WF1H', 'WF2A', 'WF2H', 'WM1A', 'WM1H', 'WM2A', 'WM2H']) for _ in range(set_size)]
-        stims[test_location] = [random.choice(['BF1A', 'BF1H', 'BF2A', 'BF2H', 'BM1A', 'BM1H', 'BM2A', 'BM2H', 'WF1A', 'WF1H', 'WF2A', 'WF2H', 'WM1A', 'WM1H', 'WM2A', 'WM2H'])]
+        stims = [self.stim_names[i] for i in self.rng.integers(len(self.stim_names), size=set_size)]
 
         trial = {
             'set_size': set_size,
@@ -395,30 +593,50 @@ class TLTask(template.BaseExperiment):
         wait_time -- The amount of time the blank should be displayed for.
         """
 
-        self.experiment_window.flip()
+        self.flip('blank')
 
         psychopy.core.wait(wait_time)
 
+    def load_stimuli(self):
+        """Creates the atlas, search renderer or stimulus pool and loads every stimulus image before
+        the first trial."""
+
+        if self.use_atlas:
+            atlas_filename = os.path.join(self.data_directory, 'stim_atlas.png')
+            if stimatlas.atlas_is_stale(self.stim_path, atlas_filename, ['.jpg']):
+                self.atlas = stimatlas.build_atlas(self.stim_path, atlas_filename, ['.jpg'])
+            else:
+                self.atlas = stimatlas.load_atlas(atlas_filename)
+        elif self.batch_draw:
+            self.search_renderer = searcharray.SearchArrayRenderer(
+                self.experiment_window, size=self.stim_size, capacity=max(self.set_sizes))
+            self.search_renderer.preload(self.stim_paths.values())
+        else:
+            self.stimulus_pool = template.StimulusPool(
+                self.experiment_window, max_size=self.stim_cache_size, size=self.stim_size)
+            self.stimulus_pool.preload(self.stim_paths.values())
+
     def display_search(self, coordinates, rotations, stimuli):
         """Displays the search array.
 
         Parameters:
         coordinates -- A list of lists containing x,y coordinates in visual degrees
         rotations -- a list of rotations (int 0 - 360) to apply to the images
-        stimuli -- A list of "T", "L1" and "L2" describing which image file to load
+        stimuli -- A list of names from stim_names describing which image to draw
         """
-        for pos, ori, stim in zip(coordinates, rotations, stimuli):
-            if stim == "BF1A":
-                path = self.BF1A_stim_path
-            elif stim == "BF1H":
-                path = self.BF1H_stim_path
-            else:
-                path = self.BF2A_stim_path
-
-            psychopy.visual.ImageStim(self.experiment_window, image=path, pos=pos, ori=ori,
-                                      size=self.stim_size).draw()
+        self.begin_draw('search')
+
+        if self.atlas is not None:
+            stimatlas.draw_many(self.experiment_window, self.atlas, stimuli, coordinates,
+                                oris=rotations, sizes=self.stim_size)
+        elif self.search_renderer is not None:
+            self.search_renderer.draw(
+                coordinates, [self.stim_paths[stim] for stim in stimuli], oris=rotations)
+        else:
+            for pos, ori, stim in zip(coordinates, rotations, stimuli):
+                self.stimulus_pool.draw(self.stim_paths[stim], pos=pos, ori=ori, size=self.stim_size)
 
-        self.experiment_window.flip()
+        self.flip('search')
 
     def get_response(self, allow_quit=True):
         """Waits for a response from the participant. A helper function for self.run_trial.
@@ -430,8 +648,9 @@ class TLTask(template.BaseExperiment):
         """
 
         rt_timer = psychopy.core.MonotonicClock()
+        self.response_clock_start = frametiming.clock_reset_time(rt_timer)
 
-        keys = self.keys
+        keys = list(self.keys)
         if allow_quit:
             keys += ['q']
 
@@ -475,7 +694,7 @@ class TLTask(template.BaseExperiment):
         self.display_search(trial['locations'], trial['rotations'], trial['stimuli'])
 
         resp, rt = self.get_response()
-        self.experiment_window.flip()
+        self.flip('clear')
 
         acc = 1 if resp == trial['cresp'] else 0
 
@@ -490,13 +709,79 @@ class TLTask(template.BaseExperiment):
             'RESP': resp,
             'ACC': acc,
             'LocationTested': trial['test_location'],
-            'Locations': json.dumps(trial['locations']),
-            'Rotations': json.dumps(trial['rotations']),
-            'Stimuli': str(trial['stimuli']),  # avoids double quotes issues
+            'Locations': json.dumps(np.asarray(trial['locations']).tolist()),
+            'Rotations': json.dumps(np.asarray(trial['rotations']).tolist()),
+            'Stimuli': str(np.asarray(trial['stimuli']).tolist()),  # avoids double quotes issues
         }
 
+        if self.flip_timer.enabled:
+            data.update(self.flip_timer.trial_data(self.response_clock_start))
+
+        if self.data_format != 'csv':
+            self.trial_arrays.append({
+                'Locations': np.asarray(trial['locations'], dtype=np.float32).reshape(-1, 2),
+                'Rotations': np.asarray(trial['rotations'], dtype=np.int16),
+                'Stimuli': np.asarray(trial['stimuli'], dtype=str),
+            })
+
         return data
 
+    def save_data_columnar(self):
+        """Writes every trial so far to a columnar file (see columnar.py) if data_format is 'npz'
+        or 'arrow'.
+
+        The file has the name of the csv file with the data_format extension. Locations (as x, y
+        pairs), Rotations and Stimuli are list columns instead of json strings.
+        """
+        if self.data_format == 'csv':
+            return
+
+        columns = {}
+        for field in self.data_fields:
+            if self.trial_arrays and field in self.trial_arrays[0]:
+                columns[field] = columnar.RaggedColumn.from_lists(
+                    [arrays[field] for arrays in self.trial_arrays])
+            else:
+                columns[field] = columnar.typed_column(
+                    [trial.get(field) for trial in self.experiment_data])
+
+        columnar.write_table(
+            os.path.splitext(self.experiment_data_filename)[0] + '.' + self.data_format, columns)
+
+    def resume_position(self, records):
+        """Finds where an unfinished session stopped from the records of its journal.
+
+        Returns the block and trial number to continue at and a dict of the trials of every
+        journaled block. Also restores the random generator to its state after the last block was
+        made, and the list values of the trials run so far for save_data_columnar.
+
+        Parameters:
+        records -- The journal records returned by recover_from_journal.
+        """
+        blocks = {}
+        block_num, trials_done = 0, 0
+        for record in records:
+            if record['type'] == 'block':
+                block_num, trials_done = record['block_num'], 0
+                blocks[block_num] = trialblock.TrialBlock.from_dicts(record['trials'])
+                self.rng.bit_generator.state = record['rng_state']
+            elif record['type'] == 'data':
+                trials_done += 1
+
+                if self.data_format != 'csv':
+                    data = record['data']
+                    self.trial_arrays.append({
+                        'Locations': np.asarray(json.loads(data['Locations']),
+                                                dtype=np.float32).reshape(-1, 2),
+                        'Rotations': np.asarray(json.loads(data['Rotations']), dtype=np.int16),
+                        'Stimuli': np.asarray(ast.literal_eval(data['Stimuli']), dtype=str),
+                    })
+
+        if block_num in blocks and trials_done >= len(blocks[block_num]):
+            block_num, trials_done = block_num + 1, 0
+
+        return block_num, trials_done, blocks
+
     def run(self, setup_hook=None, before_first_trial_hook=None, pre_block_hook=None,
             pre_trial_hook=None, post_trial_hook=post_trial_hook, post_block_hook=None,
             end_experiment_hook=None):
@@ -511,10 +796,11 @@ class TLTask(template.BaseExperiment):
         Parameters:
         setup_hook -- takes self, executed once the window is open.
         before_first_trial_hook -- takes self, executed after instructions are displayed.
-        pre_block_hook -- takes self, block list and block num
+        pre_block_hook -- takes self, block (a trialblock.TrialBlock) and block num
             Executed immediately before block start.
-            Can optionally return an altered block list.
-        pre_trial_hook -- takes self, trial dict, block num, trial num
+            Can optionally return an altered block (a TrialBlock or a list of trial dicts).
+        pre_trial_hook -- takes self, trial (a trialblock.TrialView, used like a dict), block num,
+            trial num
             Executed immediately before trial start.
             Can optionally return an altered trial dict.
         post_trial_hook -- takes self and the trial data, executed immediately after trial end.
@@ -532,29 +818,54 @@ class TLTask(template.BaseExperiment):
             print('Experiment has been terminated.')
             sys.exit(1)
 
-        self.save_experiment_info()
-        self.open_csv_data_file()
+        records = self.recover_from_journal() if self.resume_after_crash else None
+        if records is None:
+            self.save_experiment_info()
+            self.open_csv_data_file()
+            self.open_journal()
+            self.save_checkpoint()
+            first_block, first_trial, journaled_blocks = 0, 0, {}
+        else:
+            first_block, first_trial, journaled_blocks = self.resume_position(records)
+
         self.open_window(screen=0)
         self.display_text_screen('Loading...', wait_for_input=False)
+        self.load_stimuli()
+
+        if self.use_layout_file:
+            # Without a seed a new session must not reuse an earlier session's layouts
+            rebuild = records is None and self.layout_seed is None
+            self.layouts = layoutcache.load_layouts(self, self.layout_filename(), rebuild=rebuild)
 
         if setup_hook is not None:
             setup_hook(self)
 
-        for instruction in self.instruct_text:
-            self.display_text_screen(text=instruction)
+        if records is None:
+            for instruction in self.instruct_text:
+                self.display_text_screen(text=instruction)
 
-        if before_first_trial_hook is not None:
-            before_first_trial_hook(self)
+            if before_first_trial_hook is not None:
+                before_first_trial_hook(self)
+        else:
+            self.display_text_screen('Press any key to continue the experiment.')
 
-        for block_num in range(self.number_of_blocks):
-            block = self.make_block()
+        for block_num in range(first_block, self.number_of_blocks):
+            if block_num in journaled_blocks:
+                block = journaled_blocks[block_num]  # pre_block_hook was already applied
+            else:
+                block = self.make_block(block_num)
+
+                if pre_block_hook is not None:
+                    tmp = pre_block_hook(self, block, block_num)
+                    if tmp is not None:
+                        block = trialblock.TrialBlock.from_dicts(tmp)
 
-            if pre_block_hook is not None:
-                tmp = pre_block_hook(self, block, block_num)
-                if tmp is not None:
-                    block = tmp
+                self.add_journal_record('block', block_num=block_num, trials=block.to_dicts(),
+                                        rng_state=self.rng.bit_generator.state)
 
             for trial_num, trial in enumerate(block):
+                if block_num == first_block and trial_num < first_trial:
+                    continue  # already run before the crash
 
                 if pre_trial_hook is not None:
                     tmp = pre_trial_hook(self, trial, block_num, trial_num)
@@ -571,6 +882,7 @@ class TLTask(template.BaseExperiment):
                 self.send_data(data)
 
             self.save_data_to_csv()
+            self.save_data_columnar()
 
             if post_block_hook is not None:
                 post_block_hook(self)
@@ -578,6 +890,8 @@ class TLTask(template.BaseExperiment):
             if block_num + 1 != self.number_of_blocks:
                 self.display_break()
 
+        self.save_checkpoint({'finished': True})
+
         if end_experiment_hook is not None:
             end_experiment_hook(self)
 